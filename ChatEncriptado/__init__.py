@@ -0,0 +1,4 @@
+# Load the celery app when django starts so @shared_task uses it.
+from .celery import app as celery_app
+
+__all__ = ('celery_app',)
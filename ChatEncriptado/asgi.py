@@ -13,4 +13,17 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ChatEncriptado.settings')
 
-application = get_asgi_application()
+# Initialize Django before importing anything that touches the ORM.
+django_asgi_app = get_asgi_application()
+
+from channels.routing import ProtocolTypeRouter, URLRouter  # noqa: E402
+
+from api_chat.middleware import TokenAuthMiddleware  # noqa: E402
+from api_chat.routing import websocket_urlpatterns  # noqa: E402
+
+application = ProtocolTypeRouter({
+    'http': django_asgi_app,
+    # Clients authenticate with a knox token instead of cookies, so the origin is not
+    # checked here; CORS_ALLOW_ALL_ORIGINS already allows any origin for the REST api.
+    'websocket': TokenAuthMiddleware(URLRouter(websocket_urlpatterns)),
+})
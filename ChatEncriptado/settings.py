@@ -37,6 +37,7 @@ else:
 # Application definition
 
 INSTALLED_APPS = [
+    'daphne',
     'api_chat.apps.ApiChatConfig',
     'admin_interface',
     'colorfield',
@@ -56,6 +57,8 @@ X_FRAME_OPTIONS = 'SAMEORIGIN'
 SILENCED_SYSTEM_CHECKS = ['security.W019']
 
 MIDDLEWARE = [
+    # First, so its timings cover the rest of the stack; unloaded when METRICS_ENABLED is off.
+    'api_chat.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -94,27 +97,151 @@ ASGI_APPLICATION = 'ChatEncriptado.asgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
-result = urlparse(os.environ.get('DATABASE_URL'))
-username = result.username
-password = result.password
-database = result.path[1:]
-hostname = result.hostname
-port = result.port
+# Under ASGI (daphne) django opens a thread per request, so connections are kept in an
+# in-process pool (api_chat.postgresql_pool) instead of persistent per thread. Under WSGI
+# set DB_POOL=False: every thread keeps its connection for DB_CONN_MAX_AGE seconds.
+DB_POOL = os.environ.get('DB_POOL', 'True') == 'True'
+DB_CONN_MAX_AGE = int(os.environ.get('DB_CONN_MAX_AGE', 60))
+# Check a reused connection before the first query of a request, to survive db restarts.
+DB_CONN_HEALTH_CHECKS = os.environ.get('DB_CONN_HEALTH_CHECKS', 'True') == 'True'
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 20))
+DB_POOL_MAX_IDLE = int(os.environ.get('DB_POOL_MAX_IDLE', 5))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+DB_POOL_MAX_AGE = int(os.environ.get('DB_POOL_MAX_AGE', 600))
+
+
+def database_from_url(url):
+    result = urlparse(url)
+    database = {
+        'ENGINE': 'api_chat.postgresql_pool' if DB_POOL else 'django.db.backends.postgresql_psycopg2',
+        'NAME': result.path[1:],
+        'USER': result.username,
+        'PASSWORD': result.password,
+        'HOST': result.hostname,
+        'PORT': result.port,
+        'CONN_MAX_AGE': 0 if DB_POOL else DB_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': DB_CONN_HEALTH_CHECKS,
+    }
+    if DB_POOL:
+        database['POOL'] = {
+            'MAX_SIZE': DB_POOL_MAX_SIZE,
+            'MAX_IDLE': DB_POOL_MAX_IDLE,
+            'TIMEOUT': DB_POOL_TIMEOUT,
+            'MAX_AGE': DB_POOL_MAX_AGE,
+        }
+    return database
+
 
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.postgresql_psycopg2',
-        'NAME': database,
-        'USER': username,
-        'PASSWORD': password,
-        'HOST': hostname,
-        'PORT': port,
-        'MIGRATE': True,
-    }
+    'default': dict(database_from_url(os.environ.get('DATABASE_URL')), MIGRATE=True),
 }
 
+# Comma separated urls of read replicas, used by the views wrapped in read_from_replica()
+# (validated_chat/ and validate_chat_aproved/); see api_chat.routers.
+DATABASE_REPLICAS = []
+for index, url in enumerate(filter(None, os.environ.get('DATABASE_REPLICA_URLS', '').split(','))):
+    alias = 'replica%d' % (index + 1)
+    # Tests run every replica alias against the test database of default.
+    DATABASES[alias] = dict(database_from_url(url.strip()), TEST={'MIRROR': 'default'})
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['api_chat.routers.ReplicaRouter']
+
+# REDIS
+REDIS_URL = os.environ.get('REDIS_URL')
+
+# CHANNELS
+# Without REDIS_URL (local development) frames are only relayed inside one process.
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [REDIS_URL],
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
+
+# CACHE
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Maximum length of a single encrypted frame relayed through the chat WebSocket.
+CHAT_MAX_FRAME_SIZE = int(os.environ.get('CHAT_MAX_FRAME_SIZE', 64 * 1024))
+
+# Serve login/, created_chat/, validated_chat/, authorized_chat/ and validate_chat_aproved/
+# with their async views. Meant for ASGI servers (daphne, see Procfile); under WSGI the
+# sync views avoid running an event loop per request.
+ASYNC_VIEWS = os.environ.get('ASYNC_VIEWS', 'True') == 'True'
+
+# Default and maximum seconds a validate_chat_aproved/wait/ long-poll may block.
+CHAT_LONG_POLL_TIMEOUT = int(os.environ.get('CHAT_LONG_POLL_TIMEOUT', 25))
+CHAT_LONG_POLL_MAX_TIMEOUT = int(os.environ.get('CHAT_LONG_POLL_MAX_TIMEOUT', 60))
+
+# Default and maximum page size of chat_messages/.
+CHAT_HISTORY_PAGE_SIZE = int(os.environ.get('CHAT_HISTORY_PAGE_SIZE', 100))
+CHAT_HISTORY_MAX_LIMIT = int(os.environ.get('CHAT_HISTORY_MAX_LIMIT', 500))
+
+# Maximum number of phones accepted by created_chat_batch/.
+CHAT_BATCH_MAX_SIZE = int(os.environ.get('CHAT_BATCH_MAX_SIZE', 500))
+
+# Maximum members of a group conversation.
+CHAT_GROUP_MAX_MEMBERS = int(os.environ.get('CHAT_GROUP_MAX_MEMBERS', 500))
+
+# Largest public key or signature accepted by keys/ and prekeys/, in bytes, and most
+# one-time prekeys uploaded per request.
+KEYS_MAX_KEY_SIZE = int(os.environ.get('KEYS_MAX_KEY_SIZE', 256))
+KEYS_MAX_PREKEYS = int(os.environ.get('KEYS_MAX_PREKEYS', 200))
+
+# Offline mailboxes: default and maximum envelopes returned by a mailbox/ drain, most
+# envelopes a device keeps (the oldest are evicted beyond it) and days an envelope waits
+# to be acknowledged. Evictions run every MAILBOX_EVICTION_INTERVAL seconds (celery beat).
+MAILBOX_PAGE_SIZE = int(os.environ.get('MAILBOX_PAGE_SIZE', 1000))
+MAILBOX_MAX_LIMIT = int(os.environ.get('MAILBOX_MAX_LIMIT', 5000))
+MAILBOX_MAX_ENVELOPES = int(os.environ.get('MAILBOX_MAX_ENVELOPES', 10000))
+MAILBOX_MAX_AGE_DAYS = int(os.environ.get('MAILBOX_MAX_AGE_DAYS', 30))
+
+# Default and maximum page size of chat_inbox/ (and groups/).
+CHAT_INBOX_PAGE_SIZE = int(os.environ.get('CHAT_INBOX_PAGE_SIZE', 50))
+CHAT_INBOX_MAX_LIMIT = int(os.environ.get('CHAT_INBOX_MAX_LIMIT', 200))
+
 REST_FRAMEWORK = {
-    'DEFAULT_AUTHENTICATION_CLASSES': ('knox.auth.TokenAuthentication',),
+    'DEFAULT_AUTHENTICATION_CLASSES': ('api_chat.authentication.CachedTokenAuthentication',),
+    # Sliding-window limits used by api_chat.throttling, keyed '<throttle_scope>_<phone|ip|token>'.
+    'DEFAULT_THROTTLE_RATES': {
+        'otp_phone': os.environ.get('THROTTLE_OTP_PHONE', '5/hour'),
+        'otp_ip': os.environ.get('THROTTLE_OTP_IP', '30/hour'),
+        'otp_verify_phone': os.environ.get('THROTTLE_OTP_VERIFY_PHONE', '10/hour'),
+        'otp_verify_ip': os.environ.get('THROTTLE_OTP_VERIFY_IP', '60/hour'),
+        'login_phone': os.environ.get('THROTTLE_LOGIN_PHONE', '10/minute'),
+        'login_ip': os.environ.get('THROTTLE_LOGIN_IP', '60/minute'),
+        'chat_token': os.environ.get('THROTTLE_CHAT_TOKEN', '120/minute'),
+        # key_bundles/ claims one-time prekeys of other users: keep draining them slow.
+        'keys_token': os.environ.get('THROTTLE_KEYS_TOKEN', '30/minute'),
+        # Every attachments request calls the storage service.
+        'attachments_token': os.environ.get('THROTTLE_ATTACHMENTS_TOKEN', '30/minute'),
+        # change_psw_api/ hashes the current and the new password.
+        'account_token': os.environ.get('THROTTLE_ACCOUNT_TOKEN', '10/hour'),
+    },
+    # Proxies in front of the app (dokku's nginx); used to read the client ip.
+    'NUM_PROXIES': int(os.environ.get('NUM_PROXIES', 1)),
 }
 
 REST_KNOX = {
@@ -122,6 +249,20 @@ REST_KNOX = {
     'TOKEN_TTL': timedelta(hours=24 * 7),
 }
 
+# Token -> user cache used by CachedTokenAuthentication. Entries in the shared cache live
+# until the token expires, capped by TOKEN_CACHE_TTL seconds; the per-worker LRU keeps up
+# to TOKEN_CACHE_SIZE entries for TOKEN_CACHE_LOCAL_TTL seconds, which bounds how long a
+# revoked token can still be accepted by another worker.
+TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL', 300))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
+TOKEN_CACHE_LOCAL_TTL = int(os.environ.get('TOKEN_CACHE_LOCAL_TTL', 10))
+
+# Expired knox tokens are deleted by api_chat.tasks.clear_expired_tokens (celery beat) or
+# the clear_expired_tokens command, TOKEN_SWEEP_BATCH_SIZE rows per query and at most
+# TOKEN_SWEEP_MAX_BATCHES queries per run (0: no limit).
+TOKEN_SWEEP_BATCH_SIZE = int(os.environ.get('TOKEN_SWEEP_BATCH_SIZE', 1000))
+TOKEN_SWEEP_MAX_BATCHES = int(os.environ.get('TOKEN_SWEEP_MAX_BATCHES', 100))
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -140,6 +281,26 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Hasher for new passwords: 'scrypt', 'argon2' or 'pbkdf2'. Hashes made with another
+# hasher or other costs are rehashed on the next successful login.
+PASSWORD_HASHER = os.environ.get('PASSWORD_HASHER', 'scrypt')
+PASSWORD_SCRYPT_WORK_FACTOR = int(os.environ.get('PASSWORD_SCRYPT_WORK_FACTOR', 2 ** 14))
+PASSWORD_SCRYPT_BLOCK_SIZE = int(os.environ.get('PASSWORD_SCRYPT_BLOCK_SIZE', 8))
+PASSWORD_SCRYPT_PARALLELISM = int(os.environ.get('PASSWORD_SCRYPT_PARALLELISM', 1))
+PASSWORD_ARGON2_TIME_COST = int(os.environ.get('PASSWORD_ARGON2_TIME_COST', 2))
+PASSWORD_ARGON2_MEMORY_COST = int(os.environ.get('PASSWORD_ARGON2_MEMORY_COST', 102400))
+PASSWORD_ARGON2_PARALLELISM = int(os.environ.get('PASSWORD_ARGON2_PARALLELISM', 8))
+PASSWORD_PBKDF2_ITERATIONS = int(os.environ.get('PASSWORD_PBKDF2_ITERATIONS', 390000))
+_PASSWORD_HASHERS = {
+    'scrypt': 'api_chat.hashers.ScryptPasswordHasher',
+    'argon2': 'api_chat.hashers.Argon2PasswordHasher',
+    'pbkdf2': 'api_chat.hashers.PBKDF2PasswordHasher',
+}
+PASSWORD_HASHERS = [_PASSWORD_HASHERS[PASSWORD_HASHER]] + [
+    hasher for name, hasher in _PASSWORD_HASHERS.items() if name != PASSWORD_HASHER]
+# Threads hashing passwords for the async login; hashing uses a whole core each.
+PASSWORD_HASHER_THREADS = int(os.environ.get('PASSWORD_HASHER_THREADS', os.cpu_count() or 1))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
@@ -187,11 +348,120 @@ DEFAULT_FILE_STORAGE = 'storages.backends.s3boto3.S3Boto3Storage'
 AWS_S3_FILE_OVERWRITE = False
 AWS_QUERYSTRING_AUTH = False
 AWS_DEFAULT_ACL = 'public-read'
+# 'path' for S3-compatible services without virtual-hosted buckets (MinIO).
+AWS_S3_ADDRESSING_STYLE = os.environ.get('AWS_S3_ADDRESSING_STYLE')
+AWS_S3_SIGNATURE_VERSION = 's3v4'
+
+# Encrypted chat attachments, uploaded and downloaded through presigned urls (see
+# api_chat/attachments.py). They are private objects, so they may share the bucket of
+# the public media files. Sizes are in bytes; S3 parts must be of 5 MiB or more.
+ATTACHMENTS_BUCKET_NAME = os.environ.get('ATTACHMENTS_BUCKET_NAME', AWS_STORAGE_BUCKET_NAME)
+ATTACHMENTS_LOCATION = os.environ.get('ATTACHMENTS_LOCATION', 'attachments')
+ATTACHMENT_PART_SIZE = int(os.environ.get('ATTACHMENT_PART_SIZE', 8 * 1024 * 1024))
+ATTACHMENT_MAX_SIZE = int(os.environ.get('ATTACHMENT_MAX_SIZE', 1024 * 1024 * 1024))
+# Seconds a presigned url stays valid, and an upload may stay incomplete before it is aborted.
+ATTACHMENT_URL_EXPIRES = int(os.environ.get('ATTACHMENT_URL_EXPIRES', 3600))
+ATTACHMENT_UPLOAD_TTL = int(os.environ.get('ATTACHMENT_UPLOAD_TTL', 24 * 3600))
+
+# Square WebP variants made of every Profile.image, in pixels, their quality (0-100) and
+# the storage folder they go to. AvatarField (the avatar of ChatMemberSerializer) defaults
+# to PROFILE_IMAGE_DEFAULT_SIZE; clients ask for another size with ?avatar_size=<px>.
+PROFILE_IMAGE_SIZES = [int(size) for size in os.environ.get('PROFILE_IMAGE_SIZES', '64,128,256,512').split(',')]
+PROFILE_IMAGE_QUALITY = int(os.environ.get('PROFILE_IMAGE_QUALITY', 80))
+PROFILE_IMAGE_VARIANTS_LOCATION = os.environ.get('PROFILE_IMAGE_VARIANTS_LOCATION', 'profile_variants')
+PROFILE_IMAGE_DEFAULT_SIZE = int(os.environ.get('PROFILE_IMAGE_DEFAULT_SIZE', 128))
 
 # TWILIO
 ACCOUNT_SID = os.environ.get('TWILIO_ACCOUNT_SID')
 AUTH_TOKEN = os.environ.get('TWILIO_AUTH_TOKEN')
-PHONE_NUMBER = os.environ.get('TWILIO_PHONE_NUMBER')
+PHONE_NUMBER = os.environ.get('TWILIO_PHONE_NUMBER', '+14254753844')
+
+# SMS
+# api_chat.sms.TwilioBackend sends for real; api_chat.sms.LocMemBackend and
+# api_chat.sms.FileBackend (writes to SMS_FILE_PATH) are stubs for tests and benchmarks.
+SMS_BACKEND = os.environ.get('SMS_BACKEND', 'api_chat.sms.TwilioBackend')
+SMS_FILE_PATH = os.environ.get('SMS_FILE_PATH', str(BASE_DIR / 'sms_outbox.jsonl'))
+SMS_MAX_RETRIES = int(os.environ.get('SMS_MAX_RETRIES', 5))
+SMS_RETRY_BACKOFF_MAX = int(os.environ.get('SMS_RETRY_BACKOFF_MAX', 300))
+# Concurrent requests per batch and per pooled Twilio session, and per-request timeout.
+SMS_MAX_IN_FLIGHT = int(os.environ.get('SMS_MAX_IN_FLIGHT', 10))
+SMS_TIMEOUT = float(os.environ.get('SMS_TIMEOUT', 10))
+# With redis, OTPs queued within SMS_BATCH_WINDOW seconds are sent together, at most
+# SMS_BATCH_MAX_SIZE per task (see api_chat.tasks.enqueue_sms); 0 sends each on its own.
+SMS_BATCH_WINDOW = float(os.environ.get('SMS_BATCH_WINDOW', 0.5))
+SMS_BATCH_MAX_SIZE = int(os.environ.get('SMS_BATCH_MAX_SIZE', 100))
+# Seconds a scheduled flush of the buffer is waited for before the next OTP schedules
+# another (the task may have been lost); keep it above SMS_BATCH_WINDOW plus a batch send.
+SMS_BATCH_FLUSH_TIMEOUT = int(os.environ.get('SMS_BATCH_FLUSH_TIMEOUT', 60))
+# Only set to point the Twilio client at a local fake server (bench_sms).
+TWILIO_API_BASE_URL = os.environ.get('TWILIO_API_BASE_URL')
+
+# PHONES
+# Country code assumed for national numbers (without +<country code>) sent by clients.
+PHONE_DEFAULT_COUNTRY_CODE = os.environ.get('PHONE_DEFAULT_COUNTRY_CODE', '51')
+
+# OTP
+# Verification state of OTPs sent by SMS. Redis expires it OTP_TTL seconds after the last
+# OTP sent to a phone; without redis it falls back to the PhoneOTP table. Redis keeps the
+# number of OTPs sent to a phone, which the "max otp sent" limits count, until
+# OTP_COUNT_TTL seconds after the last one; the PhoneOTP table keeps it until the phone
+# registers or changes its password.
+OTP_STORE = os.environ.get(
+    'OTP_STORE', 'api_chat.otp_store.RedisOTPStore' if REDIS_URL else 'api_chat.otp_store.ORMOTPStore')
+OTP_TTL = int(os.environ.get('OTP_TTL', 10 * 60))
+OTP_COUNT_TTL = int(os.environ.get('OTP_COUNT_TTL', 30 * 24 * 3600))
+# Digits of the OTPs sent by SMS.
+OTP_LENGTH = int(os.environ.get('OTP_LENGTH', 6))
+# Seconds a code is accepted, and verifications allowed per code. Only an HMAC of each code
+# is stored, keyed with OTP_HMAC_KEY (SECRET_KEY when unset).
+OTP_CODE_TTL = int(os.environ.get('OTP_CODE_TTL', 5 * 60))
+OTP_MAX_ATTEMPTS = int(os.environ.get('OTP_MAX_ATTEMPTS', 5))
+OTP_HMAC_KEY = os.environ.get('OTP_HMAC_KEY')
+
+# CELERY
+# Without a broker (local development) tasks run inline in the request.
+CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', REDIS_URL)
+CELERY_TASK_ALWAYS_EAGER = not CELERY_BROKER_URL
+CELERY_TASK_IGNORE_RESULT = True
+CELERY_TASK_ACKS_LATE = True
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+# Run `celery -A ChatEncriptado beat` (see Procfile) for the periodic tasks.
+CELERY_BEAT_SCHEDULE = {
+    'clear-expired-tokens': {
+        'task': 'api_chat.tasks.clear_expired_tokens',
+        'schedule': int(os.environ.get('TOKEN_SWEEP_INTERVAL', 3600)),
+    },
+    'evict-mailboxes': {
+        'task': 'api_chat.tasks.evict_mailboxes',
+        'schedule': int(os.environ.get('MAILBOX_EVICTION_INTERVAL', 3600)),
+    },
+    'abort-stale-uploads': {
+        'task': 'api_chat.tasks.abort_stale_uploads',
+        'schedule': int(os.environ.get('ATTACHMENT_SWEEP_INTERVAL', 3600)),
+    },
+}
+
+# METRICS
+# Request, database, SMS and token auth metrics scraped from /metrics (api_chat.metrics).
+# Off by default: the middleware is then not loaded at all.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'False') == 'True'
+# Bearer token required to scrape /metrics, if set.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# LOGGING
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'simple': {'format': '%(asctime)s %(levelname)s %(name)s %(message)s'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'simple'},
+    },
+    'loggers': {
+        'api_chat': {'handlers': ['console'], 'level': os.environ.get('LOG_LEVEL', 'INFO')},
+    },
+}
 
 #CORS
 CORS_ALLOW_ALL_ORIGINS = True
@@ -17,6 +17,8 @@ from django.urls import path, include, re_path
 from django.contrib import admin
 from django.contrib.auth import views as auth_views
 
+from api_chat.views import MetricsView
+
 admin.site.site_header = "Encripted Chat Stracontech"
 admin.site.site_title = "Encripted Chat Stracontech"
 admin.site.index_title = "Bienvenido a la Plataforma de administración del Chat Encriptado de Stracontech"
@@ -24,6 +26,7 @@ admin.site.index_title = "Bienvenido a la Plataforma de administración del Chat
 urlpatterns = [
 
     re_path(r'^api/', include('api_chat.urls')),
+    path('metrics', MetricsView.as_view(), name='metrics'),
 
     path('accounts/password_reset/', auth_views.PasswordResetView.as_view(), name='admin_password_reset', ),
     path('accounts/password_reset/done/', auth_views.PasswordResetDoneView.as_view(),
@@ -0,0 +1,145 @@
+"""
+Presigned S3 multipart uploads and downloads of encrypted attachments.
+
+Clients PUT the parts of an attachment straight to the bucket (in parallel, any order)
+and GET it back from it, with URLs signed here; the bytes never go through a Django
+worker. Works with any S3-compatible service (MinIO, ...) set in AWS_S3_ENDPOINT_URL.
+"""
+import logging
+import threading
+
+from botocore.exceptions import BotoCoreError, ClientError
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# Errors of the storage service (unreachable, denied, unknown upload, ...).
+STORAGE_ERRORS = (BotoCoreError, ClientError)
+
+# S3 rejects parts smaller than 5 MiB, except the last one, and uploads of more than
+# 10000 parts.
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+
+_client = None
+_lock = threading.Lock()
+
+
+def get_s3_client():
+    """
+    Process-wide boto3 S3 client; it is thread-safe and keeps connections alive.
+    """
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                import boto3
+                from botocore.config import Config
+
+                _client = boto3.client(
+                    's3',
+                    aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+                    aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+                    region_name=settings.AWS_S3_REGION_NAME,
+                    endpoint_url=settings.AWS_S3_ENDPOINT_URL,
+                    config=Config(signature_version='s3v4',
+                                  s3={'addressing_style': settings.AWS_S3_ADDRESSING_STYLE or 'auto'}),
+                )
+    return _client
+
+
+def part_count(size, part_size):
+    return max(1, -(-size // part_size))
+
+
+def create_upload(key):
+    """Starts a multipart upload of a private object, returns its upload id."""
+    response = get_s3_client().create_multipart_upload(
+        Bucket=settings.ATTACHMENTS_BUCKET_NAME, Key=key, ContentType='application/octet-stream')
+    return response['UploadId']
+
+
+def presign_parts(key, upload_id, part_numbers):
+    """``[{'numero': n, 'url': ...}]``, one PUT url per part. Signing is local, no request is made."""
+    client = get_s3_client()
+    return [{
+        'numero': number,
+        'url': client.generate_presigned_url('upload_part', Params={
+            'Bucket': settings.ATTACHMENTS_BUCKET_NAME, 'Key': key, 'UploadId': upload_id, 'PartNumber': number,
+        }, ExpiresIn=settings.ATTACHMENT_URL_EXPIRES),
+    } for number in part_numbers]
+
+
+def list_uploaded_parts(key, upload_id):
+    """``{part number: (etag, size)}`` of the parts stored so far."""
+    client = get_s3_client()
+    parts = {}
+    kwargs = {'Bucket': settings.ATTACHMENTS_BUCKET_NAME, 'Key': key, 'UploadId': upload_id}
+    while True:
+        response = client.list_parts(**kwargs)
+        for part in response.get('Parts', ()):
+            parts[part['PartNumber']] = (part['ETag'], part['Size'])
+        if not response.get('IsTruncated'):
+            return parts
+        kwargs['PartNumberMarker'] = response['NextPartNumberMarker']
+
+
+def missing_parts(attachment, parts):
+    """
+    Numbers of the parts of ``attachment`` that are absent from ``parts`` (as returned by
+    list_uploaded_parts) or do not have the size they should.
+    """
+    count = part_count(attachment.tamano, attachment.tamano_parte)
+    last_size = attachment.tamano - (count - 1) * attachment.tamano_parte
+    return [number for number in range(1, count + 1)
+            if parts.get(number, (None, None))[1] != (last_size if number == count else attachment.tamano_parte)]
+
+
+def complete_upload(key, upload_id, parts):
+    get_s3_client().complete_multipart_upload(
+        Bucket=settings.ATTACHMENTS_BUCKET_NAME, Key=key, UploadId=upload_id,
+        MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': parts[number][0]} for number in sorted(parts)]})
+
+
+def abort_upload(key, upload_id):
+    try:
+        get_s3_client().abort_multipart_upload(Bucket=settings.ATTACHMENTS_BUCKET_NAME, Key=key, UploadId=upload_id)
+    except ClientError as e:
+        # Already aborted or completed: the parts are gone either way.
+        if e.response.get('Error', {}).get('Code') != 'NoSuchUpload':
+            raise
+
+
+def presign_download(key):
+    return get_s3_client().generate_presigned_url('get_object', Params={
+        'Bucket': settings.ATTACHMENTS_BUCKET_NAME, 'Key': key,
+    }, ExpiresIn=settings.ATTACHMENT_URL_EXPIRES)
+
+
+def abort_stale_uploads(max_age, batch_size=100):
+    """
+    Aborts the uploads started more than ``max_age`` (a timedelta) ago and never completed,
+    so their parts stop being billed, and deletes their attachments. Returns how many.
+    """
+    from api_chat.models import Attachment
+
+    limite = timezone.now() - max_age
+    aborted = 0
+    while True:
+        stale = list(Attachment.objects.filter(estado=Attachment.PENDIENTE, fecha_hora_creacion__lt=limite)
+                     .values_list('id', 'key', 'upload_id')[:batch_size])
+        if not stale:
+            return aborted
+        done = []
+        for id_adjunto, key, upload_id in stale:
+            try:
+                abort_upload(key, upload_id)
+            except STORAGE_ERRORS:
+                logger.exception('No se pudo abortar la subida del adjunto %s', id_adjunto)
+                continue
+            done.append(id_adjunto)
+        if not done:
+            # Storage unreachable: try again on the next run.
+            return aborted
+        aborted += Attachment.objects.filter(id__in=done, estado=Attachment.PENDIENTE).delete()[0]
@@ -0,0 +1,207 @@
+import binascii
+import threading
+import time
+from collections import OrderedDict
+from hmac import compare_digest
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connections, router
+from django.utils import timezone
+from knox.auth import TokenAuthentication
+from knox.crypto import hash_token
+from knox.signals import token_expired
+from knox.models import AuthToken
+from knox.settings import CONSTANTS, knox_settings
+from rest_framework import exceptions
+
+from api_chat import metrics
+
+
+class TokenCache:
+    """
+    Two tier cache of knox token -> user resolutions.
+
+    The first tier is a bounded LRU private to the worker process, with a short TTL since
+    other workers can not evict from it. The second tier is the shared django cache (Redis
+    when REDIS_URL is set), whose entries live until the token expires, capped by
+    TOKEN_CACHE_TTL. Entries keep the token digest, so the token itself is still verified
+    on every request; only the database round trips are saved.
+    """
+    # Renamed when the entries change shape, so entries of the previous version are ignored.
+    key_prefix = 'knox_auth:'
+
+    def __init__(self):
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cache_key(self, token_key):
+        return self.key_prefix + token_key
+
+    def get(self, token_key):
+        now = time.monotonic()
+        with self._lock:
+            item = self._local.get(token_key)
+            if item is not None:
+                entry, deadline = item
+                if deadline > now:
+                    self._local.move_to_end(token_key)
+                    return entry
+                del self._local[token_key]
+
+        entry = cache.get(self._cache_key(token_key))
+        if entry is not None:
+            self._set_local(token_key, entry)
+        return entry
+
+    def set(self, token_key, entry):
+        timeout = settings.TOKEN_CACHE_TTL
+        if entry['expiry'] is not None:
+            timeout = min(timeout, (entry['expiry'] - timezone.now()).total_seconds())
+        if timeout <= 0:
+            return
+        cache.set(self._cache_key(token_key), entry, timeout)
+        self._set_local(token_key, entry)
+
+    def _set_local(self, token_key, entry):
+        if settings.TOKEN_CACHE_SIZE <= 0 or settings.TOKEN_CACHE_LOCAL_TTL <= 0:
+            return
+        deadline = time.monotonic() + settings.TOKEN_CACHE_LOCAL_TTL
+        with self._lock:
+            self._local[token_key] = (entry, deadline)
+            self._local.move_to_end(token_key)
+            while len(self._local) > settings.TOKEN_CACHE_SIZE:
+                self._local.popitem(last=False)
+
+    def delete_many(self, token_keys):
+        token_keys = list(token_keys)
+        if not token_keys:
+            return
+        with self._lock:
+            for token_key in token_keys:
+                self._local.pop(token_key, None)
+        cache.delete_many([self._cache_key(token_key) for token_key in token_keys])
+
+    def delete(self, token_key):
+        self.delete_many([token_key])
+
+
+token_cache = TokenCache()
+
+
+def cache_auth_token(auth_token):
+    # Only what authenticating needs, not the user: no password hashes in the shared cache.
+    token_cache.set(auth_token.token_key, {
+        'digest': auth_token.digest,
+        'expiry': auth_token.expiry,
+        'user_id': auth_token.user_id,
+        'user_active': auth_token.user.is_active,
+    })
+
+
+def cached_user(entry):
+    '''
+    The user of a cached token with only its id and active flag loaded; any other field is
+    read from the database when first accessed, and save() writes only the fields set on
+    it, so nothing stale is written back.
+    '''
+    User = get_user_model()
+    return User.from_db(User.objects.db, ['id', 'active'], [entry['user_id'], entry['user_active']])
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    '''
+    knox TokenAuthentication that resolves tokens through ``token_cache``.
+
+    A cache hit costs a hash of the token and no queries. On a miss the regular knox
+    lookup runs and its result is cached. A cached expiry that falls behind an
+    AUTO_REFRESH renewal only forces a fresh lookup. ``request.auth`` is always an
+    AuthToken, so knox's LogoutView keeps working with it.
+    '''
+
+    def authenticate_credentials(self, token):
+        start = time.perf_counter()
+        credentials, cache_result = self.resolve_credentials(token)
+        metrics.auth_duration.observe(time.perf_counter() - start, cache_result)
+        return credentials
+
+    def resolve_credentials(self, token):
+        """
+        Returns ``((user, auth_token), cache_result)``, where cache_result tells whether
+        ``token_cache`` answered ('hit') or the database was queried ('miss').
+        """
+        token_str = token.decode('utf-8')
+        token_key = token_str[:CONSTANTS.TOKEN_KEY_LENGTH]
+
+        entry = token_cache.get(token_key)
+        if entry is not None:
+            try:
+                digest = hash_token(token_str)
+            except (TypeError, binascii.Error):
+                raise exceptions.AuthenticationFailed('Invalid token.')
+            if compare_digest(digest, entry['digest']) and (
+                    entry['expiry'] is None or entry['expiry'] > timezone.now()):
+                auth_token = AuthToken(digest=entry['digest'], token_key=token_key,
+                                       user=cached_user(entry), expiry=entry['expiry'])
+                auth_token._state.adding = False
+                if knox_settings.AUTO_REFRESH and auth_token.expiry:
+                    self.renew_token(auth_token)
+                return self.validate_user(auth_token), 'hit'
+
+        user, auth_token = self.authenticate_uncached(token_str)
+        cache_auth_token(auth_token)
+        return (user, auth_token), 'miss'
+
+    def authenticate_uncached(self, token):
+        """
+        knox's lookup in a single query: the user is joined in, and an expired token is
+        deleted when it is presented instead of checking every token of the user on
+        each lookup.
+        """
+        msg = 'Invalid token.'
+        for auth_token in AuthToken.objects.filter(
+                token_key=token[:CONSTANTS.TOKEN_KEY_LENGTH]).select_related('user'):
+            try:
+                digest = hash_token(token)
+            except (TypeError, binascii.Error):
+                raise exceptions.AuthenticationFailed(msg)
+            if not compare_digest(digest, auth_token.digest):
+                continue
+            if auth_token.expiry is not None and auth_token.expiry < timezone.now():
+                username = auth_token.user.get_username()
+                auth_token.delete()
+                token_expired.send(sender=self.__class__, username=username, source='auth_token')
+                break
+            if knox_settings.AUTO_REFRESH and auth_token.expiry:
+                self.renew_token(auth_token)
+            return self.validate_user(auth_token)
+        raise exceptions.AuthenticationFailed(msg)
+
+
+def delete_expired_tokens(batch_size=1000, max_batches=None):
+    """
+    Deletes the knox tokens that expired, oldest first, ``batch_size`` rows per query so
+    locks stay short, and at most ``max_batches`` batches (None: until none is left).
+    knox only deletes the expired tokens of a user when that user authenticates, so
+    without this the table grows with every login. Returns how many were deleted.
+    """
+    now = timezone.now()
+    expired = AuthToken.objects.filter(expiry__lt=now)
+    table = connections[router.db_for_write(AuthToken)].ops.quote_name(AuthToken._meta.db_table)
+    deleted = batches = 0
+    while max_batches is None or batches < max_batches:
+        batch = list(expired.order_by('expiry').values_list('digest', 'token_key')[:batch_size])
+        if not batch:
+            break
+        # A plain DELETE instead of delete(): its per row post_delete signals (cache
+        # eviction) would cost a query and a cache round trip per token, so the cache is
+        # evicted in bulk here.
+        with connections[router.db_for_write(AuthToken)].cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+                table, cursor.db.ops.quote_name('digest'), ', '.join(['%s'] * len(batch))),
+                [digest for digest, _ in batch])
+            deleted += cursor.rowcount
+        token_cache.delete_many(token_key for _, token_key in batch)
+        batches += 1
+    return deleted
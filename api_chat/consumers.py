@@ -0,0 +1,226 @@
+import asyncio
+import base64
+import binascii
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from api_chat.models import Chat, ChatMember, Device, Message
+
+logger = logging.getLogger(__name__)
+
+# Close codes sent to the client when the handshake is rejected.
+CLOSE_NOT_AUTHENTICATED = 4001
+CLOSE_FORBIDDEN = 4003
+CLOSE_FRAME_TOO_LARGE = 4009
+
+
+def chat_group_name(id_chat):
+    return 'chat_%s' % id_chat
+
+
+async def anotify_chat_accepted(chat):
+    """
+    Pushes a ``chat.accepted`` event to everyone subscribed to the chat group, i.e. the
+    initiator's WebSocket and any pending long-poll on validate_chat_aproved/wait/.
+    A channel layer failure is logged but never undoes the acceptance itself.
+    """
+    try:
+        await get_channel_layer().group_send(chat_group_name(chat.pk), {
+            'type': 'chat.accepted',
+            'id_chat': chat.pk,
+        })
+    except Exception:
+        logger.exception('No se pudo notificar la aceptación del chat %s', chat.pk)
+
+
+def notify_chat_accepted(chat):
+    """
+    Synchronous form of ``anotify_chat_accepted``, for sync views.
+    """
+    async_to_sync(anotify_chat_accepted)(chat)
+
+
+def notify_member_removed(id_chat, user_id):
+    """
+    Tells the connections of a group that ``user_id`` left it; that user's own
+    connections are closed.
+    """
+    try:
+        async_to_sync(get_channel_layer().group_send)(chat_group_name(id_chat), {
+            'type': 'chat.member_removed',
+            'user_id': user_id,
+        })
+    except Exception:
+        logger.exception('No se pudo notificar la salida del usuario %s del chat %s', user_id, id_chat)
+
+
+def mailbox_group_name(id_dispositivo):
+    return 'mailbox_%s' % id_dispositivo
+
+
+def notify_envelopes(sobres):
+    """
+    Pushes every stored envelope to the connections of its device, so devices online get
+    it right away; all group_sends run concurrently. The envelopes stay in the mailbox
+    until acknowledged, so a failure here only delays them until the next drain.
+    """
+    async def send_all():
+        channel_layer = get_channel_layer()
+        await asyncio.gather(*(channel_layer.group_send(mailbox_group_name(sobre.device_id), {
+            'type': 'mailbox.envelope',
+            'id': sobre.pk,
+            'id_chat': sobre.chat_id,
+            'user_desde': sobre.user_desde_id,
+            'contenido': base64.b64encode(sobre.contenido).decode('ascii'),
+        }) for sobre in sobres))
+
+    try:
+        async_to_sync(send_all)()
+    except Exception:
+        logger.exception('No se pudieron notificar %d sobres', len(sobres))
+
+
+class MailboxConsumer(AsyncJsonWebsocketConsumer):
+    '''
+    Delivers the envelopes stored for one device of the user while it is connected. It is
+    only a fast path: envelopes are deleted when the device acknowledges them through
+    mailbox/ack/, and whatever arrived while offline is read with mailbox/.
+    '''
+
+    async def connect(self):
+        self.id_dispositivo = int(self.scope['url_route']['kwargs']['id_dispositivo'])
+        self.group_name = mailbox_group_name(self.id_dispositivo)
+        user = self.scope.get('user')
+
+        if user is None or not user.is_authenticated:
+            await self.close(code=CLOSE_NOT_AUTHENTICATED)
+            return
+        if not await Device.objects.filter(id=self.id_dispositivo, user=user).aexists():
+            await self.close(code=CLOSE_FORBIDDEN)
+            return
+
+        self.user = user
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, code):
+        if hasattr(self, 'user'):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def mailbox_envelope(self, event):
+        await self.send_json(event)
+
+
+class ChatConsumer(AsyncJsonWebsocketConsumer):
+    '''
+    Relays encrypted frames between the two participants of an accepted chat, or the
+    members of a group who accepted its invitation.
+
+    The server never looks inside ``ciphertext`` (base64); it only checks that the sender
+    belongs to the chat, stores the frame with the next seq of the chat and forwards it to
+    every other connection in the chat group.
+    The initiator may also connect while the chat is still pending: it then receives a
+    ``chat.accepted`` event as soon as the receiver accepts, and can start sending.
+    Membership is checked once, when connecting; a frame to a group of any size is then a
+    single insert and a single group_send, fanned out by the channel layer.
+    '''
+
+    async def connect(self):
+        self.id_chat = int(self.scope['url_route']['kwargs']['id_chat'])
+        self.group_name = chat_group_name(self.id_chat)
+        user = self.scope.get('user')
+
+        if user is None or not user.is_authenticated:
+            await self.close(code=CLOSE_NOT_AUTHENTICATED)
+            return
+
+        aceptado = await self.get_access(user)
+        if aceptado is None:
+            await self.close(code=CLOSE_FORBIDDEN)
+            return
+
+        self.user = user
+        self.aceptado = aceptado
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, code):
+        if hasattr(self, 'user'):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def receive_json(self, content, **kwargs):
+        if not self.aceptado:
+            await self.send_json({'type': 'error', 'detail': 'La conversación no ha sido aceptada por el receptor.'})
+            return
+        ciphertext = content.get('ciphertext') if isinstance(content, dict) else None
+        if not isinstance(ciphertext, str) or not ciphertext:
+            await self.send_json({'type': 'error', 'detail': 'El mensaje no contiene ciphertext.'})
+            return
+        if len(ciphertext) > settings.CHAT_MAX_FRAME_SIZE:
+            await self.close(code=CLOSE_FRAME_TOO_LARGE)
+            return
+        try:
+            contenido = base64.b64decode(ciphertext, validate=True)
+        except (ValueError, binascii.Error):
+            await self.send_json({'type': 'error', 'detail': 'El contenido debe estar codificado en base64.'})
+            return
+
+        mensaje = await self.store_message(contenido)
+        await self.send_json({'type': 'chat.stored', 'seq': mensaje.seq})
+        await self.channel_layer.group_send(self.group_name, {
+            'type': 'chat.message',
+            'seq': mensaje.seq,
+            'user_desde': self.user.pk,
+            'ciphertext': ciphertext,
+            'sender_channel': self.channel_name,
+        })
+
+    async def chat_message(self, event):
+        if event['sender_channel'] == self.channel_name:
+            return
+        await self.send_json({
+            'type': 'chat.message',
+            'seq': event['seq'],
+            'user_desde': event['user_desde'],
+            'ciphertext': event['ciphertext'],
+        })
+
+    async def chat_member_removed(self, event):
+        if event['user_id'] == self.user.pk:
+            await self.close(code=CLOSE_FORBIDDEN)
+            return
+        await self.send_json({
+            'type': 'chat.member_removed',
+            'user_id': event['user_id'],
+        })
+
+    async def chat_accepted(self, event):
+        self.aceptado = True
+        await self.send_json({
+            'type': 'chat.accepted',
+            'id_chat': event['id_chat'],
+        })
+
+    @database_sync_to_async
+    def get_access(self, user):
+        """
+        Whether ``user`` may send to the chat (True), may only wait for its acceptance
+        (False, the initiator of a pending chat) or may not connect at all (None).
+        """
+        chat = Chat.objects.filter(id=self.id_chat).only('id', 'tipo', 'aceptado', 'user_desde', 'user_hasta').first()
+        if chat is None:
+            return None
+        if chat.tipo == Chat.GRUPO:
+            return ChatMember.objects.filter(chat_id=chat.pk, user=user, aceptado=True).exists() or None
+        if chat.aceptado and user.pk in (chat.user_desde_id, chat.user_hasta_id):
+            return True
+        return False if chat.user_desde_id == user.pk else None
+
+    @database_sync_to_async
+    def store_message(self, contenido):
+        return Message.objects.create_next(self.id_chat, self.user, contenido)
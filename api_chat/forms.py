@@ -1,6 +1,7 @@
 from django import forms
 from django.contrib.auth.forms import ReadOnlyPasswordHashField
 from api_chat.models import User
+from api_chat.utils import normalize_phone, phone_validator
 
 
 class LoginForm(forms.Form):
@@ -21,7 +22,9 @@ class RegisterForm(forms.ModelForm):
         fields = ('phone',)
 
     def clean_phone(self):
-        phone = self.cleaned_data.get('phone')
+        phone = normalize_phone(self.cleaned_data.get('phone'))
+        if not phone_validator(phone):
+            raise forms.ValidationError("phone is not a valid number")
         qs = User.objects.filter(phone=phone)
         if qs.exists():
             raise forms.ValidationError("phone is taken")
@@ -1,9 +1,16 @@
-from knox.models import AuthToken
-from knox.settings import CONSTANTS
+from rest_framework.exceptions import AuthenticationFailed
+from api_chat.authentication import CachedTokenAuthentication
 
 
-def get_user_from_token(token):
-    objs = AuthToken.objects.filter(token_key=token[:CONSTANTS.TOKEN_KEY_LENGTH])
-    if len(objs) == 0:
+def authenticate_token(token):
+    """
+    Resolves a raw knox token to its user, checking digest and expiry the same
+    way the REST endpoints do. Returns None if the token is not valid.
+    """
+    if not token:
         return None
-    return objs.first().user
+    try:
+        user, auth_token = CachedTokenAuthentication().authenticate_credentials(token.encode())
+    except AuthenticationFailed:
+        return None
+    return user
@@ -0,0 +1,101 @@
+"""
+Password hashers with their cost read from settings, and the async password check
+used by the ASGI login.
+
+The hashers keep django's algorithm names, so hashes are interchangeable with the stock
+ones. Since the first entry of PASSWORD_HASHERS is the preferred one, a hash made with
+another algorithm or with other costs is rehashed on the next successful login.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import _clean_credentials, hashers, user_login_failed
+
+
+class ScryptPasswordHasher(hashers.ScryptPasswordHasher):
+    work_factor = property(lambda self: settings.PASSWORD_SCRYPT_WORK_FACTOR)
+    block_size = property(lambda self: settings.PASSWORD_SCRYPT_BLOCK_SIZE)
+    parallelism = property(lambda self: settings.PASSWORD_SCRYPT_PARALLELISM)
+
+    @property
+    def maxmem(self):
+        # scrypt needs 128 * n * r bytes; OpenSSL refuses more than 32 MiB unless told.
+        # Twice the configured cost, so hashes made before raising it still verify.
+        return max(64 * 1024 * 1024, 2 * 128 * self.work_factor * self.block_size * self.parallelism)
+
+
+class Argon2PasswordHasher(hashers.Argon2PasswordHasher):
+    time_cost = property(lambda self: settings.PASSWORD_ARGON2_TIME_COST)
+    memory_cost = property(lambda self: settings.PASSWORD_ARGON2_MEMORY_COST)
+    parallelism = property(lambda self: settings.PASSWORD_ARGON2_PARALLELISM)
+
+
+class PBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+    iterations = property(lambda self: settings.PASSWORD_PBKDF2_ITERATIONS)
+
+
+# hashlib's scrypt and pbkdf2 (and argon2-cffi) release the GIL, so these threads hash
+# in parallel on every core.
+password_executor = ThreadPoolExecutor(max_workers=settings.PASSWORD_HASHER_THREADS,
+                                       thread_name_prefix='password')
+
+
+def verify_password(password, encoded):
+    """
+    django's check_password without the setter: returns ``(is_correct, must_update)``,
+    where must_update tells that the hash should be remade with the preferred hasher.
+    """
+    if password is None or not hashers.is_password_usable(encoded):
+        return False, False
+    preferred = hashers.get_hasher('default')
+    try:
+        hasher = hashers.identify_hasher(encoded)
+    except ValueError:
+        return False, False
+    hasher_changed = hasher.algorithm != preferred.algorithm
+    must_update = hasher_changed or preferred.must_update(encoded)
+    is_correct = hasher.verify(password, encoded)
+    if not is_correct and not hasher_changed and must_update:
+        hasher.harden_runtime(password, encoded)
+    return is_correct, must_update
+
+
+async def run_hasher(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(password_executor, func, *args)
+
+
+async def login_failed(phone, password, request):
+    # Same signal and payload as a failed authenticate(), for auditing and lockout receivers.
+    await sync_to_async(user_login_failed.send)(
+        sender='django.contrib.auth', credentials=_clean_credentials({'phone': phone, 'password': password}),
+        request=request)
+
+
+async def aauthenticate(phone, password, request=None):
+    """
+    Async counterpart of ``authenticate(request, phone=..., password=...)`` with
+    ModelBackend: returns the active user with that phone and password, or None after
+    sending user_login_failed. The hashing runs in ``password_executor``; an outdated hash
+    is replaced with one made by the preferred hasher.
+    """
+    from api_chat.models import User
+
+    try:
+        user = await User.objects.aget(phone=phone)
+    except User.DoesNotExist:
+        # Hash anyway, so response times do not tell which phones are registered.
+        await run_hasher(hashers.make_password, password)
+        await login_failed(phone, password, request)
+        return None
+
+    is_correct, must_update = await run_hasher(verify_password, password, user.password)
+    if not is_correct or not user.is_active:
+        await login_failed(phone, password, request)
+        return None
+    if must_update:
+        user.password = await run_hasher(hashers.make_password, password)
+        # Same password, so not a save(): nothing listening for password changes must fire.
+        await User.objects.filter(pk=user.pk).aupdate(password=user.password)
+    return user
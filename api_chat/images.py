@@ -0,0 +1,109 @@
+"""
+Resized WebP variants of Profile.image, so clients download an avatar of the size they
+render instead of the original.
+
+The variants are made by the generate_profile_variants task whenever the image changes.
+Their keys depend only on the content of the original and the size
+(``<PROFILE_IMAGE_VARIANTS_LOCATION>/<digest>/<size>.webp``), so they never change once
+written and are served with a long-lived Cache-Control.
+"""
+import hashlib
+import io
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import get_storage_class
+
+# Variants never change, so caches (browsers, CDN) may keep them for a year.
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+_storage = None
+
+
+def get_variant_storage():
+    """
+    An instance of the default storage class that writes with CACHE_CONTROL on S3, where
+    overwriting a variant is also fine: same key, same bytes.
+    """
+    global _storage
+    if _storage is None:
+        from storages.backends.s3boto3 import S3Boto3Storage
+
+        storage_class = get_storage_class()
+        if issubclass(storage_class, S3Boto3Storage):
+            _storage = storage_class(file_overwrite=True, object_parameters={
+                **getattr(settings, 'AWS_S3_OBJECT_PARAMETERS', {}), 'CacheControl': CACHE_CONTROL})
+        else:
+            _storage = storage_class()
+    return _storage
+
+
+def variant_name(digest, size):
+    return '%s/%s/%d.webp' % (settings.PROFILE_IMAGE_VARIANTS_LOCATION, digest, size)
+
+
+def pick_size(size):
+    """The smallest variant of at least ``size`` pixels, or the largest one."""
+    sizes = sorted(settings.PROFILE_IMAGE_SIZES)
+    return next((candidate for candidate in sizes if candidate >= size), sizes[-1])
+
+
+def variant_url(profile, size):
+    """
+    Url of the variant of ``profile.image`` that best fits ``size`` pixels; the original
+    while its variants are not ready. None without an image.
+    """
+    if not profile.image:
+        return None
+    if profile.image_variants_of != profile.image.name or not profile.image_digest:
+        return profile.image.url
+    return get_variant_storage().url(variant_name(profile.image_digest, pick_size(size)))
+
+
+def make_variants(data):
+    """
+    ``{size: webp bytes}`` of the image in ``data``: a centered square crop, resized once
+    to the largest size and then down from it to the smaller ones.
+    """
+    from PIL import Image, ImageOps
+
+    image = Image.open(io.BytesIO(data))
+    sizes = sorted(settings.PROFILE_IMAGE_SIZES, reverse=True)
+    # JPEGs are decoded straight at a fraction of their size when that is enough.
+    image.draft('RGB', (sizes[0], sizes[0]))
+    image = ImageOps.exif_transpose(image)
+    image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+
+    variants = {}
+    for size in sizes:
+        image = ImageOps.fit(image, (size, size), Image.Resampling.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, 'WEBP', quality=settings.PROFILE_IMAGE_QUALITY, method=4)
+        variants[size] = output.getvalue()
+    return variants
+
+
+def generate_profile_variants(profile_id):
+    """
+    Writes the variants of the current image of the profile and records them on it,
+    unless the image changed meanwhile. Returns the digest, or None if there was nothing
+    to do.
+    """
+    from api_chat.models import Profile
+
+    profile = Profile.objects.filter(pk=profile_id).only('image', 'image_variants_of').first()
+    if profile is None or not profile.image or profile.image_variants_of == profile.image.name:
+        return None
+    name = profile.image.name
+    with profile.image.open('rb') as original:
+        data = original.read()
+    digest = hashlib.sha256(data).hexdigest()[:32]
+
+    storage = get_variant_storage()
+    for size, content in make_variants(data).items():
+        # The same image uploaded again already has its variants.
+        if not storage.exists(variant_name(digest, size)):
+            storage.save(variant_name(digest, size), ContentFile(content))
+    Profile.objects.filter(pk=profile_id, image=name).update(image_digest=digest, image_variants_of=name)
+    return digest
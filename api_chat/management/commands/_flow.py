@@ -0,0 +1,140 @@
+"""
+Drives the signup, login and chat handshake endpoints end to end with the django test
+client, measuring queries and latency of every request. Shared by the check_query_budgets,
+bench_flow and bench_asgi commands.
+"""
+import json
+import math
+import re
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+from django.test.runner import DiscoverRunner
+from django.test.utils import (CaptureQueriesContext, override_settings, setup_test_environment,
+                               teardown_test_environment)
+
+from ChatEncriptado.celery import app as celery_app
+
+# Endpoints in the order the flow calls them.
+STEPS = (
+    'validate_send_otp',
+    'validate_otp',
+    'register',
+    'login',
+    'created_chat',
+    'authorized_chat',
+    'validate_chat_aproved',
+)
+
+PASSWORD = 'Flujo-Prueba-2022'
+
+
+@contextmanager
+def flow_environment(keepdb=False):
+    """
+    Runs the block against a fresh test database, with SMS kept in memory, celery tasks
+    executed inline and OTP state in the ORM store so query counts are deterministic.
+    The test environment lets the test client's 'testserver' host in whatever
+    ALLOWED_HOSTS and DEBUG are.
+    """
+    setup_test_environment()
+    runner = DiscoverRunner(verbosity=0, interactive=False, keepdb=keepdb)
+    try:
+        old_config = runner.setup_databases()
+    except Exception:
+        teardown_test_environment()
+        raise
+    always_eager = celery_app.conf.task_always_eager
+    celery_app.conf.task_always_eager = True
+    try:
+        with override_settings(SMS_BACKEND='api_chat.sms.LocMemBackend',
+                               OTP_STORE='api_chat.otp_store.ORMOTPStore',
+                               REST_FRAMEWORK=_without_throttle_rates()):
+            yield
+    finally:
+        celery_app.conf.task_always_eager = always_eager
+        runner.teardown_databases(old_config)
+        teardown_test_environment()
+
+
+def _without_throttle_rates():
+    from django.conf import settings
+    rest_framework = dict(settings.REST_FRAMEWORK)
+    rest_framework['DEFAULT_THROTTLE_RATES'] = {}
+    return rest_framework
+
+
+# Transaction control is not counted: sqlite logs BEGIN and postgres does not.
+TRANSACTION_STATEMENTS = ('BEGIN', 'SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK')
+
+
+def count_queries(captured):
+    return sum(1 for query in captured if not query['sql'].startswith(TRANSACTION_STATEMENTS))
+
+
+def percentile(samples, point):
+    """``point``-th percentile (nearest rank) of the already sorted ``samples``."""
+    rank = math.ceil(point / 100 * len(samples))
+    return samples[min(max(rank, 1), len(samples)) - 1]
+
+
+class StepResult:
+    def __init__(self, name, response, queries, elapsed):
+        self.name = name
+        self.response = response
+        self.queries = queries
+        self.elapsed = elapsed
+
+
+class HandshakeFlow:
+    """
+    One run of the flow for a fresh pair of users. ``phone_desde`` signs up and opens a
+    chat with ``phone_hasta``, who must already exist (see ``create_receiver``).
+    """
+
+    def __init__(self, client, phone_desde, phone_hasta, token_hasta):
+        self.client = client
+        self.phone_desde = phone_desde
+        self.phone_hasta = phone_hasta
+        self.token_hasta = token_hasta
+        self.token_desde = None
+        self.id_chat = None
+
+    @staticmethod
+    def create_receiver(phone):
+        from knox.models import AuthToken
+        from api_chat.models import User
+
+        user = User.objects.create_user(phone, password=PASSWORD)
+        return AuthToken.objects.create(user)[1]
+
+    def call(self, name, method, data, token=None):
+        headers = {'HTTP_AUTHORIZATION': 'Token %s' % token} if token else {}
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            # validated_chat/ and validate_chat_aproved/ read a JSON body even on GET.
+            response = self.client.generic(method.upper(), '/api/%s/' % name, json.dumps(data),
+                                           content_type='application/json', **headers)
+            elapsed = time.perf_counter() - start
+        if response.status_code != 200 or response.json().get('status') is False:
+            raise AssertionError('%s failed: %s %s' % (name, response.status_code, response.content[:300]))
+        return StepResult(name, response, count_queries(queries), elapsed)
+
+    def run(self):
+        from api_chat import sms
+
+        results = [self.call('validate_send_otp', 'post', {'phone': self.phone_desde})]
+        otp = re.search(r'(\d+)\.$', sms.outbox.pop()['body']).group(1)
+        results.append(self.call('validate_otp', 'post', {'phone': self.phone_desde, 'otp': otp}))
+        results.append(self.call('register', 'post', {'phone': self.phone_desde, 'password': PASSWORD,
+                                                      'name': 'Flujo'}))
+        login = self.call('login', 'post', {'phone': self.phone_desde, 'password': PASSWORD})
+        self.token_desde = login.response.json()['token']
+        results.append(login)
+        chat = self.call('created_chat', 'post', {'phone_hasta': self.phone_hasta}, self.token_desde)
+        self.id_chat = int(chat.response.json()['id_conversacion'])
+        results.append(chat)
+        results.append(self.call('authorized_chat', 'post', {'id_chat': self.id_chat}, self.token_hasta))
+        results.append(self.call('validate_chat_aproved', 'get', {'id_chat': self.id_chat}, self.token_desde))
+        return results
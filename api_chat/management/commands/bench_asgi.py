@@ -0,0 +1,163 @@
+import asyncio
+import json
+import queue
+import threading
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings
+from django.urls import re_path
+
+from api_chat.management.commands._flow import flow_environment, percentile
+from api_chat.views import (CreateChat, ValidateChat, AuthorizedChat, ValidateChatAproved,
+                            CreateChatAsync, ValidateChatAsync, AuthorizedChatAsync, ValidateChatAprovedAsync)
+
+# Both implementations of the handshake, mounted side by side for the benchmark.
+urlpatterns = [
+    re_path('^wsgi/created_chat/', CreateChat.as_view()),
+    re_path('^wsgi/validated_chat/', ValidateChat.as_view()),
+    re_path('^wsgi/authorized_chat/', AuthorizedChat.as_view()),
+    re_path('^wsgi/validate_chat_aproved/', ValidateChatAproved.as_view()),
+    re_path('^asgi/created_chat/', CreateChatAsync.as_view()),
+    re_path('^asgi/validated_chat/', ValidateChatAsync.as_view()),
+    re_path('^asgi/authorized_chat/', AuthorizedChatAsync.as_view()),
+    re_path('^asgi/validate_chat_aproved/', ValidateChatAprovedAsync.as_view()),
+]
+
+
+def handshake(pair):
+    """
+    The requests of one chat handshake between ``pair`` = (phone_hasta, token_desde,
+    token_hasta), as a generator of (method, endpoint, data, token) that is sent the
+    response of every request.
+    """
+    phone_hasta, token_desde, token_hasta = pair
+    response = yield 'POST', 'created_chat', {'phone_hasta': phone_hasta}, token_desde
+    id_chat = int(response.json()['id_conversacion'])
+    yield 'GET', 'validated_chat', {'id_chat': id_chat}, token_hasta
+    yield 'POST', 'authorized_chat', {'id_chat': id_chat}, token_hasta
+    yield 'GET', 'validate_chat_aproved', {'id_chat': id_chat}, token_desde
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the chat handshake endpoints (created_chat, validated_chat, authorized_chat, '
+            'validate_chat_aproved) under concurrency: the sync views through the WSGI handler '
+            'with one thread per worker, and the async views through the ASGI handler with one '
+            'coroutine per client, on a test database. Use postgres (DATABASE_URL) for meaningful '
+            'numbers: sqlite serializes every write.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--handshakes', type=int, default=200, help='Handshakes per mode, 4 requests each.')
+        parser.add_argument('--concurrency', type=int, default=20,
+                            help='WSGI worker threads / concurrent ASGI clients.')
+        parser.add_argument('--mode', choices=('wsgi', 'asgi', 'both'), default='both')
+
+    def handle(self, *args, **options):
+        modes = ('wsgi', 'asgi') if options['mode'] == 'both' else (options['mode'],)
+        with flow_environment(), override_settings(ROOT_URLCONF=__name__):
+            for mode in modes:
+                pairs = self.create_pairs(mode, options['handshakes'])
+                start = time.perf_counter()
+                if mode == 'wsgi':
+                    latencies, errors = self.run_wsgi(pairs, options['concurrency'])
+                else:
+                    latencies, errors = asyncio.run(self.run_asgi(pairs, options['concurrency']))
+                self.report(mode, latencies, errors, time.perf_counter() - start)
+
+    @staticmethod
+    def create_pairs(mode, count):
+        from knox.models import AuthToken
+        from api_chat.models import User
+
+        # Only token authentication is used, so users get no usable password: setup would
+        # otherwise spend most of its time hashing.
+        prefix = '+5190%d' % ('wsgi', 'asgi').index(mode)
+        users = User.objects.bulk_create(
+            User(phone='%s%d%05d' % (prefix, lado, i), password=make_password(None))
+            for i in range(count) for lado in (1, 2))
+        pairs = []
+        for desde, hasta in zip(users[::2], users[1::2]):
+            pairs.append((hasta.phone, AuthToken.objects.create(desde)[1], AuthToken.objects.create(hasta)[1]))
+        return pairs
+
+    @staticmethod
+    def request_args(mode, endpoint, data, token):
+        return ('/%s/%s/' % (mode, endpoint), json.dumps(data)), {
+            'content_type': 'application/json', 'HTTP_AUTHORIZATION': 'Token %s' % token}
+
+    def run_wsgi(self, pairs, concurrency):
+        pending = queue.SimpleQueue()
+        for pair in pairs:
+            pending.put(pair)
+        latencies, errors = [], []
+
+        def worker():
+            client = Client(raise_request_exception=False)
+            try:
+                while True:
+                    try:
+                        steps = handshake(pending.get_nowait())
+                    except queue.Empty:
+                        return
+                    response = None
+                    try:
+                        while True:
+                            method, endpoint, data, token = steps.send(response)
+                            args, kwargs = self.request_args('wsgi', endpoint, data, token)
+                            start = time.perf_counter()
+                            response = client.generic(method, *args, **kwargs)
+                            latencies.append(time.perf_counter() - start)
+                            if response.status_code != 200:
+                                errors.append(response.status_code)
+                                break
+                    except StopIteration:
+                        pass
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return latencies, errors
+
+    async def run_asgi(self, pairs, concurrency):
+        pending = asyncio.Queue()
+        for pair in pairs:
+            pending.put_nowait(pair)
+        latencies, errors = [], []
+
+        async def worker():
+            client = AsyncClient(raise_request_exception=False)
+            while not pending.empty():
+                steps = handshake(pending.get_nowait())
+                response = None
+                try:
+                    while True:
+                        method, endpoint, data, token = steps.send(response)
+                        args, kwargs = self.request_args('asgi', endpoint, data, token)
+                        kwargs['authorization'] = kwargs.pop('HTTP_AUTHORIZATION')
+                        start = time.perf_counter()
+                        response = await client.generic(method, *args, **kwargs)
+                        latencies.append(time.perf_counter() - start)
+                        if response.status_code != 200:
+                            errors.append(response.status_code)
+                            break
+                except StopIteration:
+                    pass
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return latencies, errors
+
+    def report(self, mode, latencies, errors, elapsed):
+        if not latencies:
+            raise CommandError('No requests were made.')
+        latencies.sort()
+        self.stdout.write('%-5s %6d reqs  %7.2f s  %8.1f req/s  p50 %6.1f ms  p95 %6.1f ms  p99 %6.1f ms  %d errors' % (
+            mode, len(latencies), elapsed, len(latencies) / elapsed,
+            percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000, percentile(latencies, 99) * 1000,
+            len(errors)))
@@ -0,0 +1,104 @@
+import json
+import platform
+import statistics
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.utils import timezone
+
+from api_chat.management.commands._flow import STEPS, HandshakeFlow, flow_environment, percentile
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the signup, login and chat handshake flow end to end against a test database '
+            '(sqlite or postgres, SMS kept in memory): p50/p95/p99 latency, requests per second and '
+            'queries per request of every endpoint. --save writes the results as a baseline and '
+            '--compare checks them against one.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50, help='Measured runs of the flow.')
+        parser.add_argument('--warmup', type=int, default=3, help='Runs before measuring, not reported.')
+        parser.add_argument('--save', metavar='PATH', help='Write the results to PATH as a baseline.')
+        parser.add_argument('--compare', metavar='PATH', help='Compare the results with the baseline in PATH.')
+        parser.add_argument('--threshold', type=float, default=20,
+                            help='p50 slowdown, in percent, reported as a regression by --compare.')
+
+    def handle(self, *args, **options):
+        if options['iterations'] < 1:
+            raise CommandError('--iterations must be at least 1.')
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+
+        samples = {name: [] for name in STEPS}
+        with flow_environment():
+            vendor = connection.vendor
+            client = Client()
+            for i in range(options['warmup'] + options['iterations']):
+                # Every run is a new user: a session left by the previous login would be rotated.
+                client.cookies.clear()
+                phone_hasta = '+5192%07d' % i
+                flow = HandshakeFlow(client, '+5191%07d' % i, phone_hasta, HandshakeFlow.create_receiver(phone_hasta))
+                results = flow.run()
+                if i >= options['warmup']:
+                    for result in results:
+                        samples[result.name].append(result)
+
+        report = {
+            'created': timezone.now().isoformat(),
+            'database': vendor,
+            'django': django.get_version(),
+            'python': platform.python_version(),
+            'iterations': options['iterations'],
+            'steps': {name: self.summarize(results) for name, results in samples.items()},
+        }
+        self.write_report(report, baseline)
+
+        if options['save']:
+            with open(options['save'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write('Baseline saved to %s' % options['save'])
+        if baseline is not None:
+            regressions = self.regressions(report, baseline, options['threshold'])
+            if regressions:
+                raise CommandError('Regressions against %s: %s' % (options['compare'], ', '.join(regressions)))
+
+    @staticmethod
+    def summarize(results):
+        latencies = sorted(result.elapsed for result in results)
+        return {
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            # One client, so throughput is the inverse of the mean latency.
+            'rps': len(latencies) / sum(latencies),
+            'queries': statistics.mean(result.queries for result in results),
+        }
+
+    def write_report(self, report, baseline):
+        self.stdout.write('%s, %d iterations' % (report['database'], report['iterations']))
+        self.stdout.write('%-24s %9s %9s %9s %9s %8s' % ('endpoint', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'queries'))
+        for name, step in report['steps'].items():
+            line = '%-24s %9.2f %9.2f %9.2f %9.1f %8.1f' % (
+                name, step['p50_ms'], step['p95_ms'], step['p99_ms'], step['rps'], step['queries'])
+            base = baseline['steps'].get(name) if baseline else None
+            if base:
+                line += '   p50 %+6.1f%%  queries %+.1f' % (
+                    (step['p50_ms'] / base['p50_ms'] - 1) * 100, step['queries'] - base['queries'])
+            self.stdout.write(line)
+
+    @staticmethod
+    def regressions(report, baseline, threshold):
+        regressions = []
+        for name, step in report['steps'].items():
+            base = baseline['steps'].get(name)
+            if base is None:
+                continue
+            if step['p50_ms'] > base['p50_ms'] * (1 + threshold / 100):
+                regressions.append('%s p50 %.2f ms > %.2f ms' % (name, step['p50_ms'], base['p50_ms']))
+            if step['queries'] > base['queries']:
+                regressions.append('%s %.1f queries > %.1f' % (name, step['queries'], base['queries']))
+        return regressions
@@ -0,0 +1,38 @@
+import random
+import string
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from api_chat.utils import otp_generator, random_string_generator, unique_key_generator
+
+
+def previous_otp_generator():
+    return str(random.randint(999, 9999))
+
+
+def previous_key_generator():
+    return ''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(random.randint(30, 45)))
+
+
+class Command(BaseCommand):
+    help = ('Micro-benchmark of the OTP and key generators of api_chat.utils, next to the '
+            'random-module versions they replaced: values generated per second.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=100000, help='Values generated per measure.')
+        parser.add_argument('--repeat', type=int, default=5, help='Measures per generator; the best is kept.')
+
+    def handle(self, *args, **options):
+        generators = (
+            ('otp (random, previous)', previous_otp_generator),
+            ('otp_generator()', otp_generator),
+            ('key (random, previous)', previous_key_generator),
+            ('unique_key_generator()', unique_key_generator),
+            ('random_string_generator(10)', lambda: random_string_generator(10)),
+        )
+        self.stdout.write('%-30s %14s %10s' % ('generator', 'values/s', 'us/value'))
+        for name, generator in generators:
+            best = min(timeit.repeat(generator, number=options['number'], repeat=options['repeat']))
+            self.stdout.write('%-30s %14.0f %10.3f' % (
+                name, options['number'] / best, best / options['number'] * 1e6))
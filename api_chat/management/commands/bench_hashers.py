@@ -0,0 +1,68 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from api_chat.hashers import verify_password
+
+HASHERS = {
+    'pbkdf2': 'api_chat.hashers.PBKDF2PasswordHasher',
+    'scrypt': 'api_chat.hashers.ScryptPasswordHasher',
+    'argon2': 'api_chat.hashers.Argon2PasswordHasher',
+}
+
+PASSWORD = 'Banco-Prueba-2022'
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the password check of every hasher with the costs in settings: logins per '
+            'second on one core, and with PASSWORD_HASHER_THREADS threads as the async login runs '
+            'them. Use it to pick costs that keep a login around the wanted latency.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checks', type=int, default=20, help='Password checks per hasher and mode.')
+        parser.add_argument('--threads', type=int, default=settings.PASSWORD_HASHER_THREADS,
+                            help='Threads of the parallel run.')
+        parser.add_argument('--hasher', action='append', choices=sorted(HASHERS),
+                            help='Hasher to benchmark, may be repeated. Defaults to all of them.')
+
+    def handle(self, *args, **options):
+        if options['checks'] < 1 or options['threads'] < 1:
+            raise CommandError('--checks and --threads must be at least 1.')
+        self.stdout.write('%-8s %-28s %10s %12s %16s' % (
+            'hasher', 'cost', 'ms/check', 'logins/s 1', 'logins/s %d thr' % options['threads']))
+        for name in options['hasher'] or HASHERS:
+            with override_settings(PASSWORD_HASHERS=[HASHERS[name]]):
+                from django.contrib.auth.hashers import get_hasher, make_password
+                hasher = get_hasher('default')
+                try:
+                    encoded = make_password(PASSWORD)
+                except ValueError as e:
+                    # argon2 without argon2-cffi installed.
+                    self.stdout.write('%-8s skipped: %s' % (name, e))
+                    continue
+                single = self.run(encoded, options['checks'], 1)
+                parallel = self.run(encoded, options['checks'] * options['threads'], options['threads'])
+            self.stdout.write('%-8s %-28s %10.1f %12.1f %16.1f' % (
+                name, self.cost(hasher), 1000 / single, single, parallel))
+
+    @staticmethod
+    def run(encoded, checks, threads):
+        """Password checks per second of ``checks`` checks over ``threads`` threads."""
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            start = time.perf_counter()
+            results = list(executor.map(verify_password, [PASSWORD] * checks, [encoded] * checks))
+            elapsed = time.perf_counter() - start
+        if not all(is_correct for is_correct, _ in results):
+            raise CommandError('A password check failed.')
+        return checks / elapsed
+
+    @staticmethod
+    def cost(hasher):
+        if hasher.algorithm == 'scrypt':
+            return 'n=%d r=%d p=%d' % (hasher.work_factor, hasher.block_size, hasher.parallelism)
+        if hasher.algorithm == 'argon2':
+            return 't=%d m=%dKiB p=%d' % (hasher.time_cost, hasher.memory_cost, hasher.parallelism)
+        return 'iterations=%d' % hasher.iterations
@@ -0,0 +1,78 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from api_chat.sms import TwilioBackend
+
+FAKE_ACCOUNT_SID = 'AC' + '0' * 32
+
+
+class FakeTwilioHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Buffered so headers and body leave in one segment; unbuffered writes hit delayed ACKs.
+    wbufsize = 64 * 1024
+    latency = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.latency:
+            time.sleep(self.latency)
+        payload = json.dumps({'sid': 'SM' + '0' * 32, 'account_sid': FAKE_ACCOUNT_SID, 'status': 'queued'}).encode()
+        self.send_response(201)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks SMS dispatch against a local fake Twilio server: a new client per '
+            'message (previous behaviour), the pooled TwilioBackend, and batched dispatch.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=200)
+        parser.add_argument('--latency', type=float, default=20, help='Fake gateway latency in ms.')
+        parser.add_argument('--in-flight', type=int, default=10, help='SMS_MAX_IN_FLIGHT for the batch run.')
+
+    def handle(self, *args, **options):
+        FakeTwilioHandler.latency = options['latency'] / 1000
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FakeTwilioHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = 'http://127.0.0.1:%s' % server.server_port
+
+        messages = [('+51900000%03d' % (i % 1000), 'Bench %s' % i) for i in range(options['messages'])]
+        try:
+            with override_settings(ACCOUNT_SID=FAKE_ACCOUNT_SID, AUTH_TOKEN='bench', PHONE_NUMBER='+15005550006',
+                                   TWILIO_API_BASE_URL=base_url, SMS_MAX_IN_FLIGHT=options['in_flight']):
+                self.report('client per message', messages, lambda: self.send_fresh(messages, base_url))
+                TwilioBackend.reset_client()
+                backend = TwilioBackend()
+                self.report('pooled client', messages, lambda: [backend.send_message(*m) for m in messages])
+                self.report('pooled batch', messages, lambda: backend.send_messages(messages))
+        finally:
+            TwilioBackend.reset_client()
+            server.shutdown()
+
+    @staticmethod
+    def send_fresh(messages, base_url):
+        from twilio.rest import Client
+
+        for to, body in messages:
+            client = Client(FAKE_ACCOUNT_SID, 'bench')
+            client.api.base_url = base_url
+            client.messages.create(body=body, from_='+15005550006', to=to)
+
+    def report(self, name, messages, run):
+        start = time.perf_counter()
+        results = run()
+        elapsed = time.perf_counter() - start
+        errors = sum(isinstance(result, Exception) for result in results or [])
+        self.stdout.write('%-20s %6d msgs  %8.3f s  %9.1f msgs/s  %d errors' % (
+            name, len(messages), elapsed, len(messages) / elapsed, errors))
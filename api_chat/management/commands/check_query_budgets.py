@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+
+from api_chat.management.commands._flow import STEPS, HandshakeFlow, flow_environment
+
+# Maximum queries per request (transaction control excluded) for one run of the flow.
+# Raise a budget only together with the change that needs it.
+QUERY_BUDGETS = {
+    'validate_send_otp': 4,
+    'validate_otp': 2,
+    'register': 6,
+    'login': 7,
+    'created_chat': 2,
+    'authorized_chat': 3,
+    'validate_chat_aproved': 1,
+}
+
+
+class Command(BaseCommand):
+    help = ('Runs the signup, login and chat handshake flow against a test database and fails '
+            'if any endpoint runs more queries than its budget in QUERY_BUDGETS.')
+
+    def handle(self, *args, **options):
+        with flow_environment():
+            receiver_token = HandshakeFlow.create_receiver('+51900000002')
+            results = HandshakeFlow(Client(), '+51900000001', '+51900000002', receiver_token).run()
+
+        over_budget = []
+        for result in results:
+            budget = QUERY_BUDGETS[result.name]
+            ok = result.queries <= budget
+            if not ok:
+                over_budget.append(result.name)
+            self.stdout.write('%-24s %3d / %-3d %s' % (
+                result.name, result.queries, budget,
+                self.style.SUCCESS('ok') if ok else self.style.ERROR('OVER BUDGET')))
+
+        missing = set(STEPS) - set(QUERY_BUDGETS)
+        if missing:
+            raise CommandError('Missing query budget for: %s' % ', '.join(sorted(missing)))
+        if over_budget:
+            raise CommandError('Query budget exceeded by: %s' % ', '.join(over_budget))
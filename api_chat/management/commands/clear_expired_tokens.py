@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api_chat.authentication import delete_expired_tokens
+
+
+class Command(BaseCommand):
+    help = ('Deletes the expired knox tokens in batches. The same sweep runs periodically '
+            'as the api_chat.tasks.clear_expired_tokens celery beat task.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.TOKEN_SWEEP_BATCH_SIZE,
+                            help='Tokens deleted per query.')
+        parser.add_argument('--max-batches', type=int, default=0,
+                            help='Stop after this many batches; 0 deletes every expired token.')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1.')
+        deleted = delete_expired_tokens(options['batch_size'], options['max_batches'] or None)
+        self.stdout.write('Deleted %d expired tokens.' % deleted)
@@ -0,0 +1,91 @@
+"""
+In-process metrics registry rendered in the Prometheus text exposition format.
+
+Metrics are only recorded when settings.METRICS_ENABLED is on; otherwise ``observe``
+returns right away and MetricsMiddleware is not even loaded. Every process keeps its
+own registry: scrape each web process, and note that SMS sent by a celery worker are
+recorded in the worker, not in the web process (unless tasks run eagerly).
+"""
+import threading
+from bisect import bisect_left
+
+from django.conf import settings
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        if not settings.METRICS_ENABLED:
+            return
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # Per bucket counts (the last one is +Inf), then the sum of the observed values.
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for labels, values in sorted(series.items()):
+            pairs = ['%s="%s"' % (name, escape(value)) for name, value in zip(self.labelnames, labels)]
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                lines.append('%s_bucket{%s} %d' % (self.name, ','.join(pairs + ['le="%s"' % bound]), cumulative))
+            selector = '{%s}' % ','.join(pairs) if pairs else ''
+            lines.append('%s_sum%s %r' % (self.name, selector, float(values[-1])))
+            lines.append('%s_count%s %d' % (self.name, selector, cumulative))
+        return '\n'.join(lines)
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, *args, **kwargs):
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
+
+
+registry = Registry()
+
+request_duration = registry.histogram(
+    'http_request_duration_seconds', 'Time to serve a request, by url name.', ('view', 'method', 'status'))
+request_db_queries = registry.histogram(
+    'http_request_db_queries', 'Database queries run by a request, by url name.', ('view',), COUNT_BUCKETS)
+request_db_duration = registry.histogram(
+    'http_request_db_duration_seconds', 'Time a request spent in database queries, by url name.', ('view',))
+sms_duration = registry.histogram(
+    'sms_send_duration_seconds', 'Time the SMS gateway took to accept a message.', ('outcome',))
+auth_duration = registry.histogram(
+    'knox_auth_duration_seconds', 'Time to authenticate a knox token, by token cache result.', ('cache',))
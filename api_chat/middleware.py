@@ -0,0 +1,115 @@
+import asyncio
+import time
+from contextlib import ExitStack
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from api_chat import metrics
+from api_chat.get_token import authenticate_token
+
+
+class TokenAuthMiddleware:
+    """
+    Authenticates WebSocket connections with the same knox token used by the REST api.
+
+    Browsers can not set headers on a WebSocket handshake, so the token is read from
+    the ``token`` query string parameter, falling back to an ``Authorization: Token``
+    header for native clients.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        scope['user'] = await self.get_user(self.get_token(scope))
+        return await self.inner(scope, receive, send)
+
+    @staticmethod
+    def get_token(scope):
+        query = parse_qs(scope.get('query_string', b'').decode())
+        if query.get('token'):
+            return query['token'][0]
+        for name, value in scope.get('headers', []):
+            if name == b'authorization':
+                return value.decode().rsplit(' ', 1)[-1]
+        return None
+
+    @database_sync_to_async
+    def get_user(self, token):
+        return authenticate_token(token) or AnonymousUser()
+
+
+class QueryTimer:
+    """
+    Database execute wrapper counting the queries of a request and the time spent in them.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - start
+
+
+class MetricsMiddleware:
+    """
+    Records latency, database queries and database time of every request in
+    ``api_chat.metrics``, labelled with the url name of the view. When
+    settings.METRICS_ENABLED is off at startup django drops the middleware.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Same marker django's MiddlewareMixin uses to be seen as async.
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        timer = QueryTimer()
+        start = time.perf_counter()
+        with self.timing_queries(timer):
+            response = self.get_response(request)
+        self.record(request, response, timer, time.perf_counter() - start)
+        return response
+
+    async def __acall__(self, request):
+        timer = QueryTimer()
+        start = time.perf_counter()
+        with self.timing_queries(timer):
+            response = await self.get_response(request)
+        self.record(request, response, timer, time.perf_counter() - start)
+        return response
+
+    @staticmethod
+    def timing_queries(timer):
+        # Installing the wrapper does not touch the database, so it is safe in async code.
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(timer))
+        return stack
+
+    @staticmethod
+    def record(request, response, timer, duration):
+        match = request.resolver_match
+        view = (match.url_name or match.view_name) if match else 'unmatched'
+        metrics.request_duration.observe(duration, view, request.method, response.status_code)
+        metrics.request_db_queries.observe(timer.count, view)
+        metrics.request_db_duration.observe(timer.duration, view)
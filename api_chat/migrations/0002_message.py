@@ -0,0 +1,39 @@
+# Generated by Django 4.1.3 on 2026-10-18 14:38
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api_chat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='ultimo_seq',
+            field=models.PositiveBigIntegerField(default=0, help_text='seq of the last message stored in this chat'),
+        ),
+        migrations.CreateModel(
+            name='Message',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('seq', models.PositiveBigIntegerField()),
+                ('contenido', models.BinaryField(help_text='Opaque ciphertext, never decrypted by the server')),
+                ('fecha_hora_creacion', models.DateTimeField(auto_now_add=True)),
+                ('chat', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='mensajes', to='api_chat.chat')),
+                ('user_desde', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='mensajes_enviados', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'mensaje',
+                'verbose_name_plural': 'mensajes',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('chat', 'seq'), name='api_chat_message_chat_seq_uniq'),
+        ),
+    ]
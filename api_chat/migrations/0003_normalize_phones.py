@@ -0,0 +1,66 @@
+import logging
+import re
+
+from django.db import migrations
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+# api_chat.utils.normalize_phone as of this migration, with the PHONE_DEFAULT_COUNTRY_CODE
+# the existing rows were entered with, so later changes to either do not alter it.
+DEFAULT_COUNTRY_CODE = '51'
+PHONE_SEPARATORS = re.compile(r'[\s\-().]')
+PHONE_DIGITS = re.compile(r'^\+?\d+$')
+
+
+def normalize_phone(phone_number):
+    if not phone_number:
+        return phone_number
+    phone = PHONE_SEPARATORS.sub('', str(phone_number))
+    if not PHONE_DIGITS.match(phone):
+        return phone
+    if phone.startswith('00'):
+        phone = '+' + phone[2:]
+    if phone.startswith('+'):
+        return phone
+    if len(phone) <= 10:
+        return '+' + DEFAULT_COUNTRY_CODE + phone.lstrip('0')
+    return '+' + phone
+
+
+def normalize_phones(apps, schema_editor):
+    """
+    Rewrites stored phones in E.164, the form every lookup now uses. A row whose
+    normalized phone is already taken by another row is left as is and reported.
+    """
+    for model_name in ('User', 'PhoneOTP'):
+        model = apps.get_model('api_chat', model_name)
+        taken = set(model.objects.values_list('phone', flat=True))
+        pending = []
+        for obj in model.objects.only('id', 'phone').iterator(chunk_size=BATCH_SIZE):
+            phone = normalize_phone(obj.phone)
+            if phone == obj.phone:
+                continue
+            if phone in taken:
+                logger.warning('%s %s: %s already exists, not normalized', model_name, obj.pk, phone)
+                continue
+            taken.add(phone)
+            obj.phone = phone
+            pending.append(obj)
+            if len(pending) >= BATCH_SIZE:
+                model.objects.bulk_update(pending, ['phone'])
+                pending = []
+        if pending:
+            model.objects.bulk_update(pending, ['phone'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api_chat', '0002_message'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_phones, migrations.RunPython.noop),
+    ]
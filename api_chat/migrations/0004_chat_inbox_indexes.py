@@ -0,0 +1,41 @@
+# Generated by Django 4.1.3 on 2026-10-18 14:47
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api_chat', '0003_normalize_phones'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chat',
+            name='user_desde',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='user_desde', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='chat',
+            name='user_hasta',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='user_hasta', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['user_hasta', '-fecha_hora_creacion', '-id'], name='api_chat_chat_hasta_inbox_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['user_desde', '-fecha_hora_creacion', '-id'], name='api_chat_chat_desde_inbox_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(condition=models.Q(('aceptado', False)), fields=['user_hasta', '-fecha_hora_creacion', '-id'], name='api_chat_chat_hasta_pend_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(condition=models.Q(('aceptado', False)), fields=['user_desde', '-fecha_hora_creacion', '-id'], name='api_chat_chat_desde_pend_idx'),
+        ),
+    ]
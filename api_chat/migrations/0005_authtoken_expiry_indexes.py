@@ -0,0 +1,40 @@
+# Generated by Django 4.1.3 on 2026-10-18 16:02
+
+from django.db import migrations
+
+# knox's AuthToken is not our model, so its indexes are created with plain SQL: one on
+# (user, expiry) for the live token count of the token limit at login, and one on
+# expiry for the expired token sweep (api_chat.authentication.delete_expired_tokens).
+INDEXES = (
+    ('api_chat_authtoken_user_exp_idx', ('user_id', 'expiry')),
+    ('api_chat_authtoken_expiry_idx', ('expiry',)),
+)
+
+
+def create_indexes(apps, schema_editor):
+    quote = schema_editor.quote_name
+    table = apps.get_model('knox', 'AuthToken')._meta.db_table
+    # The token table can be large: on postgres build the indexes without locking writes.
+    concurrently = 'CONCURRENTLY ' if schema_editor.connection.vendor == 'postgresql' else ''
+    for name, columns in INDEXES:
+        schema_editor.execute('CREATE INDEX %sIF NOT EXISTS %s ON %s (%s)' % (
+            concurrently, quote(name), quote(table), ', '.join(quote(column) for column in columns)))
+
+
+def drop_indexes(apps, schema_editor):
+    for name, _ in INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS %s' % schema_editor.quote_name(name))
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY can not run inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('api_chat', '0004_chat_inbox_indexes'),
+        ('knox', '0008_remove_authtoken_salt'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 4.1.3 on 2026-10-18 15:08
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
+
+
+def hash_otp(phone, otp):
+    # api_chat.otp_store.hash_otp as of this migration. The key stays the configured one:
+    # the digests must match the ones the running code computes.
+    return salted_hmac('api_chat.otp', '%s:%s' % (phone, otp),
+                       secret=settings.OTP_HMAC_KEY or None, algorithm='sha256').hexdigest()
+
+
+def hash_pending_otps(apps, schema_editor):
+    """Replaces the plaintext codes still pending with their HMAC, valid for a new OTP_CODE_TTL."""
+    PhoneOTP = apps.get_model('api_chat', 'PhoneOTP')
+    expires_at = timezone.now() + timedelta(seconds=settings.OTP_CODE_TTL)
+    pending = []
+    for obj in PhoneOTP.objects.exclude(otp=None).only('id', 'phone', 'otp').iterator():
+        obj.otp = hash_otp(obj.phone, obj.otp)
+        obj.otp_expires_at = expires_at
+        pending.append(obj)
+    PhoneOTP.objects.bulk_update(pending, ['otp', 'otp_expires_at'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api_chat', '0005_authtoken_expiry_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='phoneotp',
+            name='otp_attempts',
+            field=models.IntegerField(default=0, help_text='Verifications of the last otp sent'),
+        ),
+        migrations.AddField(
+            model_name='phoneotp',
+            name='otp_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='phoneotp',
+            name='otp',
+            field=models.CharField(blank=True, help_text='HMAC of the last otp sent', max_length=64, null=True),
+        ),
+        # Codes can not be recovered from their HMAC, so there is no way back.
+        migrations.RunPython(hash_pending_otps),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.1.3 on 2026-10-18 15:09
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api_chat', '0006_phoneotp_hashed_otp'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='nombre',
+            field=models.CharField(blank=True, default='', help_text='Name of a group', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='tipo',
+            field=models.CharField(choices=[('directo', 'Directo'), ('grupo', 'Grupo')], default='directo', max_length=10),
+        ),
+        migrations.CreateModel(
+            name='ChatMember',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('rol', models.CharField(choices=[('admin', 'Administrador'), ('miembro', 'Miembro')], default='miembro', max_length=10)),
+                ('aceptado', models.BooleanField(default=False, help_text='If the user accepted the invitation')),
+                ('fecha_hora_union', models.DateTimeField(auto_now_add=True)),
+                ('chat', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='miembros', to='api_chat.chat')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='grupos', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'miembro',
+                'verbose_name_plural': 'miembros',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='chatmember',
+            index=models.Index(fields=['user', '-chat'], name='api_chat_member_user_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='chatmember',
+            constraint=models.UniqueConstraint(fields=('chat', 'user'), name='api_chat_chatmember_chat_user_uniq'),
+        ),
+    ]
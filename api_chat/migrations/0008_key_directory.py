@@ -0,0 +1,47 @@
+# Generated by Django 4.1.3 on 2026-10-18 15:11
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api_chat', '0007_chat_groups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KeyBundle',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='claves', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('identity_key', models.BinaryField()),
+                ('signed_prekey_id', models.PositiveIntegerField()),
+                ('signed_prekey', models.BinaryField()),
+                ('signed_prekey_signature', models.BinaryField()),
+                ('fecha_hora_actualizacion', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'claves',
+                'verbose_name_plural': 'claves',
+            },
+        ),
+        migrations.CreateModel(
+            name='OneTimePreKey',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('key_id', models.PositiveIntegerField()),
+                ('public_key', models.BinaryField()),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='prekeys', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'prekey',
+                'verbose_name_plural': 'prekeys',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='onetimeprekey',
+            constraint=models.UniqueConstraint(fields=('user', 'key_id'), name='api_chat_prekey_user_key_uniq'),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 4.1.3 on 2026-10-18 15:13
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api_chat', '0008_key_directory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Device',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('identificador', models.CharField(max_length=64)),
+                ('nombre', models.CharField(blank=True, default='', max_length=100)),
+                ('fecha_hora_registro', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='dispositivos', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'dispositivo',
+                'verbose_name_plural': 'dispositivos',
+            },
+        ),
+        migrations.CreateModel(
+            name='Envelope',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('contenido', models.BinaryField(help_text='Opaque ciphertext, never decrypted by the server')),
+                ('fecha_hora_creacion', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('chat', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='api_chat.chat')),
+                ('device', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='sobres', to='api_chat.device')),
+                ('user_desde', models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'sobre',
+                'verbose_name_plural': 'sobres',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='envelope',
+            index=models.Index(fields=['device', 'id'], name='api_chat_envelope_device_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='device',
+            constraint=models.UniqueConstraint(fields=('user', 'identificador'), name='api_chat_device_user_ident_uniq'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.1.3 on 2026-10-18 15:17
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api_chat', '0009_device_mailbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Attachment',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('key', models.CharField(max_length=255, unique=True)),
+                ('upload_id', models.TextField(blank=True, default='', help_text='Multipart upload in progress, while pending')),
+                ('tamano', models.BigIntegerField(help_text='Size of the encrypted file, in bytes')),
+                ('tamano_parte', models.IntegerField()),
+                ('estado', models.CharField(choices=[('P', 'Pendiente'), ('C', 'Completo')], default='P', max_length=1)),
+                ('fecha_hora_creacion', models.DateTimeField(auto_now_add=True)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='adjuntos', to='api_chat.chat')),
+                ('user', models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'adjunto',
+                'verbose_name_plural': 'adjuntos',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='attachment',
+            index=models.Index(fields=['estado', 'fecha_hora_creacion'], name='api_chat_attachment_state_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.3 on 2026-10-18 15:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api_chat', '0010_attachments'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='image_digest',
+            field=models.CharField(blank=True, default='', editable=False, max_length=32),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='image_variants_of',
+            field=models.CharField(blank=True, default='', editable=False, max_length=100),
+        ),
+    ]
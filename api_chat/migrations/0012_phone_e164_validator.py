@@ -0,0 +1,25 @@
+# Generated by Django 4.1.3 on 2026-10-18 15:45
+
+import django.core.validators
+from django.db import migrations, models
+import re
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api_chat', '0011_profile_image_variants'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='phoneotp',
+            name='phone',
+            field=models.CharField(max_length=17, unique=True, validators=[django.core.validators.RegexValidator(message="Phone number must be entered in E.164 format: '+<country code><number>'. Up to 15 digits allowed.", regex=re.compile('^\\+[1-9]\\d{7,14}$'))]),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='phone',
+            field=models.CharField(max_length=17, unique=True, validators=[django.core.validators.RegexValidator(message="Phone number must be entered in E.164 format: '+<country code><number>'. Up to 15 digits allowed.", regex=re.compile('^\\+[1-9]\\d{7,14}$'))]),
+        ),
+    ]
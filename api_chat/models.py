@@ -1,20 +1,28 @@
 from __future__ import unicode_literals
-from django.db import models
+from django.db import connections, models, router, transaction
+from django.db.models import Count, F
+from django.utils import timezone
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
-from django.core.validators import RegexValidator
 from rest_framework.authtoken.models import Token
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
+from knox.models import AuthToken
+from api_chat.authentication import token_cache
+from api_chat.utils import e164_validator, normalize_phone, phone_validator
 
 
 class UserManager(BaseUserManager):
-    def create_user(self, phone, password=None, is_staff=False, is_active=True, is_admin=False):
+    def get_by_natural_key(self, username):
+        return super().get_by_natural_key(normalize_phone(username))
+
+    def create_user(self, phone, password=None, is_staff=False, is_active=True, is_admin=False, **extra_fields):
         if not phone:
             raise ValueError('users must have a phone number')
         if not password:
             raise ValueError('user must have a password')
 
         user_obj = self.model(
-            phone=phone
+            phone=phone,
+            **extra_fields
         )
         user_obj.set_password(password)
         user_obj.staff = is_staff
@@ -44,8 +52,7 @@ class UserManager(BaseUserManager):
 
 
 class User(AbstractBaseUser):
-    phone_regex = RegexValidator(regex=r'^\+?1?\d{9,14}$',
-                                 message="Phone number must be entered in the format: '+999999999'. Up to 14 digits allowed.")
+    phone_regex = e164_validator
     id = models.AutoField(primary_key=True)
     phone = models.CharField(validators=[phone_regex], max_length=17, unique=True)
     name = models.CharField(max_length=250, blank=True, null=True)
@@ -91,57 +98,384 @@ class User(AbstractBaseUser):
         verbose_name = 'usuario'
         verbose_name_plural = 'usuarios'
 
+    def save(self, *args, **kwargs):
+        self.phone = normalize_phone(self.phone)
+        if not phone_validator(self.phone):
+            raise ValueError('%r is not a valid phone number' % self.phone)
+        super().save(*args, **kwargs)
+
     def __str__(self) -> str:
         return str(self.phone)
 
 
 class Chat(models.Model):
+    DIRECTO = 'directo'
+    GRUPO = 'grupo'
+    TIPOS = ((DIRECTO, 'Directo'), (GRUPO, 'Grupo'))
+
     id = models.AutoField(primary_key=True)
+    # A group has no user_desde/user_hasta: its participants are its ChatMember rows.
+    tipo = models.CharField(max_length=10, choices=TIPOS, default=DIRECTO)
+    nombre = models.CharField(max_length=100, blank=True, default='', help_text='Name of a group')
+    # Indexed by the inbox indexes below, which have the user as leading column.
     user_desde = models.ForeignKey(to=User, null=True, blank=False, on_delete=models.SET_NULL,
-                                   related_name="user_desde")
+                                   related_name="user_desde", db_index=False)
     user_hasta = models.ForeignKey(to=User, null=True, blank=False, on_delete=models.SET_NULL,
-                                   related_name="user_hasta")
+                                   related_name="user_hasta", db_index=False)
     fecha_hora_creacion = models.DateTimeField(auto_now_add=True)
     aceptado = models.BooleanField(max_length=250, blank=False, null=True, default=False)
+    ultimo_seq = models.PositiveBigIntegerField(default=0, help_text='seq of the last message stored in this chat')
 
     class Meta:
         verbose_name = 'chat'
         verbose_name_plural = 'chats'
+        # Serve the chat_inbox/ pages: one index range scan per side of the chat, already
+        # in page order. Pending chats are few, so they get their own partial indexes.
+        indexes = [
+            models.Index(fields=['user_hasta', '-fecha_hora_creacion', '-id'],
+                         name='api_chat_chat_hasta_inbox_idx'),
+            models.Index(fields=['user_desde', '-fecha_hora_creacion', '-id'],
+                         name='api_chat_chat_desde_inbox_idx'),
+            models.Index(fields=['user_hasta', '-fecha_hora_creacion', '-id'],
+                         condition=models.Q(aceptado=False), name='api_chat_chat_hasta_pend_idx'),
+            models.Index(fields=['user_desde', '-fecha_hora_creacion', '-id'],
+                         condition=models.Q(aceptado=False), name='api_chat_chat_desde_pend_idx'),
+        ]
 
     def __str__(self) -> str:
         return str(self.id)
 
 
+class ChatMember(models.Model):
+    ADMIN = 'admin'
+    MIEMBRO = 'miembro'
+    ROLES = ((ADMIN, 'Administrador'), (MIEMBRO, 'Miembro'))
+
+    id = models.BigAutoField(primary_key=True)
+    # Membership checks are served by the (chat, user) unique index.
+    chat = models.ForeignKey(to=Chat, on_delete=models.CASCADE, related_name='miembros', db_index=False)
+    user = models.ForeignKey(to=User, on_delete=models.CASCADE, related_name='grupos', db_index=False)
+    rol = models.CharField(max_length=10, choices=ROLES, default=MIEMBRO)
+    aceptado = models.BooleanField(default=False, help_text='If the user accepted the invitation')
+    fecha_hora_union = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'miembro'
+        verbose_name_plural = 'miembros'
+        constraints = [
+            models.UniqueConstraint(fields=['chat', 'user'], name='api_chat_chatmember_chat_user_uniq'),
+        ]
+        indexes = [
+            # The groups of a user, newest first.
+            models.Index(fields=['user', '-chat'], name='api_chat_member_user_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return '%s en %s' % (self.user_id, self.chat_id)
+
+
+class KeyBundle(models.Model):
+    """
+    Public keys a user publishes so others can start end-to-end encrypted sessions with
+    them: the long-term identity key and the current signed prekey. The server only
+    stores and hands them out; it never sees private keys.
+    """
+    user = models.OneToOneField(to=User, on_delete=models.CASCADE, primary_key=True, related_name='claves')
+    identity_key = models.BinaryField()
+    signed_prekey_id = models.PositiveIntegerField()
+    signed_prekey = models.BinaryField()
+    signed_prekey_signature = models.BinaryField()
+    fecha_hora_actualizacion = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'claves'
+        verbose_name_plural = 'claves'
+
+    def __str__(self) -> str:
+        return str(self.user_id)
+
+
+class OneTimePreKeyManager(models.Manager):
+    def claim(self, user_ids):
+        """
+        Takes (deletes) the lowest one-time prekey of each of ``user_ids`` and returns them
+        as ``{user_id: (key_id, public_key)}``; users without prekeys left are missing.
+        Rows locked by a concurrent claim are skipped instead of waited for, so claims on
+        the same pool never block each other and never hand out the same prekey twice.
+        """
+        user_ids = sorted(set(user_ids))
+        if not user_ids:
+            return {}
+        using = router.db_for_write(self.model)
+        connection = connections[using]
+        if connection.vendor == 'postgresql':
+            # Every user in one statement: the lateral subquery locks one row per user.
+            table = connection.ops.quote_name(self.model._meta.db_table)
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'DELETE FROM {table} WHERE id IN ('
+                    ' SELECT k.id FROM unnest(%s::integer[]) AS u(user_id)'
+                    ' CROSS JOIN LATERAL (SELECT id FROM {table} WHERE user_id = u.user_id'
+                    '  ORDER BY key_id LIMIT 1 FOR UPDATE SKIP LOCKED) AS k'
+                    ') RETURNING user_id, key_id, public_key'.format(table=table), [user_ids])
+                return {user_id: (key_id, bytes(public_key)) for user_id, key_id, public_key in cursor.fetchall()}
+
+        # Elsewhere (sqlite in development) one claim per user.
+        claimed = {}
+        with transaction.atomic(using=using):
+            for user_id in user_ids:
+                prekey = self.db_manager(using).select_for_update(skip_locked=True).filter(
+                    user_id=user_id).order_by('key_id').first()
+                if prekey is not None:
+                    claimed[user_id] = (prekey.key_id, bytes(prekey.public_key))
+                    self.db_manager(using).filter(pk=prekey.pk).delete()
+        return claimed
+
+
+class OneTimePreKey(models.Model):
+    id = models.BigAutoField(primary_key=True)
+    # Claims take the lowest key_id of a user from the (user, key_id) unique index.
+    user = models.ForeignKey(to=User, on_delete=models.CASCADE, related_name='prekeys', db_index=False)
+    key_id = models.PositiveIntegerField()
+    public_key = models.BinaryField()
+
+    objects = OneTimePreKeyManager()
+
+    class Meta:
+        verbose_name = 'prekey'
+        verbose_name_plural = 'prekeys'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key_id'], name='api_chat_prekey_user_key_uniq'),
+        ]
+
+    def __str__(self) -> str:
+        return '%s de %s' % (self.key_id, self.user_id)
+
+
+class Device(models.Model):
+    """
+    An installation of the app of a user, with its own mailbox of pending envelopes.
+    ``identificador`` is chosen by the client and stable across logins.
+    """
+    id = models.BigAutoField(primary_key=True)
+    user = models.ForeignKey(to=User, on_delete=models.CASCADE, related_name='dispositivos', db_index=False)
+    identificador = models.CharField(max_length=64)
+    nombre = models.CharField(max_length=100, blank=True, default='')
+    fecha_hora_registro = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'dispositivo'
+        verbose_name_plural = 'dispositivos'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'identificador'], name='api_chat_device_user_ident_uniq'),
+        ]
+
+    def __str__(self) -> str:
+        return '%s de %s' % (self.identificador, self.user_id)
+
+
+class EnvelopeManager(models.Manager):
+    def evict_expired(self, max_age, batch_size=1000):
+        """
+        Deletes the envelopes older than ``max_age`` (a timedelta), ``batch_size`` rows per
+        statement. Returns how many were deleted.
+        """
+        limite = timezone.now() - max_age
+        deleted = 0
+        while True:
+            ids = list(self.filter(fecha_hora_creacion__lt=limite).values_list('id', flat=True)[:batch_size])
+            if not ids:
+                return deleted
+            deleted += self.filter(id__in=ids).delete()[0]
+
+    def evict_overflow(self, max_envelopes):
+        """
+        Deletes the oldest envelopes of every mailbox holding more than ``max_envelopes``.
+        Returns how many were deleted.
+        """
+        deleted = 0
+        llenos = self.values('device_id').annotate(total=Count('id')).filter(total__gt=max_envelopes)
+        for device_id in llenos.values_list('device_id', flat=True):
+            # The newest envelope that does not fit; it and everything older go.
+            corte = self.filter(device_id=device_id).order_by('-id').values_list('id', flat=True)[max_envelopes]
+            deleted += self.filter(device_id=device_id, id__lte=corte).delete()[0]
+        return deleted
+
+
+class Envelope(models.Model):
+    """
+    Ciphertext waiting in the mailbox of a device until the device acknowledges it. The
+    id orders the mailbox: drains read ranges of it and acks delete ranges of it.
+    """
+    id = models.BigAutoField(primary_key=True)
+    # Drains and acks are range scans on the (device, id) index.
+    device = models.ForeignKey(to=Device, on_delete=models.CASCADE, related_name='sobres', db_index=False)
+    chat = models.ForeignKey(to=Chat, on_delete=models.CASCADE, related_name='+', db_index=False)
+    user_desde = models.ForeignKey(to=User, null=True, on_delete=models.SET_NULL, related_name='+',
+                                   db_index=False)
+    contenido = models.BinaryField(help_text='Opaque ciphertext, never decrypted by the server')
+    fecha_hora_creacion = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    objects = EnvelopeManager()
+
+    class Meta:
+        verbose_name = 'sobre'
+        verbose_name_plural = 'sobres'
+        indexes = [
+            models.Index(fields=['device', 'id'], name='api_chat_envelope_device_idx'),
+        ]
+
+
+class Attachment(models.Model):
+    """
+    Encrypted file shared in a chat, stored in the bucket under ``key``. The server only
+    signs urls: the client encrypts it, uploads its parts and downloads it directly.
+    """
+    PENDIENTE = 'P'
+    COMPLETO = 'C'
+    ESTADOS = (
+        (PENDIENTE, 'Pendiente'),
+        (COMPLETO, 'Completo'),
+    )
+
+    id = models.BigAutoField(primary_key=True)
+    chat = models.ForeignKey(to=Chat, on_delete=models.CASCADE, related_name='adjuntos')
+    user = models.ForeignKey(to=User, null=True, on_delete=models.SET_NULL, related_name='+', db_index=False)
+    key = models.CharField(max_length=255, unique=True)
+    upload_id = models.TextField(blank=True, default='', help_text='Multipart upload in progress, while pending')
+    tamano = models.BigIntegerField(help_text='Size of the encrypted file, in bytes')
+    tamano_parte = models.IntegerField()
+    estado = models.CharField(max_length=1, choices=ESTADOS, default=PENDIENTE)
+    fecha_hora_creacion = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'adjunto'
+        verbose_name_plural = 'adjuntos'
+        indexes = [
+            # Stale uploads sweep.
+            models.Index(fields=['estado', 'fecha_hora_creacion'], name='api_chat_attachment_state_idx'),
+        ]
+
+
+class MessageManager(models.Manager):
+    def create_next(self, chat_id, user_desde, contenido):
+        """
+        Stores a message with the next seq of its chat. The UPDATE on the chat row holds
+        its lock until commit, so concurrent senders get consecutive, gap-free seqs.
+        """
+        with transaction.atomic(using=self.db):
+            Chat.objects.filter(pk=chat_id).update(ultimo_seq=F('ultimo_seq') + 1)
+            seq = Chat.objects.filter(pk=chat_id).values_list('ultimo_seq', flat=True).get()
+            return self.create(chat_id=chat_id, seq=seq, user_desde=user_desde, contenido=contenido)
+
+
+class Message(models.Model):
+    id = models.BigAutoField(primary_key=True)
+    # Lookups by chat are served by the (chat, seq) unique index.
+    chat = models.ForeignKey(to=Chat, on_delete=models.CASCADE, related_name='mensajes', db_index=False)
+    seq = models.PositiveBigIntegerField()
+    user_desde = models.ForeignKey(to=User, null=True, blank=False, on_delete=models.SET_NULL,
+                                   related_name='mensajes_enviados')
+    contenido = models.BinaryField(help_text='Opaque ciphertext, never decrypted by the server')
+    fecha_hora_creacion = models.DateTimeField(auto_now_add=True)
+
+    objects = MessageManager()
+
+    class Meta:
+        verbose_name = 'mensaje'
+        verbose_name_plural = 'mensajes'
+        constraints = [
+            models.UniqueConstraint(fields=['chat', 'seq'], name='api_chat_message_chat_seq_uniq'),
+        ]
+
+    def __str__(self) -> str:
+        return '%s #%s' % (self.chat_id, self.seq)
+
+
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     email = models.EmailField(blank=True, null=True)
     image = models.ImageField(null=True, blank=True)
+    # Set by the generate_profile_variants task (see api_chat/images.py): the image its
+    # resized variants were made from, and the digest that names them.
+    image_variants_of = models.CharField(max_length=100, blank=True, default='', editable=False)
+    image_digest = models.CharField(max_length=32, blank=True, default='', editable=False)
     address = models.CharField(max_length=900, blank=True, null=True)
     city = models.CharField(max_length=30, blank=True, null=True)
     first_count = models.IntegerField(default=0,
                                       help_text='It is 0, if the user is totally new and 1 if the user has saved his standard once')
 
+    # Image name as loaded from the database, to tell when a save changes it.
+    _saved_image = ''
+
     def __str__(self):
         return str(self.user)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_image = instance.image.name if 'image' in instance.__dict__ else None
+        return instance
+
 
 def user_created_receiver(sender, instance, created, *args, **kwargs):
     if created:
-        Profile.objects.get_or_create(user=instance)
+        Profile.objects.create(user=instance)
 
 
 post_save.connect(user_created_receiver, sender=User)
 
 
+def profile_image_changed_receiver(sender, instance, update_fields=None, *args, **kwargs):
+    # A new image gets its variants made by a worker once the change is committed; other
+    # saves (first_count, address, ...) queue nothing.
+    if update_fields is not None and 'image' not in update_fields:
+        return
+    name = instance.image.name or ''
+    changed = name != (instance._saved_image or '')
+    instance._saved_image = name
+    if changed and name:
+        from api_chat.tasks import generate_profile_variants
+        transaction.on_commit(lambda: generate_profile_variants.delay(instance.pk))
+
+
+post_save.connect(profile_image_changed_receiver, sender=Profile)
+
+
+def user_changed_token_cache_receiver(sender, instance, created, update_fields=None, *args, **kwargs):
+    # Cached tokens carry the active flag of the user; drop them when the user changes
+    # (password, active flag, ...). Login bookkeeping is not worth a query.
+    if created or (update_fields is not None and set(update_fields) <= {'last_login', 'first_login'}):
+        return
+    token_cache.delete_many(AuthToken.objects.filter(user=instance).values_list('token_key', flat=True))
+
+
+post_save.connect(user_changed_token_cache_receiver, sender=User)
+
+
+def auth_token_deleted_receiver(sender, instance, *args, **kwargs):
+    token_cache.delete(instance.token_key)
+
+
+post_delete.connect(auth_token_deleted_receiver, sender=AuthToken)
+
+
 class PhoneOTP(models.Model):
-    phone_regex = RegexValidator(regex=r'^\+?1?\d{9,14}$',
-                                 message="Phone number must be entered in the format: '+999999999'. Up to 14 digits allowed.")
+    phone_regex = e164_validator
     phone = models.CharField(validators=[phone_regex], max_length=17, unique=True)
-    otp = models.CharField(max_length=9, blank=True, null=True)
+    otp = models.CharField(max_length=64, blank=True, null=True, help_text='HMAC of the last otp sent')
+    otp_attempts = models.IntegerField(default=0, help_text='Verifications of the last otp sent')
+    otp_expires_at = models.DateTimeField(blank=True, null=True)
     count = models.IntegerField(default=0, help_text='Number of otp sent')
     logged = models.BooleanField(default=False, help_text='If otp verification got successful')
     forgot = models.BooleanField(default=False, help_text='only true for forgot password')
     forgot_logged = models.BooleanField(default=False, help_text='Only true if validdate otp forgot get successful')
 
+    def save(self, *args, **kwargs):
+        self.phone = normalize_phone(self.phone)
+        if not phone_validator(self.phone):
+            raise ValueError('%r is not a valid phone number' % self.phone)
+        super().save(*args, **kwargs)
+
     def __str__(self):
-        return str(self.phone) + ' is sent ' + str(self.otp)
+        return str(self.phone) + ' is sent ' + str(self.count) + ' otp'
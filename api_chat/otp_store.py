@@ -0,0 +1,260 @@
+"""
+Storage of the OTP verification state of a phone number, selected with settings.OTP_STORE.
+
+RedisOTPStore keeps each phone in a hash that expires OTP_TTL seconds after the last OTP
+was issued, and the number of OTPs sent to it in a key that expires OTP_COUNT_TTL seconds
+after it, so the "max otp sent" limits hold for that long without keeping a key per phone
+ever seen. ORMOTPStore keeps the previous PhoneOTP table behaviour and is used when redis
+is not available.
+
+Codes are never stored: only an HMAC of the phone and the code, keyed with OTP_HMAC_KEY,
+which ``verify`` compares in constant time. Each code is valid for OTP_CODE_TTL seconds
+and OTP_MAX_ATTEMPTS verifications; the attempt is counted before the comparison, so
+concurrent guesses can not go past the limit.
+"""
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+from hmac import compare_digest
+from typing import Optional
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
+from django.utils.module_loading import import_string
+
+from api_chat.redis_client import get_redis_connection
+
+# Results of BaseOTPStore.verify.
+OTP_VALID = 'valid'
+OTP_INVALID = 'invalid'
+OTP_EXPIRED = 'expired'
+OTP_LOCKED = 'locked'
+
+
+def hash_otp(phone, otp):
+    """HMAC-SHA256 (hex) of the code sent to ``phone``; bound to the phone."""
+    return salted_hmac('api_chat.otp', '%s:%s' % (phone, otp),
+                       secret=settings.OTP_HMAC_KEY or None, algorithm='sha256').hexdigest()
+
+
+def otp_matches(state, otp):
+    return state.otp_digest is not None and compare_digest(state.otp_digest, hash_otp(state.phone, otp))
+
+
+@dataclass
+class OTPState:
+    phone: str
+    otp_digest: Optional[str] = None
+    # Unix time after which the code is no longer accepted.
+    expires: Optional[float] = None
+    attempts: int = 0
+    count: int = 0
+    logged: bool = False
+    forgot: bool = False
+    forgot_logged: bool = False
+
+
+class BaseOTPStore:
+    """
+    Phones are expected already normalized with api_chat.utils.normalize_phone.
+    """
+
+    def get(self, phone):
+        """Returns the OTPState of ``phone`` or None."""
+        raise NotImplementedError
+
+    def issue(self, phone, otp, forgot=False, max_count=None):
+        """
+        Stores the digest of a newly sent ``otp``, increments the number of OTPs sent and
+        clears any previous verification and attempts. Returns the new OTPState, or None
+        without changing anything when ``max_count`` OTPs were already sent; the check and
+        the increment are atomic, so concurrent requests can not go past it.
+        """
+        raise NotImplementedError
+
+    def verify(self, phone, otp, mark='logged'):
+        """
+        Checks ``otp`` against the last code issued to ``phone``, counting the attempt, and
+        sets the ``mark`` flag (logged or forgot_logged, None for none) when it matches. Returns
+        ``(state, result)``, with result one of OTP_VALID, OTP_INVALID, OTP_EXPIRED or
+        OTP_LOCKED; state is None (and result OTP_INVALID) for an unknown phone.
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def check(state, otp):
+        """Result of ``otp`` for ``state``, whose ``attempts`` already count this one."""
+        if state.otp_digest is None or state.expires is None or state.expires < time.time():
+            return OTP_EXPIRED
+        if state.attempts > settings.OTP_MAX_ATTEMPTS:
+            return OTP_LOCKED
+        return OTP_VALID if otp_matches(state, otp) else OTP_INVALID
+
+    def delete(self, phone):
+        raise NotImplementedError
+
+
+class ORMOTPStore(BaseOTPStore):
+    @staticmethod
+    def _to_state(obj):
+        return OTPState(phone=obj.phone, otp_digest=obj.otp,
+                        expires=obj.otp_expires_at.timestamp() if obj.otp_expires_at else None,
+                        attempts=obj.otp_attempts, count=obj.count, logged=obj.logged,
+                        forgot=obj.forgot, forgot_logged=obj.forgot_logged)
+
+    @staticmethod
+    def _queryset(phone):
+        from api_chat.models import PhoneOTP
+        return PhoneOTP.objects.filter(phone=phone)
+
+    def get(self, phone):
+        obj = self._queryset(phone).first()
+        return self._to_state(obj) if obj is not None else None
+
+    def issue(self, phone, otp, forgot=False, max_count=None):
+        from api_chat.models import PhoneOTP
+        values = {'otp': hash_otp(phone, otp), 'otp_attempts': 0,
+                  'otp_expires_at': timezone.now() + timedelta(seconds=settings.OTP_CODE_TTL),
+                  'forgot': forgot, 'logged': False, 'forgot_logged': False}
+        queryset = self._queryset(phone)
+        if max_count is not None:
+            queryset = queryset.filter(count__lt=max_count)
+        with transaction.atomic():
+            if not queryset.update(count=F('count') + 1, **values):
+                try:
+                    with transaction.atomic():
+                        return self._to_state(PhoneOTP.objects.create(phone=phone, count=1, **values))
+                except IntegrityError:
+                    # The row exists: at the limit, or created concurrently by another request.
+                    if not queryset.update(count=F('count') + 1, **values):
+                        return None
+            return self.get(phone)
+
+    def verify(self, phone, otp, mark='logged'):
+        with transaction.atomic():
+            # The row lock serializes concurrent verifications of the phone.
+            obj = self._queryset(phone).select_for_update().first()
+            if obj is None:
+                return None, OTP_INVALID
+            obj.otp_attempts += 1
+            state = self._to_state(obj)
+            result = self.check(state, otp)
+            update = {'otp_attempts': obj.otp_attempts}
+            if result == OTP_VALID and mark:
+                update[mark] = True
+                setattr(state, mark, True)
+            self._queryset(phone).update(**update)
+        return state, result
+
+    def delete(self, phone):
+        self._queryset(phone).delete()
+
+
+class RedisOTPStore(BaseOTPStore):
+    key_prefix = 'otp:'
+    # Sets a field only on a live hash, so a late verification can not resurrect an
+    # expired OTP as a key without TTL.
+    set_if_exists_script = """
+        if redis.call('EXISTS', KEYS[1]) == 1 then
+            return redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+        end
+        return nil
+    """
+    count_prefix = 'otp_count:'
+    # Counts a verification attempt of a live hash and returns the hash after it, with the
+    # number of OTPs sent (KEYS[2]) as its 'count' field.
+    count_attempt_script = """
+        if redis.call('EXISTS', KEYS[1]) == 1 then
+            redis.call('HINCRBY', KEYS[1], 'attempts', 1)
+            local data = redis.call('HGETALL', KEYS[1])
+            table.insert(data, 'count')
+            table.insert(data, redis.call('GET', KEYS[2]) or '0')
+            return data
+        end
+        return nil
+    """
+    # Unless ARGV[1] (the limit, '' for none) OTPs were already sent: increments the count
+    # (KEYS[2]) and renews its expiry (ARGV[2]), resets the hash (KEYS[1]) to the code digest
+    # (ARGV[4]), its expiry time (ARGV[5]) and forgot flag (ARGV[6]), and renews its expiry
+    # (ARGV[3]). Returns the count, or nil at the limit.
+    issue_script = """
+        local count = tonumber(redis.call('GET', KEYS[2]) or '0')
+        if ARGV[1] ~= '' and count >= tonumber(ARGV[1]) then
+            return nil
+        end
+        count = redis.call('INCR', KEYS[2])
+        redis.call('EXPIRE', KEYS[2], ARGV[2])
+        redis.call('HSET', KEYS[1], 'otp', ARGV[4], 'expires', ARGV[5], 'attempts', 0,
+                   'forgot', ARGV[6], 'logged', 0, 'forgot_logged', 0)
+        redis.call('EXPIRE', KEYS[1], ARGV[3])
+        return count
+    """
+
+    def __init__(self):
+        self.redis = get_redis_connection()
+        self._set_if_exists = self.redis.register_script(self.set_if_exists_script)
+        self._count_attempt = self.redis.register_script(self.count_attempt_script)
+        self._issue = self.redis.register_script(self.issue_script)
+
+    def _key(self, phone):
+        return self.key_prefix + str(phone)
+
+    def _count_key(self, phone):
+        return self.count_prefix + str(phone)
+
+    @staticmethod
+    def _to_state(phone, data):
+        return OTPState(phone=str(phone), otp_digest=data.get('otp'),
+                        expires=float(data['expires']) if data.get('expires') else None,
+                        attempts=int(data.get('attempts', 0)), count=int(data.get('count', 0)),
+                        logged=data.get('logged') == '1', forgot=data.get('forgot') == '1',
+                        forgot_logged=data.get('forgot_logged') == '1')
+
+    def get(self, phone):
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(self._key(phone))
+            pipe.get(self._count_key(phone))
+            data, count = pipe.execute()
+        if not data and count is None:
+            return None
+        # Past OTP_TTL only the count is left: a state without a code, like a PhoneOTP row.
+        data['count'] = count or 0
+        return self._to_state(phone, data)
+
+    def issue(self, phone, otp, forgot=False, max_count=None):
+        digest = hash_otp(phone, otp)
+        expires = time.time() + settings.OTP_CODE_TTL
+        count = self._issue(
+            keys=[self._key(phone), self._count_key(phone)],
+            args=['' if max_count is None else max_count, settings.OTP_COUNT_TTL, settings.OTP_TTL,
+                  digest, repr(expires), int(forgot)])
+        if count is None:
+            return None
+        return OTPState(phone=str(phone), otp_digest=digest, expires=expires, count=count, forgot=forgot)
+
+    def verify(self, phone, otp, mark='logged'):
+        values = self._count_attempt(keys=[self._key(phone), self._count_key(phone)])
+        if not values:
+            return None, OTP_INVALID
+        state = self._to_state(phone, dict(zip(values[::2], values[1::2])))
+        result = self.check(state, otp)
+        if result == OTP_VALID and mark:
+            self._set_if_exists(keys=[self._key(phone)], args=[mark, 1])
+            setattr(state, mark, True)
+        return state, result
+
+    def delete(self, phone):
+        self.redis.delete(self._key(phone), self._count_key(phone))
+
+
+_stores = {}
+
+
+def get_otp_store():
+    store = _stores.get(settings.OTP_STORE)
+    if store is None:
+        store = _stores[settings.OTP_STORE] = import_string(settings.OTP_STORE)()
+    return store
@@ -0,0 +1,147 @@
+"""
+PostgreSQL backend that keeps connections in an in-process pool.
+
+Under ASGI django runs the sync code of every request in a thread of its own, so
+persistent connections (CONN_MAX_AGE) are left behind in threads that never come back.
+With this backend and CONN_MAX_AGE = 0 django still "closes" the connection when the
+request finishes, but the connection goes back to a pool shared by all the threads of
+the process and the next request reuses it instead of paying TCP, TLS and auth again.
+
+Configured with the POOL key of the database settings (see settings.DATABASES):
+MAX_SIZE connections at most, MAX_IDLE kept open while unused, TIMEOUT seconds to wait
+for a free one and MAX_AGE seconds before a connection is replaced. With
+CONN_HEALTH_CHECKS a reused connection is checked before it is handed out.
+"""
+import threading
+import time
+from collections import deque
+
+import psycopg2
+import psycopg2.extras
+from django.db.backends.postgresql import base, creation
+
+
+class ConnectionPool:
+    def __init__(self, conn_params, max_size=20, max_idle=5, timeout=10, max_age=600):
+        self.conn_params = conn_params
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.max_age = max_age
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.lock = threading.Lock()
+        # (connection, opened at), the most recently returned last.
+        self.idle = deque()
+        self.opened_at = {}
+
+    def acquire(self, health_check=False):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise psycopg2.OperationalError(
+                'connection pool exhausted: %d connections in use for %ss' % (self.max_size, self.timeout))
+        try:
+            while True:
+                with self.lock:
+                    connection = self.idle.pop()[0] if self.idle else None
+                if connection is None:
+                    connection = psycopg2.connect(**self.conn_params)
+                    self.opened_at[id(connection)] = time.monotonic()
+                    return connection
+                if self.usable(connection, health_check):
+                    return connection
+                self.discard(connection)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, connection, discard=False):
+        try:
+            if not discard and not connection.closed:
+                status = connection.info.transaction_status
+                if status in (psycopg2.extensions.TRANSACTION_STATUS_INTRANS,
+                              psycopg2.extensions.TRANSACTION_STATUS_INERROR):
+                    connection.rollback()
+                    status = connection.info.transaction_status
+                if status == psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    with self.lock:
+                        if len(self.idle) < self.max_idle:
+                            self.idle.append((connection, self.opened_at[id(connection)]))
+                            return
+            self.discard(connection)
+        finally:
+            self.slots.release()
+
+    def usable(self, connection, health_check):
+        if connection.closed or time.monotonic() - self.opened_at[id(connection)] > self.max_age:
+            return False
+        if health_check:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+            except psycopg2.Error:
+                return False
+        return True
+
+    def clear(self):
+        with self.lock:
+            idle, self.idle = self.idle, deque()
+        for connection, _ in idle:
+            self.discard(connection)
+
+    def discard(self, connection):
+        self.opened_at.pop(id(connection), None)
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # Idle pooled connections would keep postgres from dropping the database.
+        self.connection.clear_pools()
+        super()._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+    # One pool per set of connection parameters (the test database has its own) and process.
+    pools = {}
+    pools_lock = threading.Lock()
+
+    def get_pool(self, conn_params):
+        key = tuple(sorted(conn_params.items()))
+        with self.pools_lock:
+            pool = self.pools.get(key)
+            if pool is None:
+                options = {name.lower(): value for name, value in self.settings_dict.get('POOL', {}).items()}
+                pool = self.pools[key] = ConnectionPool(conn_params, **options)
+        return pool
+
+    @classmethod
+    def clear_pools(cls):
+        with cls.pools_lock:
+            pools = list(cls.pools.values())
+        for pool in pools:
+            pool.clear()
+
+    def get_new_connection(self, conn_params):
+        self.pool = self.get_pool(conn_params)
+        connection = self.pool.acquire(health_check=self.settings_dict['CONN_HEALTH_CHECKS'])
+
+        # As in the postgresql backend, which would open the connection itself.
+        options = self.settings_dict['OPTIONS']
+        try:
+            self.isolation_level = options['isolation_level']
+        except KeyError:
+            self.isolation_level = connection.isolation_level
+        else:
+            if self.isolation_level != connection.isolation_level:
+                connection.set_session(isolation_level=self.isolation_level)
+        psycopg2.extras.register_default_jsonb(conn_or_curs=connection, loads=lambda x: x)
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                # After an error the connection may be broken: do not hand it out again.
+                self.pool.release(self.connection, discard=self.errors_occurred)
@@ -0,0 +1,21 @@
+import threading
+
+from django.conf import settings
+
+_connection = None
+_lock = threading.Lock()
+
+
+def get_redis_connection():
+    """
+    Process-wide redis client for REDIS_URL, or None when redis is not configured.
+    """
+    global _connection
+    if not settings.REDIS_URL:
+        return None
+    if _connection is None:
+        with _lock:
+            if _connection is None:
+                import redis
+                _connection = redis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
+    return _connection
@@ -0,0 +1,43 @@
+"""
+Database router that sends reads to the read replicas (settings.DATABASE_REPLICAS), only
+inside ``read_from_replica()`` blocks: the rest of the code keeps reading its own writes
+from the primary. Replicas lag a little behind, so only use it for reads that can be
+slightly stale.
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+
+_use_replica = ContextVar('use_replica', default=False)
+
+
+@contextmanager
+def read_from_replica():
+    """
+    Reads in the block go to a replica, also the ones an async view makes through the
+    async ORM (sync_to_async copies the context into the thread that runs the query).
+    """
+    token = _use_replica.set(True)
+    try:
+        yield
+    finally:
+        _use_replica.reset(token)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if _use_replica.get() and settings.DATABASE_REPLICAS:
+            return random.choice(settings.DATABASE_REPLICAS)
+        return None
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Every alias holds the same data.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.DATABASE_REPLICAS
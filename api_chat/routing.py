@@ -0,0 +1,7 @@
+from django.urls import re_path
+from api_chat.consumers import ChatConsumer, MailboxConsumer
+
+websocket_urlpatterns = [
+    re_path(r'^ws/chat/(?P<id_chat>\d+)/$', ChatConsumer.as_asgi()),
+    re_path(r'^ws/mailbox/(?P<id_dispositivo>\d+)/$', MailboxConsumer.as_asgi()),
+]
@@ -1,6 +1,16 @@
+import base64
+import binascii
+import datetime
+import math
 from rest_framework import serializers
+from django.conf import settings
 from django.contrib.auth import authenticate
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ObjectDoesNotExist
+
+from api_chat.models import Chat, ChatMember, Message
+from api_chat.images import variant_url
+from api_chat.utils import normalize_phone
 
 User = get_user_model()
 
@@ -22,29 +32,34 @@ class UserSerializer(serializers.ModelSerializer):
         fields = ('id', 'phone', 'first_login')
 
 
-class LoginUserSerializer(serializers.Serializer):
+class LoginCredentialsSerializer(serializers.Serializer):
     phone = serializers.CharField()
     password = serializers.CharField(
         style={'input_type': 'password'}, trim_whitespace=False)
 
+
+def login_failed_error(registered):
+    if not registered:
+        msg = {'detail': 'Phone number is not registered.',
+               'register': False}
+        return serializers.ValidationError(msg)
+    msg = {
+        'detail': 'Unable to log in with provided credentials.', 'register': True}
+    return serializers.ValidationError(msg, code='authorization')
+
+
+class LoginUserSerializer(LoginCredentialsSerializer):
     def validate(self, attrs):
-        phone = attrs.get('phone')
+        phone = normalize_phone(attrs.get('phone'))
         password = attrs.get('password')
 
         if phone and password:
-            if User.objects.filter(phone=phone).exists():
-                user = authenticate(request=self.context.get('request'),
-                                    phone=phone, password=password)
-
-            else:
-                msg = {'detail': 'Phone number is not registered.',
-                       'register': False}
-                raise serializers.ValidationError(msg)
+            user = authenticate(request=self.context.get('request'),
+                                phone=phone, password=password)
 
+            # Only failed logins pay for the query that tells both errors apart.
             if not user:
-                msg = {
-                    'detail': 'Unable to log in with provided credentials.', 'register': True}
-                raise serializers.ValidationError(msg, code='authorization')
+                raise login_failed_error(User.objects.filter(phone=phone).exists())
 
         else:
             msg = 'Must include "username" and "password".'
@@ -79,9 +94,297 @@ class CreateChatSerializer(serializers.Serializer):
     phone_hasta = serializers.CharField(required=True)
 
 
+class CreateChatBatchSerializer(serializers.Serializer):
+    phones_hasta = serializers.ListField(child=serializers.CharField(), allow_empty=False)
+
+    def validate_phones_hasta(self, value):
+        if len(value) > settings.CHAT_BATCH_MAX_SIZE:
+            raise serializers.ValidationError(
+                'Se pueden crear como máximo %d chats por solicitud.' % settings.CHAT_BATCH_MAX_SIZE)
+        return value
+
+
+class GroupMembersSerializer(serializers.Serializer):
+    id_chat = serializers.IntegerField(required=True)
+    phones_miembros = serializers.ListField(child=serializers.CharField(), allow_empty=False)
+
+    def validate_phones_miembros(self, value):
+        if len(value) > settings.CHAT_GROUP_MAX_MEMBERS:
+            raise serializers.ValidationError(
+                'Un grupo puede tener como máximo %d miembros.' % settings.CHAT_GROUP_MAX_MEMBERS)
+        return value
+
+
+class CreateGroupSerializer(GroupMembersSerializer):
+    id_chat = None
+    nombre = serializers.CharField(required=True, max_length=100)
+    phones_miembros = serializers.ListField(child=serializers.CharField(), allow_empty=True, required=False,
+                                            default=list)
+
+
+class AvatarField(serializers.Field):
+    """
+    Url of the variant of a user's Profile.image that fits the avatar size the client asks
+    for with ?avatar_size=<px> (``size`` by default), or of the original while its variants
+    are being made. Select the profile along with the users to avoid a query per user.
+    """
+
+    def __init__(self, size=None, **kwargs):
+        self.size = size
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, user):
+        try:
+            profile = user.profile
+        except ObjectDoesNotExist:
+            return None
+        size = self.size or settings.PROFILE_IMAGE_DEFAULT_SIZE
+        request = self.context.get('request')
+        if request is not None and request.query_params.get('avatar_size', '').isdigit():
+            size = int(request.query_params['avatar_size'])
+        return variant_url(profile, size)
+
+
+class ChatMemberSerializer(serializers.ModelSerializer):
+    id_usuario = serializers.IntegerField(source='user_id')
+    nombre = serializers.CharField(source='user.name')
+    avatar = AvatarField(source='user')
+
+    class Meta:
+        model = ChatMember
+        fields = ('id_usuario', 'nombre', 'avatar', 'rol', 'aceptado', 'fecha_hora_union')
+
+
+class GroupSerializer(serializers.ModelSerializer):
+    """
+    A group as seen by one of its members: ``rol`` and ``aceptado`` are the membership's.
+    """
+    id_chat = serializers.IntegerField(source='chat_id')
+    nombre = serializers.CharField(source='chat.nombre')
+    ultimo_seq = serializers.IntegerField(source='chat.ultimo_seq')
+
+    class Meta:
+        model = ChatMember
+        fields = ('id_chat', 'nombre', 'rol', 'aceptado', 'ultimo_seq')
+
+
+class GroupsSerializer(serializers.Serializer):
+    before = serializers.IntegerField(required=False)
+    limit = serializers.IntegerField(required=False, min_value=1)
+
+    def validate_limit(self, value):
+        return min(value, settings.CHAT_INBOX_MAX_LIMIT)
+
+
 class ValidateChatSerializer(serializers.Serializer):
     id_chat = serializers.IntegerField(required=True)
 
 
+class ChatLongPollSerializer(ValidateChatSerializer):
+    timeout = serializers.FloatField(required=False, min_value=0, error_messages={
+        'invalid': 'El tiempo de espera debe ser un número de segundos.'})
+
+    def validate_timeout(self, value):
+        if not math.isfinite(value):
+            raise serializers.ValidationError('El tiempo de espera debe ser un número de segundos.')
+        return min(value, settings.CHAT_LONG_POLL_MAX_TIMEOUT)
+
+
 class AuthorizedChatSerializer(serializers.Serializer):
     id_chat = serializers.IntegerField(required=True)
+
+
+class Base64BinaryField(serializers.Field):
+    """
+    Exposes a BinaryField (ciphertext) as a base64 string.
+    """
+
+    def to_representation(self, value):
+        return base64.b64encode(bytes(value)).decode('ascii')
+
+    def to_internal_value(self, data):
+        try:
+            return base64.b64decode(data, validate=True)
+        except (TypeError, ValueError, binascii.Error):
+            raise serializers.ValidationError('El contenido debe estar codificado en base64.')
+
+
+class PublicKeyField(Base64BinaryField):
+    def to_internal_value(self, data):
+        value = super().to_internal_value(data)
+        if not 0 < len(value) <= settings.KEYS_MAX_KEY_SIZE:
+            raise serializers.ValidationError('La clave debe tener entre 1 y %d bytes.' % settings.KEYS_MAX_KEY_SIZE)
+        return value
+
+
+class PreKeySerializer(serializers.Serializer):
+    key_id = serializers.IntegerField(min_value=0, max_value=2 ** 31 - 1)
+    public_key = PublicKeyField()
+
+
+class UploadPreKeysSerializer(serializers.Serializer):
+    one_time_prekeys = serializers.ListField(child=PreKeySerializer(), allow_empty=False)
+
+    def validate_one_time_prekeys(self, value):
+        if len(value) > settings.KEYS_MAX_PREKEYS:
+            raise serializers.ValidationError(
+                'Se pueden subir como máximo %d prekeys.' % settings.KEYS_MAX_PREKEYS)
+        if len({prekey['key_id'] for prekey in value}) != len(value):
+            raise serializers.ValidationError('Los key_id de las prekeys deben ser distintos.')
+        return value
+
+
+class UploadKeysSerializer(UploadPreKeysSerializer):
+    identity_key = PublicKeyField()
+    signed_prekey_id = serializers.IntegerField(min_value=0, max_value=2 ** 31 - 1)
+    signed_prekey = PublicKeyField()
+    signed_prekey_signature = PublicKeyField()
+    one_time_prekeys = serializers.ListField(child=PreKeySerializer(), allow_empty=True, required=False,
+                                             default=list)
+
+
+class KeyBundlesSerializer(serializers.Serializer):
+    ids_usuarios = serializers.ListField(child=serializers.IntegerField(), allow_empty=False)
+
+    def validate_ids_usuarios(self, value):
+        if len(value) > settings.CHAT_GROUP_MAX_MEMBERS:
+            raise serializers.ValidationError(
+                'Se pueden pedir como máximo %d usuarios.' % settings.CHAT_GROUP_MAX_MEMBERS)
+        return value
+
+
+class MessageSerializer(serializers.ModelSerializer):
+    contenido = Base64BinaryField()
+
+    class Meta:
+        model = Message
+        fields = ('seq', 'user_desde', 'contenido', 'fecha_hora_creacion')
+
+
+class ChatHistorySerializer(serializers.Serializer):
+    id_chat = serializers.IntegerField(required=True)
+    after = serializers.IntegerField(required=False, default=0, min_value=0)
+    limit = serializers.IntegerField(required=False, min_value=1)
+
+    def validate_limit(self, value):
+        return min(value, settings.CHAT_HISTORY_MAX_LIMIT)
+
+
+class DeviceSerializer(serializers.Serializer):
+    identificador = serializers.CharField(max_length=64)
+    nombre = serializers.CharField(max_length=100, required=False, allow_blank=True, default='')
+
+
+class EnvelopeSerializer(serializers.Serializer):
+    id_usuario = serializers.IntegerField()
+    contenido = Base64BinaryField()
+
+    def validate_contenido(self, value):
+        if not 0 < len(value) <= settings.CHAT_MAX_FRAME_SIZE:
+            raise serializers.ValidationError(
+                'El contenido debe tener entre 1 y %d bytes.' % settings.CHAT_MAX_FRAME_SIZE)
+        return value
+
+
+class MailboxSendSerializer(serializers.Serializer):
+    id_chat = serializers.IntegerField()
+    sobres = serializers.ListField(child=EnvelopeSerializer(), allow_empty=False)
+
+    def validate_sobres(self, value):
+        if len(value) > settings.CHAT_GROUP_MAX_MEMBERS:
+            raise serializers.ValidationError(
+                'Se pueden enviar como máximo %d sobres.' % settings.CHAT_GROUP_MAX_MEMBERS)
+        if len({sobre['id_usuario'] for sobre in value}) != len(value):
+            raise serializers.ValidationError('Cada usuario debe recibir un solo sobre.')
+        return value
+
+
+class MailboxSerializer(serializers.Serializer):
+    id_dispositivo = serializers.IntegerField()
+    after = serializers.IntegerField(required=False, default=0, min_value=0)
+    limit = serializers.IntegerField(required=False, min_value=1)
+
+    def validate_limit(self, value):
+        return min(value, settings.MAILBOX_MAX_LIMIT)
+
+
+class MailboxAckSerializer(serializers.Serializer):
+    id_dispositivo = serializers.IntegerField()
+    desde = serializers.IntegerField(required=False, default=0, min_value=0)
+    hasta = serializers.IntegerField(min_value=1)
+
+    def validate(self, data):
+        if data['desde'] > data['hasta']:
+            raise serializers.ValidationError('desde no puede ser mayor que hasta.')
+        return data
+
+
+class CreateAttachmentSerializer(serializers.Serializer):
+    id_chat = serializers.IntegerField()
+    tamano = serializers.IntegerField(min_value=1)
+
+    def validate_tamano(self, value):
+        if value > settings.ATTACHMENT_MAX_SIZE:
+            raise serializers.ValidationError(
+                'El adjunto no puede superar los %d bytes.' % settings.ATTACHMENT_MAX_SIZE)
+        return value
+
+
+class AttachmentSerializer(serializers.Serializer):
+    id_adjunto = serializers.IntegerField()
+
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def encode_inbox_cursor(chat):
+    """
+    Position of ``chat`` in the inbox order (fecha_hora_creacion, id), as an opaque
+    '<microseconds since epoch>_<id>' string that is safe in a query string.
+    """
+    delta = chat.fecha_hora_creacion - EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+    return '%d_%d' % (micros, chat.id)
+
+
+class InboxCursorField(serializers.CharField):
+    def to_internal_value(self, data):
+        try:
+            micros, id_chat = str(data).split('_')
+            return EPOCH + datetime.timedelta(microseconds=int(micros)), int(id_chat)
+        except (TypeError, ValueError, OverflowError):
+            raise serializers.ValidationError('Cursor inválido.')
+
+
+class ChatInboxSerializer(serializers.Serializer):
+    ESTADOS = ('todos', 'pendientes', 'activos')
+
+    estado = serializers.ChoiceField(choices=ESTADOS, required=False, default='todos')
+    before = InboxCursorField(required=False)
+    limit = serializers.IntegerField(required=False, min_value=1)
+
+    def validate_limit(self, value):
+        return min(value, settings.CHAT_INBOX_MAX_LIMIT)
+
+
+class InboxChatSerializer(serializers.ModelSerializer):
+    """
+    A chat as seen by ``context['user']``: the other participant is the ``contacto``.
+    """
+    id_chat = serializers.IntegerField(source='id')
+    rol = serializers.SerializerMethodField()
+    contacto = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Chat
+        fields = ('id_chat', 'rol', 'contacto', 'aceptado', 'fecha_hora_creacion', 'ultimo_seq')
+
+    def get_rol(self, chat):
+        return 'hasta' if chat.user_hasta_id == self.context['user'].pk else 'desde'
+
+    def get_contacto(self, chat):
+        contacto = chat.user_desde if self.get_rol(chat) == 'hasta' else chat.user_hasta
+        if contacto is None:
+            return None
+        return {'id': contacto.pk, 'phone': contacto.phone, 'name': contacto.name}
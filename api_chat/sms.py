@@ -0,0 +1,138 @@
+"""
+Pluggable SMS backends, selected with settings.SMS_BACKEND in the same way
+django.core.mail selects EMAIL_BACKEND.
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from api_chat import metrics
+
+# Messages sent through LocMemBackend, like django.core.mail.outbox.
+outbox = []
+
+
+class SMSTransientError(Exception):
+    """
+    The message could not be sent but may succeed if retried (network error, 5xx, 429).
+    """
+
+
+class BaseSMSBackend:
+    def send_message(self, to, body):
+        raise NotImplementedError('subclasses of BaseSMSBackend must override send_message()')
+
+    def send_messages(self, messages):
+        """
+        Sends a burst of ``(to, body)`` messages concurrently, with at most
+        settings.SMS_MAX_IN_FLIGHT requests in flight. Returns one result per message in
+        the same order; a failed message yields its exception instead of raising.
+        """
+        def send(message):
+            try:
+                return self.send_message(*message)
+            except Exception as exc:
+                return exc
+
+        messages = list(messages)
+        if len(messages) <= 1:
+            return [send(message) for message in messages]
+        workers = min(settings.SMS_MAX_IN_FLIGHT, len(messages))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sms') as executor:
+            return list(executor.map(send, messages))
+
+
+class TwilioBackend(BaseSMSBackend):
+    """
+    Sends through one Twilio client per process. Its requests session keeps
+    connections alive, so consecutive messages skip the TCP and TLS handshake.
+    """
+    _client = None
+    _client_lock = threading.Lock()
+
+    @classmethod
+    def get_client(cls):
+        if cls._client is None:
+            with cls._client_lock:
+                if cls._client is None:
+                    cls._client = cls.build_client()
+        return cls._client
+
+    @classmethod
+    def build_client(cls):
+        from requests.adapters import HTTPAdapter
+        from twilio.http.http_client import TwilioHttpClient
+        from twilio.rest import Client
+
+        http_client = TwilioHttpClient(pool_connections=True, timeout=settings.SMS_TIMEOUT)
+        # Enough pooled connections for every concurrent sender of send_messages().
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.SMS_MAX_IN_FLIGHT)
+        http_client.session.mount('https://', adapter)
+        http_client.session.mount('http://', adapter)
+
+        client = Client(settings.ACCOUNT_SID, settings.AUTH_TOKEN, http_client=http_client)
+        if settings.TWILIO_API_BASE_URL:
+            client.api.base_url = settings.TWILIO_API_BASE_URL
+        return client
+
+    @classmethod
+    def reset_client(cls):
+        cls._client = None
+
+    def send_message(self, to, body):
+        from requests.exceptions import RequestException
+        from twilio.base.exceptions import TwilioRestException
+
+        client = self.get_client()
+        start = time.perf_counter()
+        outcome = 'error'
+        try:
+            sid = client.messages.create(body=body, from_=settings.PHONE_NUMBER, to=to).sid
+            outcome = 'sent'
+            return sid
+        except TwilioRestException as exc:
+            if exc.status == 429 or exc.status >= 500:
+                outcome = 'transient'
+                raise SMSTransientError(str(exc)) from exc
+            raise
+        except RequestException as exc:
+            outcome = 'transient'
+            raise SMSTransientError(str(exc)) from exc
+        finally:
+            metrics.sms_duration.observe(time.perf_counter() - start, outcome)
+
+
+class LocMemBackend(BaseSMSBackend):
+    """
+    Keeps sent messages in ``api_chat.sms.outbox`` instead of sending them.
+    """
+
+    def send_message(self, to, body):
+        outbox.append({'to': to, 'body': body})
+        return str(len(outbox))
+
+
+class FileBackend(BaseSMSBackend):
+    """
+    Appends sent messages as JSON lines to settings.SMS_FILE_PATH.
+    """
+    _lock = threading.Lock()
+
+    def send_message(self, to, body):
+        with self._lock, open(settings.SMS_FILE_PATH, 'a') as f:
+            f.write(json.dumps({'to': to, 'body': body}) + '\n')
+        return None
+
+
+# A forked celery worker must not share the parent's pooled sockets.
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=TwilioBackend.reset_client)
+
+
+def get_backend(backend=None):
+    return import_string(backend or settings.SMS_BACKEND)()
@@ -0,0 +1,161 @@
+import datetime
+import json
+import logging
+
+from celery import shared_task
+from django.conf import settings
+
+from api_chat import attachments, images
+from api_chat.authentication import delete_expired_tokens
+from api_chat.models import Envelope
+from api_chat.redis_client import get_redis_connection
+from api_chat.sms import SMSTransientError, get_backend
+
+logger = logging.getLogger(__name__)
+
+# Redis list of the [to, body] messages waiting for flush_sms_buffer.
+SMS_BUFFER_KEY = 'sms:buffer'
+
+
+@shared_task(autoretry_for=(SMSTransientError,), retry_backoff=True,
+             retry_backoff_max=settings.SMS_RETRY_BACKOFF_MAX, retry_jitter=True,
+             max_retries=settings.SMS_MAX_RETRIES)
+def send_sms(to, body):
+    """
+    Sends one SMS through the configured backend, retrying transient failures with
+    exponential backoff.
+    """
+    return get_backend().send_message(to, body)
+
+
+@shared_task
+def send_sms_batch(messages):
+    """
+    Sends a burst of ``[to, body]`` messages concurrently through the configured backend.
+    Messages that fail transiently are re-queued one by one on send_sms, so they get its
+    retries and backoff.
+    """
+    messages = [tuple(message) for message in messages]
+    results = get_backend().send_messages(messages)
+    sent = 0
+    for message, result in zip(messages, results):
+        if isinstance(result, SMSTransientError):
+            send_sms.delay(*message)
+        elif not isinstance(result, Exception):
+            sent += 1
+    return sent
+
+
+
+# Set while a flush_sms_buffer task is scheduled or running, so a burst schedules only one;
+# it expires after SMS_BATCH_FLUSH_TIMEOUT seconds, in case the task is lost.
+SMS_FLUSH_KEY = 'sms:flush_scheduled'
+# Messages taken from the buffer by the running flush, removed once sent.
+SMS_PROCESSING_KEY = 'sms:processing'
+# Moves up to ARGV[1] messages from the buffer (KEYS[1]) to the processing list (KEYS[2])
+# and returns them.
+CLAIM_SMS_SCRIPT = """
+    local messages = redis.call('LRANGE', KEYS[1], 0, ARGV[1] - 1)
+    redis.call('LTRIM', KEYS[1], #messages, -1)
+    for _, message in ipairs(messages) do
+        redis.call('RPUSH', KEYS[2], message)
+    end
+    return messages
+"""
+
+
+def schedule_sms_flush(redis):
+    """Schedules a flush_sms_buffer task unless one is already scheduled or running."""
+    if redis.set(SMS_FLUSH_KEY, 1, nx=True, ex=settings.SMS_BATCH_FLUSH_TIMEOUT):
+        try:
+            flush_sms_buffer.apply_async(countdown=settings.SMS_BATCH_WINDOW)
+        except Exception:
+            redis.delete(SMS_FLUSH_KEY)
+            raise
+
+
+def enqueue_sms(to, body):
+    """
+    Queues one SMS. With redis, messages queued within SMS_BATCH_WINDOW seconds of each
+    other are buffered and sent together by one flush_sms_buffer task through
+    send_sms_batch, so a burst of OTPs costs one task and concurrent gateway requests
+    instead of a task per message. Without redis, or with SMS_BATCH_WINDOW at 0, each
+    message gets its own send_sms task.
+    """
+    redis = get_redis_connection()
+    if redis is None or settings.SMS_BATCH_WINDOW <= 0:
+        send_sms.delay(to, body)
+        return
+    try:
+        redis.rpush(SMS_BUFFER_KEY, json.dumps([to, body]))
+    except Exception:
+        logger.exception('No se pudo agrupar el SMS para %s, se envía solo', to)
+        send_sms.delay(to, body)
+        return
+    try:
+        schedule_sms_flush(redis)
+    except Exception:
+        # The message is buffered: the flush scheduled for the next one will send it.
+        logger.exception('No se pudo programar el envío de los SMS agrupados')
+
+
+@shared_task
+def flush_sms_buffer():
+    """
+    Sends up to SMS_BATCH_MAX_SIZE buffered messages with send_sms_batch, and schedules
+    another flush while messages remain.
+
+    The messages stay in a processing list until sent, so the ones of a flush that died
+    while sending are sent by the next flush (at least once, never lost).
+    """
+    redis = get_redis_connection()
+    messages = redis.lrange(SMS_PROCESSING_KEY, 0, -1)
+    if messages:
+        logger.warning('Reenviando %d SMS de un envío agrupado interrumpido', len(messages))
+    else:
+        messages = redis.register_script(CLAIM_SMS_SCRIPT)(
+            keys=[SMS_BUFFER_KEY, SMS_PROCESSING_KEY], args=[settings.SMS_BATCH_MAX_SIZE])
+    sent = send_sms_batch([json.loads(message) for message in messages]) if messages else 0
+    redis.delete(SMS_PROCESSING_KEY)
+    # Cleared before looking at the buffer, so a message pushed meanwhile either is seen
+    # here or schedules its own flush.
+    redis.delete(SMS_FLUSH_KEY)
+    if redis.llen(SMS_BUFFER_KEY):
+        schedule_sms_flush(redis)
+    return sent
+
+@shared_task
+def clear_expired_tokens():
+    """
+    Periodic sweep of expired knox tokens, scheduled by celery beat every
+    TOKEN_SWEEP_INTERVAL seconds.
+    """
+    return delete_expired_tokens(settings.TOKEN_SWEEP_BATCH_SIZE, settings.TOKEN_SWEEP_MAX_BATCHES or None)
+
+
+@shared_task
+def evict_mailboxes():
+    """
+    Periodic eviction of mailbox envelopes never acknowledged: the ones older than
+    MAILBOX_MAX_AGE_DAYS, then the oldest of every device holding more than
+    MAILBOX_MAX_ENVELOPES. Scheduled by celery beat every MAILBOX_EVICTION_INTERVAL seconds.
+    """
+    expired = Envelope.objects.evict_expired(datetime.timedelta(days=settings.MAILBOX_MAX_AGE_DAYS))
+    return expired + Envelope.objects.evict_overflow(settings.MAILBOX_MAX_ENVELOPES)
+
+
+@shared_task
+def abort_stale_uploads():
+    """
+    Periodic abort of the attachment uploads left incomplete for ATTACHMENT_UPLOAD_TTL
+    seconds, scheduled by celery beat every ATTACHMENT_SWEEP_INTERVAL seconds.
+    """
+    return attachments.abort_stale_uploads(datetime.timedelta(seconds=settings.ATTACHMENT_UPLOAD_TTL))
+
+
+@shared_task
+def generate_profile_variants(profile_id):
+    """
+    Makes the resized WebP variants of the image of a profile, queued when it changes.
+    """
+    return images.generate_profile_variants(profile_id)
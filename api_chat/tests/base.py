@@ -0,0 +1,77 @@
+"""
+Base of the api_chat test cases: SMS kept in memory, OTP state in the ORM store, no
+throttle rates and celery tasks executed inline, like the flow of check_query_budgets.
+"""
+import json
+from contextlib import contextmanager
+
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from knox.models import AuthToken
+
+from ChatEncriptado.celery import app as celery_app
+from api_chat.management.commands._flow import _without_throttle_rates, count_queries
+from api_chat.models import Chat, ChatMember, User
+
+PASSWORD = 'Prueba-Segura-2022'
+
+
+@override_settings(SMS_BACKEND='api_chat.sms.LocMemBackend',
+                   OTP_STORE='api_chat.otp_store.ORMOTPStore',
+                   REST_FRAMEWORK=_without_throttle_rates())
+class APITestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls._always_eager = celery_app.conf.task_always_eager
+        celery_app.conf.task_always_eager = True
+
+    @classmethod
+    def tearDownClass(cls):
+        celery_app.conf.task_always_eager = cls._always_eager
+        super().tearDownClass()
+
+    @staticmethod
+    def create_user(phone, password=PASSWORD, **extra_fields):
+        return User.objects.create_user(phone, password=password, **extra_fields)
+
+    @staticmethod
+    def create_chat(user_desde, user_hasta, aceptado=True):
+        return Chat.objects.create(user_desde=user_desde, user_hasta=user_hasta, aceptado=aceptado)
+
+    @staticmethod
+    def create_group(admin, *miembros, pendientes=()):
+        grupo = Chat.objects.create(tipo=Chat.GRUPO, nombre='Grupo', aceptado=True)
+        ChatMember.objects.create(chat=grupo, user=admin, rol=ChatMember.ADMIN, aceptado=True)
+        for user in miembros:
+            ChatMember.objects.create(chat=grupo, user=user, aceptado=True)
+        for user in pendientes:
+            ChatMember.objects.create(chat=grupo, user=user)
+        return grupo
+
+    @staticmethod
+    def create_token(user):
+        return AuthToken.objects.create(user)[1]
+
+    def api(self, method, name, data=None, token=None, query=None):
+        """
+        Calls /api/<name>/ with ``data`` as JSON body (as query string on GET, unless
+        ``query`` is False: validated_chat/ reads a body even on GET), authenticated with
+        ``token``.
+        """
+        headers = {'HTTP_AUTHORIZATION': 'Token %s' % token} if token else {}
+        path = '/api/%s/' % name
+        if query if query is not None else method == 'get':
+            return self.client.get(path, data or {}, **headers)
+        return self.client.generic(method.upper(), path, json.dumps(data or {}),
+                                   content_type='application/json', **headers)
+
+    @contextmanager
+    def assertMaxQueries(self, budget):
+        """Fails if the block runs more than ``budget`` queries, transaction control aside."""
+        with CaptureQueriesContext(connection) as captured:
+            yield
+        queries = count_queries(captured)
+        self.assertLessEqual(queries, budget, 'Query budget exceeded: %d > %d\n%s' % (
+            queries, budget, '\n'.join(query['sql'] for query in captured)))
@@ -0,0 +1,38 @@
+from django.test import SimpleTestCase
+
+from api_chat.attachments import missing_parts, part_count
+from api_chat.models import Attachment
+
+
+class PartCountTests(SimpleTestCase):
+    def test_rounds_up(self):
+        self.assertEqual(part_count(10, 5), 2)
+        self.assertEqual(part_count(11, 5), 3)
+
+    def test_smaller_than_a_part(self):
+        self.assertEqual(part_count(1, 5), 1)
+
+
+class MissingPartsTests(SimpleTestCase):
+    def setUp(self):
+        # Two full parts of 5 bytes and a last one of 2.
+        self.adjunto = Attachment(tamano=12, tamano_parte=5)
+
+    def test_all_parts_uploaded(self):
+        self.assertEqual(missing_parts(self.adjunto, {1: ('"a"', 5), 2: ('"b"', 5), 3: ('"c"', 2)}), [])
+
+    def test_absent_parts(self):
+        self.assertEqual(missing_parts(self.adjunto, {2: ('"b"', 5)}), [1, 3])
+        self.assertEqual(missing_parts(self.adjunto, {}), [1, 2, 3])
+
+    def test_parts_of_the_wrong_size(self):
+        self.assertEqual(missing_parts(self.adjunto, {1: ('"a"', 4), 2: ('"b"', 5), 3: ('"c"', 5)}), [1, 3])
+
+    def test_parts_beyond_the_last_are_ignored(self):
+        self.assertEqual(missing_parts(self.adjunto, {1: ('"a"', 5), 2: ('"b"', 5), 3: ('"c"', 2), 4: ('"d"', 5)}),
+                         [])
+
+    def test_exact_multiple_of_the_part_size(self):
+        adjunto = Attachment(tamano=10, tamano_parte=5)
+        self.assertEqual(missing_parts(adjunto, {1: ('"a"', 5), 2: ('"b"', 5)}), [])
+        self.assertEqual(missing_parts(adjunto, {1: ('"a"', 5), 2: ('"b"', 0)}), [2])
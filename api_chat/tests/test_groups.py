@@ -0,0 +1,66 @@
+from api_chat.models import ChatMember
+from api_chat.tests.base import APITestCase
+
+
+class GroupRulesTests(APITestCase):
+    def setUp(self):
+        self.admin = self.create_user('+51999999990')
+        self.primero = self.create_user('+51999999991')
+        self.segundo = self.create_user('+51999999992')
+        self.pendiente = self.create_user('+51999999993')
+        # The pending member is the oldest after the admin, but never accepted.
+        self.grupo = self.create_group(self.admin, pendientes=[self.pendiente])
+        for user in (self.primero, self.segundo):
+            ChatMember.objects.create(chat=self.grupo, user=user, aceptado=True)
+
+    def roles(self):
+        return dict(ChatMember.objects.filter(chat=self.grupo).values_list('user_id', 'rol'))
+
+    def invite(self, user, phone):
+        return self.api('post', 'group_members', {'id_chat': self.grupo.pk, 'phones_miembros': [phone]},
+                        self.create_token(user)).json()
+
+    def leave(self, user):
+        return self.api('post', 'left_group', {'id_chat': self.grupo.pk}, self.create_token(user)).json()
+
+    def test_admin_invites(self):
+        nuevo = self.create_user('+51999999994')
+        self.assertIs(self.invite(self.admin, nuevo.phone)['status'], True)
+        self.assertEqual(self.roles()[nuevo.pk], ChatMember.MIEMBRO)
+        self.assertFalse(ChatMember.objects.get(chat=self.grupo, user=nuevo).aceptado)
+
+    def test_only_admins_invite(self):
+        nuevo = self.create_user('+51999999994')
+        self.assertIs(self.invite(self.primero, nuevo.phone)['status'], False)
+        self.assertNotIn(nuevo.pk, self.roles())
+
+    def test_members_are_not_invited_twice(self):
+        response = self.invite(self.admin, self.segundo.phone)
+        self.assertIs(response['resultados'][0]['status'], False)
+        self.assertEqual(ChatMember.objects.filter(chat=self.grupo, user=self.segundo).count(), 1)
+
+    def test_last_admin_leaving_promotes_the_oldest_accepted_member(self):
+        self.assertIs(self.leave(self.admin)['status'], True)
+        roles = self.roles()
+        self.assertNotIn(self.admin.pk, roles)
+        self.assertEqual(roles, {self.primero.pk: ChatMember.ADMIN, self.segundo.pk: ChatMember.MIEMBRO,
+                                 self.pendiente.pk: ChatMember.MIEMBRO})
+
+    def test_admin_leaving_with_another_admin_promotes_nobody(self):
+        ChatMember.objects.filter(chat=self.grupo, user=self.segundo).update(rol=ChatMember.ADMIN)
+        self.leave(self.admin)
+        self.assertEqual(self.roles()[self.primero.pk], ChatMember.MIEMBRO)
+
+    def test_member_leaving_keeps_the_admin(self):
+        self.leave(self.primero)
+        self.assertEqual(self.roles(), {self.admin.pk: ChatMember.ADMIN, self.segundo.pk: ChatMember.MIEMBRO,
+                                        self.pendiente.pk: ChatMember.MIEMBRO})
+
+    def test_leaving_declines_a_pending_invitation(self):
+        self.assertIs(self.leave(self.pendiente)['status'], True)
+        self.assertNotIn(self.pendiente.pk, self.roles())
+
+    def test_leaving_a_group_of_which_one_is_not_member(self):
+        extrano = self.create_user('+51999999995')
+        self.assertIs(self.leave(extrano)['status'], False)
+        self.assertEqual(len(self.roles()), 4)
@@ -0,0 +1,47 @@
+from unittest import mock
+
+from django.core.files.storage import FileSystemStorage
+from django.test import SimpleTestCase, override_settings
+
+from api_chat import images
+from api_chat.models import Profile
+
+
+@override_settings(PROFILE_IMAGE_SIZES=[256, 64, 128], PROFILE_IMAGE_VARIANTS_LOCATION='variantes')
+class PickSizeTests(SimpleTestCase):
+    def test_smallest_size_that_fits(self):
+        self.assertEqual(images.pick_size(100), 128)
+        self.assertEqual(images.pick_size(1), 64)
+
+    def test_exact_size(self):
+        self.assertEqual(images.pick_size(128), 128)
+
+    def test_larger_than_every_size(self):
+        self.assertEqual(images.pick_size(1000), 256)
+
+
+@override_settings(PROFILE_IMAGE_SIZES=[64, 128, 256], PROFILE_IMAGE_VARIANTS_LOCATION='variantes')
+class VariantUrlTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(Profile._meta.get_field('image'), 'storage',
+                                    FileSystemStorage(base_url='/media/'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(images, '_storage', FileSystemStorage(base_url='/cdn/'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_without_image(self):
+        self.assertIsNone(images.variant_url(Profile(), 128))
+
+    def test_original_while_variants_are_not_ready(self):
+        self.assertEqual(images.variant_url(Profile(image='perfil.png'), 128), '/media/perfil.png')
+
+    def test_original_when_the_variants_are_of_a_previous_image(self):
+        profile = Profile(image='nueva.png', image_variants_of='perfil.png', image_digest='abc')
+        self.assertEqual(images.variant_url(profile, 128), '/media/nueva.png')
+
+    def test_variant_of_the_size_that_fits(self):
+        profile = Profile(image='perfil.png', image_variants_of='perfil.png', image_digest='abc')
+        self.assertEqual(images.variant_url(profile, 100), '/cdn/variantes/abc/128.webp')
+        self.assertEqual(images.variant_url(profile, 1000), '/cdn/variantes/abc/256.webp')
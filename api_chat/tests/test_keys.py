@@ -0,0 +1,33 @@
+from api_chat.models import OneTimePreKey
+from api_chat.tests.base import APITestCase
+
+
+class ClaimPreKeysTests(APITestCase):
+    def setUp(self):
+        self.alice = self.create_user('+51977777771')
+        self.bob = self.create_user('+51977777772')
+        self.carol = self.create_user('+51977777773')
+        OneTimePreKey.objects.bulk_create(
+            [OneTimePreKey(user=self.alice, key_id=key_id, public_key=b'alice %d' % key_id) for key_id in (7, 3, 5)]
+            + [OneTimePreKey(user=self.bob, key_id=1, public_key=b'bob 1')])
+
+    def test_claims_the_lowest_prekey_of_each_user(self):
+        claimed = OneTimePreKey.objects.claim([self.alice.pk, self.bob.pk])
+        self.assertEqual(claimed, {self.alice.pk: (3, b'alice 3'), self.bob.pk: (1, b'bob 1')})
+
+    def test_claimed_prekeys_are_deleted(self):
+        OneTimePreKey.objects.claim([self.alice.pk, self.bob.pk])
+        self.assertEqual(sorted(OneTimePreKey.objects.filter(user=self.alice).values_list('key_id', flat=True)), [5, 7])
+        self.assertFalse(OneTimePreKey.objects.filter(user=self.bob).exists())
+
+    def test_consecutive_claims_never_repeat_a_prekey(self):
+        claims = [OneTimePreKey.objects.claim([self.alice.pk])[self.alice.pk][0] for _ in range(3)]
+        self.assertEqual(claims, [3, 5, 7])
+        self.assertEqual(OneTimePreKey.objects.claim([self.alice.pk]), {})
+
+    def test_users_without_prekeys_are_missing(self):
+        claimed = OneTimePreKey.objects.claim([self.bob.pk, self.carol.pk, self.bob.pk])
+        self.assertEqual(claimed, {self.bob.pk: (1, b'bob 1')})
+
+    def test_no_users(self):
+        self.assertEqual(OneTimePreKey.objects.claim([]), {})
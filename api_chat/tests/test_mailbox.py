@@ -0,0 +1,86 @@
+from datetime import timedelta
+
+from django.utils import timezone
+
+from api_chat.models import Device, Envelope
+from api_chat.tests.base import APITestCase
+
+
+class MailboxFixture:
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user('+51988888880')
+        self.contacto = self.create_user('+51988888881')
+        self.chat = self.create_chat(self.user, self.contacto)
+        self.telefono = Device.objects.create(user=self.user, identificador='telefono')
+        self.tableta = Device.objects.create(user=self.user, identificador='tableta')
+        self.ajeno = Device.objects.create(user=self.contacto, identificador='telefono')
+
+    def send(self, device, count):
+        return [Envelope.objects.create(device=device, chat=self.chat, user_desde=self.contacto,
+                                        contenido=b'sobre').pk for _ in range(count)]
+
+    def remaining(self, device):
+        return list(Envelope.objects.filter(device=device).order_by('id').values_list('id', flat=True))
+
+
+class MailboxAckTests(MailboxFixture, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.token = self.create_token(self.user)
+
+    def ack(self, data):
+        return self.api('post', 'mailbox/ack', data, self.token).json()
+
+    def test_deletes_the_range(self):
+        ids = self.send(self.telefono, 5)
+        response = self.ack({'id_dispositivo': self.telefono.pk, 'desde': ids[1], 'hasta': ids[3]})
+        self.assertEqual(response['eliminados'], 3)
+        self.assertEqual(self.remaining(self.telefono), [ids[0], ids[4]])
+
+    def test_desde_defaults_to_the_start(self):
+        ids = self.send(self.telefono, 3)
+        self.assertEqual(self.ack({'id_dispositivo': self.telefono.pk, 'hasta': ids[1]})['eliminados'], 2)
+        self.assertEqual(self.remaining(self.telefono), [ids[2]])
+
+    def test_other_mailboxes_are_untouched(self):
+        self.send(self.telefono, 2)
+        tableta = self.send(self.tableta, 2)
+        self.assertEqual(self.ack({'id_dispositivo': self.telefono.pk, 'hasta': tableta[-1]})['eliminados'], 2)
+        self.assertEqual(self.remaining(self.telefono), [])
+        self.assertEqual(self.remaining(self.tableta), tableta)
+
+    def test_device_of_another_user(self):
+        ids = self.send(self.ajeno, 2)
+        response = self.ack({'id_dispositivo': self.ajeno.pk, 'hasta': ids[-1]})
+        self.assertIs(response['status'], False)
+        self.assertEqual(self.remaining(self.ajeno), ids)
+
+    def test_desde_after_hasta(self):
+        response = self.api('post', 'mailbox/ack', {'id_dispositivo': self.telefono.pk, 'desde': 5, 'hasta': 2},
+                            self.token)
+        self.assertEqual(response.status_code, 400)
+
+
+class EvictEnvelopesTests(MailboxFixture, APITestCase):
+    def test_evict_expired(self):
+        viejos = self.send(self.telefono, 3) + self.send(self.ajeno, 2)
+        Envelope.objects.filter(id__in=viejos).update(fecha_hora_creacion=timezone.now() - timedelta(days=31))
+        nuevos = self.send(self.telefono, 2)
+        self.assertEqual(Envelope.objects.evict_expired(timedelta(days=30), batch_size=2), 5)
+        self.assertEqual(self.remaining(self.telefono), nuevos)
+        self.assertEqual(self.remaining(self.ajeno), [])
+
+    def test_evict_overflow_keeps_the_newest(self):
+        telefono = self.send(self.telefono, 5)
+        tableta = self.send(self.tableta, 3)
+        self.assertEqual(Envelope.objects.evict_overflow(3), 2)
+        self.assertEqual(self.remaining(self.telefono), telefono[2:])
+        self.assertEqual(self.remaining(self.tableta), tableta)
+
+    def test_evict_overflow_of_several_mailboxes(self):
+        telefono = self.send(self.telefono, 4)
+        ajeno = self.send(self.ajeno, 6)
+        self.assertEqual(Envelope.objects.evict_overflow(2), 6)
+        self.assertEqual(self.remaining(self.telefono), telefono[2:])
+        self.assertEqual(self.remaining(self.ajeno), ajeno[4:])
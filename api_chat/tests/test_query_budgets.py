@@ -0,0 +1,282 @@
+"""
+Query budget of every endpoint: each test fails if its request runs more queries than
+the budget, which catches an N+1 or a lost select_related before it ships. The listings
+and batches are measured with several rows, so a budget that grows with them fails.
+"""
+import base64
+import re
+from unittest import mock
+
+from django.db import connection
+from django.test import Client
+
+from api_chat import attachments, sms
+from api_chat.management.commands._flow import HandshakeFlow
+from api_chat.management.commands.check_query_budgets import QUERY_BUDGETS
+from api_chat.models import Attachment, ChatMember, Device, Envelope, KeyBundle, Message, OneTimePreKey
+from api_chat.otp_store import get_otp_store
+from api_chat.tests.base import PASSWORD, APITestCase
+
+
+def b64(data):
+    return base64.b64encode(data).decode()
+
+
+class HandshakeQueryBudgetTests(APITestCase):
+    def test_flow(self):
+        token_hasta = HandshakeFlow.create_receiver('+51900000002')
+        flow = HandshakeFlow(Client(), '+51900000001', '+51900000002', token_hasta)
+        for result in flow.run():
+            with self.subTest(endpoint=result.name):
+                self.assertLessEqual(result.queries, QUERY_BUDGETS[result.name])
+
+
+class AccountQueryBudgetTests(APITestCase):
+    phone = '+51911111111'
+
+    def setUp(self):
+        self.user = self.create_user(self.phone, name='Cuenta')
+
+    def request_forgot_otp(self):
+        self.api('post', 'validate_phone_forgot', {'phone': self.phone})
+        return re.search(r'(\d+)\.$', sms.outbox.pop()['body']).group(1)
+
+    def test_validate_phone_forgot(self):
+        with self.assertMaxQueries(3):
+            response = self.api('post', 'validate_phone_forgot', {'phone': self.phone})
+        self.assertIs(response.json()['status'], True)
+
+    def test_forgot_validate_otp(self):
+        otp = self.request_forgot_otp()
+        with self.assertMaxQueries(3):
+            response = self.api('post', 'forgot_validate_otp', {'phone': self.phone, 'otp': otp})
+        self.assertIs(response.json()['status'], True)
+
+    def test_forget_psw_change(self):
+        otp = self.request_forgot_otp()
+        self.api('post', 'forgot_validate_otp', {'phone': self.phone, 'otp': otp})
+        with self.assertMaxQueries(6):
+            response = self.api('post', 'forget_psw_change',
+                                {'phone': self.phone, 'otp': otp, 'password': 'Nueva-Clave-2022'})
+        self.assertIs(response.json()['status'], True)
+        self.assertIsNone(get_otp_store().get(self.phone))
+
+    def test_change_psw_api(self):
+        token = self.create_token(self.user)
+        with self.assertMaxQueries(3):
+            response = self.api('put', 'change_psw_api', {'password_1': PASSWORD, 'password_2': 'Nueva-Clave-2022'},
+                                token)
+        self.assertIs(response.json()['status'], True)
+
+    def test_logout(self):
+        token = self.create_token(self.user)
+        with self.assertMaxQueries(4):
+            response = self.api('post', 'logout', token=token)
+        self.assertEqual(response.status_code, 204)
+
+
+class ChatQueryBudgetTests(APITestCase):
+    def setUp(self):
+        self.user = self.create_user('+51922222220')
+        self.token = self.create_token(self.user)
+        self.contactos = [self.create_user('+5192222222%d' % i) for i in range(1, 6)]
+        self.chats = [self.create_chat(self.user, contacto) for contacto in self.contactos]
+        for chat in self.chats:
+            for i in range(3):
+                Message.objects.create_next(chat.pk, self.user, b'cifrado %d' % i)
+
+    def test_validated_chat(self):
+        token = self.create_token(self.contactos[0])
+        with self.assertMaxQueries(2):
+            response = self.api('get', 'validated_chat', {'id_chat': self.chats[0].pk}, token, query=False)
+        self.assertIs(response.json()['status'], True)
+
+    def test_created_chat_batch(self):
+        phones = [self.create_user('+5192222223%d' % i).phone for i in range(5)]
+        with self.assertMaxQueries(3):
+            response = self.api('post', 'created_chat_batch', {'phones_hasta': phones}, self.token)
+        self.assertIs(response.json()['status'], True)
+
+    def test_chat_inbox(self):
+        with self.assertMaxQueries(3):
+            response = self.api('get', 'chat_inbox', token=self.token)
+        self.assertEqual(len(response.json()['chats']), len(self.chats))
+
+    def test_chat_messages(self):
+        with self.assertMaxQueries(3):
+            response = self.api('get', 'chat_messages', {'id_chat': self.chats[0].pk}, self.token)
+        self.assertEqual(len(response.json()['mensajes']), 3)
+
+
+class GroupQueryBudgetTests(APITestCase):
+    def setUp(self):
+        self.admin = self.create_user('+51933333330')
+        self.token = self.create_token(self.admin)
+        self.miembros = [self.create_user('+5193333333%d' % i) for i in range(1, 5)]
+        self.grupo = self.create_group(self.admin, *self.miembros)
+
+    def test_created_group(self):
+        phones = [self.create_user('+5193333334%d' % i).phone for i in range(5)]
+        with self.assertMaxQueries(5):
+            response = self.api('post', 'created_group', {'nombre': 'Nuevo', 'phones_miembros': phones}, self.token)
+        self.assertIs(response.json()['status'], True)
+
+    def test_group_members_get(self):
+        with self.assertMaxQueries(3):
+            response = self.api('get', 'group_members', {'id_chat': self.grupo.pk}, self.token)
+        self.assertEqual(len(response.json()['miembros']), 5)
+
+    def test_group_members_post(self):
+        phones = [self.create_user('+5193333335%d' % i).phone for i in range(5)]
+        with self.assertMaxQueries(4):
+            response = self.api('post', 'group_members', {'id_chat': self.grupo.pk, 'phones_miembros': phones},
+                                self.token)
+        self.assertIs(response.json()['status'], True)
+
+    def test_authorized_group(self):
+        invitado = self.create_user('+51933333360')
+        ChatMember.objects.create(chat=self.grupo, user=invitado)
+        token = self.create_token(invitado)
+        with self.assertMaxQueries(2):
+            response = self.api('post', 'authorized_group', {'id_chat': self.grupo.pk}, token)
+        self.assertIs(response.json()['status'], True)
+
+    def test_left_group(self):
+        with self.assertMaxQueries(5):
+            response = self.api('post', 'left_group', {'id_chat': self.grupo.pk}, self.token)
+        self.assertIs(response.json()['status'], True)
+
+    def test_groups(self):
+        for i in range(3):
+            self.create_group(self.admin, *self.miembros)
+        with self.assertMaxQueries(2):
+            response = self.api('get', 'groups', token=self.token)
+        self.assertEqual(len(response.json()['grupos']), 4)
+
+
+class KeysQueryBudgetTests(APITestCase):
+    def setUp(self):
+        self.user = self.create_user('+51944444440')
+        self.token = self.create_token(self.user)
+
+    @staticmethod
+    def prekeys(first, count):
+        return [{'key_id': key_id, 'public_key': b64(bytes([5]) + bytes(32))} for key_id in range(first, first + count)]
+
+    def publish_keys(self, user):
+        KeyBundle.objects.create(user=user, identity_key=bytes(33), signed_prekey_id=1, signed_prekey=bytes(33),
+                                 signed_prekey_signature=bytes(64))
+        OneTimePreKey.objects.bulk_create(OneTimePreKey(user=user, key_id=key_id, public_key=bytes(33))
+                                          for key_id in range(3))
+
+    def test_keys(self):
+        with self.assertMaxQueries(6):
+            response = self.api('post', 'keys', {
+                'identity_key': b64(bytes([5]) + bytes(32)),
+                'signed_prekey_id': 1,
+                'signed_prekey': b64(bytes([5]) + bytes(32)),
+                'signed_prekey_signature': b64(bytes(64)),
+                'one_time_prekeys': self.prekeys(0, 10),
+            }, self.token)
+        self.assertEqual(response.json()['prekeys_disponibles'], 10)
+
+    def test_prekeys_get(self):
+        with self.assertMaxQueries(2):
+            response = self.api('get', 'prekeys', token=self.token)
+        self.assertIs(response.json()['status'], True)
+
+    def test_prekeys_post(self):
+        self.publish_keys(self.user)
+        with self.assertMaxQueries(4):
+            response = self.api('post', 'prekeys', {'one_time_prekeys': self.prekeys(10, 10)}, self.token)
+        self.assertEqual(response.json()['prekeys_disponibles'], 13)
+
+    def test_key_bundles(self):
+        usuarios = [self.create_user('+5194444445%d' % i) for i in range(5)]
+        for usuario in usuarios:
+            self.publish_keys(usuario)
+        # Postgres claims every prekey in one statement; sqlite runs a claim per user.
+        claim = 1 if connection.vendor == 'postgresql' else 2 * len(usuarios)
+        with self.assertMaxQueries(2 + claim):
+            response = self.api('post', 'key_bundles', {'ids_usuarios': [u.pk for u in usuarios]}, self.token)
+        self.assertEqual(len(response.json()['bundles']), len(usuarios))
+
+
+class MailboxQueryBudgetTests(APITestCase):
+    def setUp(self):
+        self.user = self.create_user('+51955555550')
+        self.token = self.create_token(self.user)
+        self.contacto = self.create_user('+51955555551')
+        self.chat = self.create_chat(self.user, self.contacto)
+        self.dispositivo = Device.objects.create(user=self.user, identificador='telefono')
+        Device.objects.bulk_create(Device(user=self.contacto, identificador='d%d' % i) for i in range(3))
+        Envelope.objects.bulk_create(Envelope(device=self.dispositivo, chat=self.chat, user_desde=self.contacto,
+                                              contenido=b'sobre') for _ in range(5))
+
+    def test_devices_get(self):
+        with self.assertMaxQueries(2):
+            response = self.api('get', 'devices', token=self.token)
+        self.assertEqual(len(response.json()['dispositivos']), 1)
+
+    def test_devices_post(self):
+        with self.assertMaxQueries(3):
+            response = self.api('post', 'devices', {'identificador': 'tableta'}, self.token)
+        self.assertIs(response.json()['status'], True)
+
+    def test_mailbox(self):
+        with self.assertMaxQueries(3):
+            response = self.api('get', 'mailbox', {'id_dispositivo': self.dispositivo.pk}, self.token)
+        self.assertEqual(len(response.json()['sobres']), 5)
+
+    def test_mailbox_send(self):
+        with self.assertMaxQueries(4):
+            response = self.api('post', 'mailbox/send', {
+                'id_chat': self.chat.pk, 'sobres': [{'id_usuario': self.contacto.pk, 'contenido': b64(b'hola')}],
+            }, self.token)
+        self.assertEqual(response.json()['sobres'], 3)
+
+    def test_mailbox_ack(self):
+        hasta = Envelope.objects.filter(device=self.dispositivo).order_by('id').values_list('id', flat=True)[3]
+        with self.assertMaxQueries(3):
+            response = self.api('post', 'mailbox/ack', {'id_dispositivo': self.dispositivo.pk, 'hasta': hasta},
+                                self.token)
+        self.assertEqual(response.json()['eliminados'], 4)
+
+
+@mock.patch.object(attachments, 'presign_parts', lambda key, upload_id, numbers: [
+    {'numero': number, 'url': 'https://s3/%s/%d' % (key, number)} for number in numbers])
+@mock.patch.object(attachments, 'presign_download', lambda key: 'https://s3/%s' % key)
+class AttachmentQueryBudgetTests(APITestCase):
+    def setUp(self):
+        self.user = self.create_user('+51966666660')
+        self.token = self.create_token(self.user)
+        self.chat = self.create_chat(self.user, self.create_user('+51966666661'))
+        self.adjunto = Attachment.objects.create(chat=self.chat, user=self.user, key='adjuntos/1/a', upload_id='u',
+                                                 tamano=2 * attachments.MIN_PART_SIZE,
+                                                 tamano_parte=attachments.MIN_PART_SIZE)
+        self.partes = {1: ('"e1"', attachments.MIN_PART_SIZE), 2: ('"e2"', attachments.MIN_PART_SIZE)}
+
+    def test_attachments(self):
+        with mock.patch.object(attachments, 'create_upload', return_value='upload'):
+            with self.assertMaxQueries(3):
+                response = self.api('post', 'attachments', {'id_chat': self.chat.pk, 'tamano': 1000}, self.token)
+        self.assertIs(response.json()['status'], True)
+
+    def test_attachment_parts(self):
+        with mock.patch.object(attachments, 'list_uploaded_parts', return_value={1: self.partes[1]}):
+            with self.assertMaxQueries(2):
+                response = self.api('get', 'attachment_parts', {'id_adjunto': self.adjunto.pk}, self.token)
+        self.assertEqual(response.json()['subidas'], [1])
+
+    def test_attachment_complete(self):
+        with mock.patch.object(attachments, 'list_uploaded_parts', return_value=self.partes), \
+                mock.patch.object(attachments, 'complete_upload'):
+            with self.assertMaxQueries(3):
+                response = self.api('post', 'attachment_complete', {'id_adjunto': self.adjunto.pk}, self.token)
+        self.assertIs(response.json()['status'], True)
+
+    def test_attachment_download(self):
+        Attachment.objects.filter(pk=self.adjunto.pk).update(estado=Attachment.COMPLETO)
+        with self.assertMaxQueries(2):
+            response = self.api('get', 'attachment_download', {'id_adjunto': self.adjunto.pk}, self.token)
+        self.assertIs(response.json()['status'], True)
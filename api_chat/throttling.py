@@ -0,0 +1,136 @@
+"""
+Sliding-window rate limiting for DRF views.
+
+Each throttle keeps the timestamps of the requests made in the last window: a sorted
+set per key in redis, updated by a Lua script so concurrent workers can not race past
+the limit, or an in-process log (per worker, meant for development) when REDIS_URL is
+not set.
+
+Views pick their rates with ``throttle_scope``; the rate for a throttle is read from
+REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'] under '<throttle_scope>_<throttle suffix>', e.g.
+'otp_phone'. A scope without a configured rate is not limited.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+from api_chat.redis_client import get_redis_connection
+from api_chat.utils import normalize_phone
+
+
+class SlidingWindowLimiter:
+    key_prefix = 'throttle:'
+    # Keys kept by the in-process log; the least recently used go first beyond it.
+    local_max_keys = 10000
+    # KEYS[1] = key; ARGV = now (ms), window (ms), limit, member.
+    # Returns 0 if the request is allowed, otherwise the ms until a slot frees up.
+    hit_script = """
+        local now = tonumber(ARGV[1])
+        local window = tonumber(ARGV[2])
+        redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, now - window)
+        if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[3]) then
+            redis.call('ZADD', KEYS[1], now, ARGV[4])
+            redis.call('PEXPIRE', KEYS[1], window)
+            return 0
+        end
+        local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+        return math.max(tonumber(oldest[2]) + window - now, 1)
+    """
+
+    def __init__(self):
+        self._script = None
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key, limit, window):
+        """
+        Records a request for ``key`` if fewer than ``limit`` were made in the last
+        ``window`` seconds. Returns the seconds to wait, or 0 if the request is allowed.
+        """
+        redis = get_redis_connection()
+        if redis is None:
+            return self._hit_local(key, limit, window)
+        if self._script is None:
+            self._script = redis.register_script(self.hit_script)
+        now = int(time.time() * 1000)
+        wait = self._script(keys=[self.key_prefix + key],
+                            args=[now, int(window * 1000), limit, '%s-%s' % (now, uuid.uuid4().hex)])
+        return int(wait) / 1000
+
+    def _hit_local(self, key, limit, window):
+        now = time.monotonic()
+        with self._lock:
+            hits = self._local.get(key)
+            if hits is None:
+                hits = self._local[key] = deque()
+                while len(self._local) > self.local_max_keys:
+                    self._local.popitem(last=False)
+            else:
+                self._local.move_to_end(key)
+            while hits and hits[0] <= now - window:
+                hits.popleft()
+            if len(hits) < limit:
+                hits.append(now)
+                return 0
+            return hits[0] + window - now
+
+
+limiter = SlidingWindowLimiter()
+
+
+class SlidingWindowThrottle(BaseThrottle):
+    suffix = None
+
+    def parse_rate(self, rate):
+        num, period = rate.split('/')
+        duration = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[period[0]]
+        return int(num), duration
+
+    def get_key(self, request, view):
+        raise NotImplementedError('subclasses of SlidingWindowThrottle must override get_key()')
+
+    def allow_request(self, request, view):
+        self.wait_time = None
+        scope = getattr(view, 'throttle_scope', None)
+        rate = api_settings.DEFAULT_THROTTLE_RATES.get('%s_%s' % (scope, self.suffix)) if scope else None
+        if rate is None:
+            return True
+        key = self.get_key(request, view)
+        if key is None:
+            return True
+
+        limit, window = self.parse_rate(rate)
+        self.wait_time = limiter.hit('%s_%s:%s' % (scope, self.suffix, key), limit, window)
+        return not self.wait_time
+
+    def wait(self):
+        return self.wait_time
+
+
+class PhoneRateThrottle(SlidingWindowThrottle):
+    """Limits requests per ``phone`` in the request body."""
+    suffix = 'phone'
+
+    def get_key(self, request, view):
+        phone = normalize_phone(request.data.get('phone'))
+        return phone or None
+
+
+class IPRateThrottle(SlidingWindowThrottle):
+    """Limits requests per client ip (see REST_FRAMEWORK['NUM_PROXIES'])."""
+    suffix = 'ip'
+
+    def get_key(self, request, view):
+        return self.get_ident(request)
+
+
+class TokenRateThrottle(SlidingWindowThrottle):
+    """Limits requests per knox token."""
+    suffix = 'token'
+
+    def get_key(self, request, view):
+        return getattr(request.auth, 'token_key', None)
@@ -1,23 +1,54 @@
+from django.conf import settings
 from django.urls import re_path
-from knox import views as knox_views
 from api_chat.views import ValidateOTP, Register, LoginAPI, CreateChat, ValidateChat, \
     ForgotValidateOTP, ValidatePhoneForgot, ChangePasswordAPI, ForgetPasswordChange, ValidatePhoneSendOTP, \
-    AuthorizedChat, ValidateChatAproved
+    AuthorizedChat, ValidateChatAproved, ValidateChatAprovedWait, ChatHistory, ChatInbox, \
+    CreateChatBatch, CreateChatAsync, ValidateChatAsync, AuthorizedChatAsync, ValidateChatAprovedAsync, \
+    LoginAsync, CreateGroup, GroupMembers, AuthorizedGroup, LeaveGroup, Groups, UploadKeys, UploadPreKeys, \
+    KeyBundles, Devices, Mailbox, MailboxSend, MailboxAck, Attachments, AttachmentParts, AttachmentComplete, \
+    AttachmentDownload, LogoutAPI, LogoutAllAPI
+
+# Login and the handshake endpoints are served by their async views when running under ASGI.
+if settings.ASYNC_VIEWS:
+    LoginAPI = LoginAsync
+    CreateChat, ValidateChat = CreateChatAsync, ValidateChatAsync
+    AuthorizedChat, ValidateChatAproved = AuthorizedChatAsync, ValidateChatAprovedAsync
 
 urlpatterns = [
-    re_path('^validate_send_otp/', ValidatePhoneSendOTP.as_view()),
-    re_path('^validate_otp/', ValidateOTP.as_view()),
-    re_path('^register/', Register.as_view()),
-    re_path("^login/$", LoginAPI.as_view()),
-    re_path("^logout/$", knox_views.LogoutView.as_view()),
-    re_path("^created_chat/", CreateChat.as_view()),
-    re_path("^validated_chat/", ValidateChat.as_view()),
-    re_path("^validate_phone_forgot/", ValidatePhoneForgot.as_view()),
-    re_path("^change_psw_api/", ChangePasswordAPI.as_view()),
-    re_path("^forget_psw_change/", ForgetPasswordChange.as_view()),
-    re_path("^forgot_validate_otp/", ForgotValidateOTP.as_view()),
-    re_path("^validate_phone_send_otp/", ValidatePhoneSendOTP.as_view()),
-    re_path("^authorized_chat/", AuthorizedChat.as_view()),
-    re_path("^validate_chat_aproved/", ValidateChatAproved.as_view()),
+    re_path('^validate_send_otp/', ValidatePhoneSendOTP.as_view(), name='validate_send_otp'),
+    re_path('^validate_otp/', ValidateOTP.as_view(), name='validate_otp'),
+    re_path('^register/', Register.as_view(), name='register'),
+    re_path("^login/$", LoginAPI.as_view(), name='login'),
+    re_path("^logout/$", LogoutAPI.as_view(), name='logout'),
+    re_path("^logoutall/$", LogoutAllAPI.as_view(), name='logoutall'),
+    re_path("^created_chat/", CreateChat.as_view(), name='created_chat'),
+    re_path("^created_chat_batch/", CreateChatBatch.as_view(), name='created_chat_batch'),
+    re_path("^validated_chat/", ValidateChat.as_view(), name='validated_chat'),
+    re_path("^validate_phone_forgot/", ValidatePhoneForgot.as_view(), name='validate_phone_forgot'),
+    re_path("^change_psw_api/", ChangePasswordAPI.as_view(), name='change_psw_api'),
+    re_path("^forget_psw_change/", ForgetPasswordChange.as_view(), name='forget_psw_change'),
+    re_path("^forgot_validate_otp/", ForgotValidateOTP.as_view(), name='forgot_validate_otp'),
+    re_path("^validate_phone_send_otp/", ValidatePhoneSendOTP.as_view(), name='validate_phone_send_otp'),
+    re_path("^authorized_chat/", AuthorizedChat.as_view(), name='authorized_chat'),
+    re_path("^validate_chat_aproved/wait/", ValidateChatAprovedWait.as_view(), name='validate_chat_aproved_wait'),
+    re_path("^validate_chat_aproved/", ValidateChatAproved.as_view(), name='validate_chat_aproved'),
+    re_path("^chat_messages/", ChatHistory.as_view(), name='chat_messages'),
+    re_path("^chat_inbox/", ChatInbox.as_view(), name='chat_inbox'),
+    re_path("^created_group/", CreateGroup.as_view(), name='created_group'),
+    re_path("^group_members/", GroupMembers.as_view(), name='group_members'),
+    re_path("^authorized_group/", AuthorizedGroup.as_view(), name='authorized_group'),
+    re_path("^left_group/", LeaveGroup.as_view(), name='left_group'),
+    re_path("^groups/", Groups.as_view(), name='groups'),
+    re_path("^keys/", UploadKeys.as_view(), name='keys'),
+    re_path("^prekeys/", UploadPreKeys.as_view(), name='prekeys'),
+    re_path("^key_bundles/", KeyBundles.as_view(), name='key_bundles'),
+    re_path("^devices/", Devices.as_view(), name='devices'),
+    re_path("^mailbox/$", Mailbox.as_view(), name='mailbox'),
+    re_path("^mailbox/send/", MailboxSend.as_view(), name='mailbox_send'),
+    re_path("^mailbox/ack/", MailboxAck.as_view(), name='mailbox_ack'),
+    re_path("^attachments/", Attachments.as_view(), name='attachments'),
+    re_path("^attachment_parts/", AttachmentParts.as_view(), name='attachment_parts'),
+    re_path("^attachment_complete/", AttachmentComplete.as_view(), name='attachment_complete'),
+    re_path("^attachment_download/", AttachmentDownload.as_view(), name='attachment_download'),
 
 ]
@@ -1,81 +1,69 @@
 import string
-from django.utils.text import slugify
+from django.conf import settings
+from django.core.validators import RegexValidator
 import re
-import random
+import secrets
 from base64 import b64encode
 
-Dont_use = ['create']
-
 
 def random_string_generator(size=5, chars=string.ascii_lowercase + string.digits):
-    return ''.join(random.choice(chars) for _ in range(size))
-
-
-def unique_key_generator(instance):
-    size = random.randint(30, 45)
-    key = random_string_generator(size=size)
-
-    Klass = instance.__class__
-    qs_exists = Klass.objects.filter(key=key).exists()
-    if qs_exists:
-        return unique_key_generator(instance)
-    return key
-
-
-def unique_otp_generator(instance):
-    key = random.randint(1, 999999)
-    print(key)
-
-    Klass = instance.__class__
-    qs_exists = Klass.objects.filter(key=key).exists()
-    if qs_exists:
-        return unique_otp_generator(instance)
-    return key
-
-
-def unique_slug_generator(instance, new_slug=None):
-    if new_slug is not None:
-        slug = new_slug
-    else:
-        slug = slugify(instance.title)
-    if slug in Dont_use:
-        new_slug = "{slug} - {randstr}".format(
-            slug=slug,
-            randstr=random_string_generator(size=4)
-        )
-        return unique_slug_generator(instance, new_slug=new_slug)
-
-    klass = instance.__class__
-    qs_exists = klass.objects.filter(slug=slug).exists()
-    if qs_exists:
-        new_slug = "{slug} - {randstr}".format(
-            slug=slug,
-            randstr=random_string_generator(size=4)
-        )
-        return unique_slug_generator(instance, new_slug=new_slug)
-    return slug
-
-
-def unique_order_id_generator(instance):
-    new_id = random_string_generator()
-    k = instance.__class__
-    q = k.objects.filter(order_id=new_id).exists()
-    if q:
-        return unique_order_id_generator(instance)
-    return new_id
+    # One read of the CSPRNG per string instead of one per character: random bytes are
+    # mapped onto ``chars`` (at most 256 of them), dropping the bytes past the last whole
+    # multiple of len(chars) so every character stays equally likely.
+    base = len(chars)
+    limit = 256 - 256 % base
+    result = []
+    while len(result) < size:
+        result += [chars[byte % base] for byte in secrets.token_bytes(size) if byte < limit]
+    return ''.join(result[:size])
+
+
+def unique_key_generator(nbytes=32):
+    """
+    Random url-safe key of ``nbytes`` bytes of entropy (43 characters by default). With
+    256 bits a collision is not a practical concern, so no lookup is needed; a unique
+    constraint on the column still catches one.
+    """
+    return secrets.token_urlsafe(nbytes)
+
+
+E164_REGEX = re.compile(r'^\+[1-9]\d{7,14}$')
+# The field validator of every stored phone: the same check as phone_validator, on
+# phones already normalized.
+e164_validator = RegexValidator(
+    regex=E164_REGEX,
+    message="Phone number must be entered in E.164 format: '+<country code><number>'. Up to 15 digits allowed.")
+PHONE_SEPARATORS = re.compile(r'[\s\-().]')
+PHONE_DIGITS = re.compile(r'^\+?\d+$')
+
+
+def normalize_phone(phone_number):
+    """
+    Returns the phone number in E.164 format (+<country code><number>), the only form
+    stored in the database, so phones can be looked up with an exact match on the
+    unique index. Numbers of up to 10 digits without a country code are taken as
+    national numbers of settings.PHONE_DEFAULT_COUNTRY_CODE. Empty input is returned as is,
+    and anything that is not a number gets no country code, so phone_validator rejects it.
+    """
+    if not phone_number:
+        return phone_number
+    phone = PHONE_SEPARATORS.sub('', str(phone_number))
+    if not PHONE_DIGITS.match(phone):
+        return phone
+    if phone.startswith('00'):
+        phone = '+' + phone[2:]
+    if phone.startswith('+'):
+        return phone
+    if len(phone) <= 10:
+        return '+' + settings.PHONE_DEFAULT_COUNTRY_CODE + phone.lstrip('0')
+    return '+' + phone
 
 
 def phone_validator(phone_number):
     """
     Returns true if phone number is correct else false
     """
-    regix = r'^\+?1?\d{10}$'
-    com = re.compile(regix)
-    find = len(com.findall(phone_number))
-    if find == 1:
-        return True
-    else:
-        return False
+    return bool(phone_number) and E164_REGEX.match(str(normalize_phone(phone_number))) is not None
 
 
 def password_generator(length):
@@ -83,18 +71,20 @@ def password_generator(length):
     Generate fake password of passed length.
     """
     string = "abcdefghijklmnopqrstuvwxyz01234567890ABCDEFGHIJKLMNOPQRSTUVWXYZ!@#$%^&*()?"
-    password = "".join(random.sample(string, length))
-    return password
+    return random_string_generator(size=length, chars=string)
 
 
-def otp_generator():
-    otp = random.randint(999, 9999)
-    return otp
+def otp_generator(length=None):
+    """
+    Random OTP of ``length`` digits (settings.OTP_LENGTH by default) from the OS CSPRNG.
+    The first digit is never 0, so the code survives clients that send it as a number.
+    """
+    length = length or settings.OTP_LENGTH
+    low = 10 ** (length - 1)
+    return str(low + secrets.randbelow(9 * low))
 
 
 def unique_hex_generator(phone: str, password: str):
-    string = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz1234567890!@#$%^&*'
-    salt_int = str(random.randint(1, 999999999999))
-    salt_str = "".join([i for i in random.sample(string, random.randint(0, 70))])
-    byte_like = bytes(str(salt_int + salt_str + str(phone) + password).encode('utf-8'))
+    salt = secrets.token_urlsafe(secrets.randbelow(52) + 1)
+    byte_like = bytes(str(salt + str(phone) + password).encode('utf-8'))
     return b64encode(byte_like)
@@ -1,18 +1,45 @@
-from rest_framework import permissions, generics, status
+import asyncio
+import base64
+import heapq
+import json
+import logging
+from rest_framework import permissions, generics, status, exceptions
 from rest_framework.response import Response
 from django.contrib.auth import login
-from knox.auth import TokenAuthentication
-from knox.views import LoginView as KnoxLoginView
-from api_chat.utils import otp_generator
+from knox.views import LoginView as KnoxLoginView, LogoutView as KnoxLogoutView, \
+    LogoutAllView as KnoxLogoutAllView
+from api_chat import attachments
+from api_chat.utils import otp_generator, normalize_phone, phone_validator, unique_key_generator
 from .serializers import (CreateUserSerializer, ChangePasswordSerializer,
                           UserSerializer, LoginUserSerializer, ForgetPasswordSerializer,
-                          CreateChatSerializer, ValidateChatSerializer, AuthorizedChatSerializer)
-from api_chat.models import User, PhoneOTP, Chat
+                          CreateChatSerializer, CreateChatBatchSerializer, ValidateChatSerializer, AuthorizedChatSerializer,
+                          ChatLongPollSerializer,
+                          ChatHistorySerializer, MessageSerializer, ChatInboxSerializer,
+                          InboxChatSerializer, encode_inbox_cursor, LoginCredentialsSerializer,
+                          login_failed_error, CreateGroupSerializer, GroupMembersSerializer,
+                          ChatMemberSerializer, GroupSerializer, GroupsSerializer, UploadKeysSerializer,
+                          UploadPreKeysSerializer, KeyBundlesSerializer, DeviceSerializer,
+                          MailboxSendSerializer, MailboxSerializer, MailboxAckSerializer,
+                          CreateAttachmentSerializer, AttachmentSerializer)
+from rest_framework.serializers import as_serializer_error
+from api_chat.hashers import aauthenticate
+from api_chat.models import User, Chat, ChatMember, Message, KeyBundle, OneTimePreKey, Device, Envelope, Attachment
+from api_chat.otp_store import get_otp_store, OTP_VALID, OTP_EXPIRED, OTP_LOCKED
+from api_chat.throttling import PhoneRateThrottle, IPRateThrottle, TokenRateThrottle
 from django.shortcuts import get_object_or_404
+from django.db import transaction
 from django.db.models import Q
-from twilio.rest import Client
+from api_chat.tasks import enqueue_sms
 from django.conf import settings
-from api_chat.get_token import get_user_from_token
+from api_chat.authentication import CachedTokenAuthentication, cache_auth_token
+from api_chat.consumers import chat_group_name, notify_chat_accepted, anotify_chat_accepted, notify_member_removed, notify_envelopes
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.http import Http404, HttpResponse, JsonResponse
+from hmac import compare_digest
+from api_chat.metrics import registry
+from api_chat.routers import read_from_replica
+from django.views import View
 from rest_framework.views import APIView
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
@@ -24,6 +51,8 @@ from knox.models import AuthToken
 from django.contrib.auth.signals import user_logged_in
 from rest_framework.serializers import DateTimeField
 
+logger = logging.getLogger(__name__)
+
 class LoginView(APIView):
     authentication_classes = api_settings.DEFAULT_AUTHENTICATION_CLASSES
     permission_classes = (IsAuthenticated,)
@@ -67,48 +96,71 @@ class LoginView(APIView):
             ).data
         return data
 
-    def post(self, request, format=None):
+    def create_token(self, user):
+        '''
+        Returns a new ``(instance, token)`` for ``user``, or None if the user already has
+        TOKEN_LIMIT_PER_USER live tokens.
+        '''
         token_limit_per_user = self.get_token_limit_per_user()
         if token_limit_per_user is not None:
             now = timezone.now()
-            token = request.user.auth_token_set.filter(expiry__gt=now)
+            # Counts at most token_limit_per_user rows of the (user, expiry) index.
+            token = user.auth_token_set.filter(expiry__gt=now)[:token_limit_per_user]
             if token.count() >= token_limit_per_user:
-                return Response(
-                    {"error": "Maximum amount of tokens allowed per user exceeded."},
-                    status=status.HTTP_403_FORBIDDEN
-                )
+                return None
         token_ttl = self.get_token_ttl()
-        instance, token = AuthToken.objects.create(request.user, token_ttl)
-        user_logged_in.send(sender=request.user.__class__,
-                            request=request, user=request.user)
+        instance, token = AuthToken.objects.create(user, token_ttl)
+        # The client will use the token right away; save that first lookup.
+        cache_auth_token(instance)
+        return instance, token
+
+    def post(self, request, format=None):
+        created = self.create_token(request.user)
+        if created is None:
+            return Response(
+                {"error": "Maximum amount of tokens allowed per user exceeded."},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        instance, token = created
+        # user_logged_in was already sent by login() in LoginAPI; sending it again
+        # would update last_login a second time.
         data = self.get_post_response_data(request, token, instance)
         return Response(data)
 
 @method_decorator(csrf_exempt, name='dispatch')
 class LoginAPI(LoginView):
     permission_classes = (permissions.AllowAny,)
+    # Every attempt runs a full password hash, so it is throttled before authenticate().
+    throttle_classes = (PhoneRateThrottle, IPRateThrottle)
+    throttle_scope = 'login'
 
     def post(self, request, format=None):
         serializer = LoginUserSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         user = serializer.validated_data['user']
+        self.log_in(request, user)
+        return super().post(request, format=None)
+
+    @staticmethod
+    def log_in(request, user):
         if user.last_login is None:
             user.first_login = True
-            user.save()
+            user.save(update_fields=['first_login'])
 
         elif user.first_login:
             user.first_login = False
-            user.save()
+            user.save(update_fields=['first_login'])
 
         login(request, user)
-        print(request.user.name)
-        return super().post(request, format=None)
+        logger.debug('Login del usuario %s', user.pk)
 
 @method_decorator(csrf_exempt, name='dispatch')
 class UserAPI(generics.RetrieveAPIView):
-    authentication_classes = (TokenAuthentication,)
+    authentication_classes = (CachedTokenAuthentication,)
     permission_classes = [permissions.IsAuthenticated, ]
     serializer_class = UserSerializer
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'chat'
 
     def get_object(self):
         return self.request.user
@@ -118,9 +170,12 @@ class ChangePasswordAPI(generics.UpdateAPIView):
     """
     Change password endpoint view
     """
-    authentication_classes = (TokenAuthentication,)
+    authentication_classes = (CachedTokenAuthentication,)
     serializer_class = ChangePasswordSerializer
     permission_classes = [permissions.IsAuthenticated, ]
+    # Every request runs a full password hash.
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'account'
 
     def get_object(self, queryset=None):
         """
@@ -142,7 +197,7 @@ class ChangePasswordAPI(generics.UpdateAPIView):
 
             self.object.set_password(serializer.data.get('password_2'))
             self.object.password_changed = True
-            self.object.save()
+            self.object.save(update_fields=['password'])
             return Response({
                 "status": True,
                 "detail": "Password has been successfully changed.",
@@ -151,52 +206,51 @@ class ChangePasswordAPI(generics.UpdateAPIView):
         return Response(serializer.error, status=status.HTTP_400_BAD_REQUEST)
 
 
-def send_otp(phone):
+class LogoutAPI(KnoxLogoutView):
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'chat'
+
+
+class LogoutAllAPI(KnoxLogoutAllView):
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'chat'
+
+
+def send_otp(phone, otp_key):
     """
     This is an helper function to send otp to session stored phones or
     passed phone number as argument.
+    The SMS is queued on celery (batched with others of the same burst, see
+    enqueue_sms), so the request does not wait for the SMS gateway.
     """
 
     if phone:
-
-        key = otp_generator()
         phone = str(phone)
-        otp_key = str(key)
-
-        client = Client(settings.ACCOUNT_SID, settings.AUTH_TOKEN)
-        message = client.messages.create(
-            body=f'Buenos dias, tu código de verificación es: ' + str(otp_key) + '.',
-            from_='+14254753844',
-            to=phone
-        )
-        print(message)
-        return otp_key
+
+        body = f'Buenos dias, tu código de verificación es: ' + str(otp_key) + '.'
+        return queue_sms(phone, body)
     else:
         return False
 
 
-def send_otp_forgot(phone):
+def send_otp_forgot(phone, otp_key, name=None):
     if phone:
-        key = otp_generator()
         phone = str(phone)
-        otp_key = str(key)
-        user = get_object_or_404(User, phone__iexact=phone)
-        if user.name:
-            name = user.name
-        else:
+        if not name:
             name = phone
-        client = Client(settings.ACCOUNT_SID, settings.AUTH_TOKEN)
-        message = client.messages.create(
-            body=f'Buenos dias: ' + str(name) + ' tu código de verificación es: ' + str(otp_key) + '.',
-            from_='+14254753844',
-            to=phone
-        )
+        body = f'Buenos dias: ' + str(name) + ' tu código de verificación es: ' + str(otp_key) + '.'
+        return queue_sms(phone, body)
+    else:
+        return False
 
-        print(message)
 
-        return otp_key
-    else:
+def queue_sms(phone, body):
+    try:
+        enqueue_sms(phone, body)
+    except Exception:
+        logger.exception('No se pudo encolar el SMS para %s', phone)
         return False
+    return True
 
 
 ############################################################################################################################################################################################
@@ -207,43 +261,30 @@ class ValidatePhoneSendOTP(APIView):
     '''
     This class view takes phone number and if it doesn't exists already then it sends otp for
     first coming phone numbers'''
+    throttle_classes = (PhoneRateThrottle, IPRateThrottle)
+    throttle_scope = 'otp'
 
     def post(self, request, *args, **kwargs):
-        phone_number = request.data.get('phone')
-        if phone_number:
-            phone = str(phone_number)
-            user = User.objects.filter(phone__iexact=phone)
+        phone = normalize_phone(request.data.get('phone'))
+        if phone and not phone_validator(phone):
+            return Response({'status': False, 'detail': 'Phone number is not valid.'})
+        if phone:
+            user = User.objects.filter(phone=phone)
             if user.exists():
                 return Response({'status': False, 'detail': 'Phone Number already exists'})
                 # logic to send the otp and store the phone number and that otp in table.
             else:
-                otp = send_otp(phone)
-                print(phone, otp)
-                if otp:
-                    otp = str(otp)
-                    count = 0
-                    old = PhoneOTP.objects.filter(phone__iexact=phone)
-                    if old.exists():
-                        count = old.first().count
-                        old.first().count = count + 1
-                        old.first().save()
-
-                    else:
-                        count = count + 1
-
-                        PhoneOTP.objects.create(
-                            phone=phone,
-                            otp=otp,
-                            count=count
-
-                        )
-                    if count > 7:
-                        return Response({
-                            'status': False,
-                            'detail': 'Maximum otp limits reached. Kindly support our customer care or try with different number'
-                        })
-
+                otp = str(otp_generator())
+                # Checks the limit and counts this otp in one step, so concurrent requests
+                # can not send more than 7.
+                if get_otp_store().issue(phone, otp, max_count=7) is None:
+                    return Response({
+                        'status': False,
+                        'detail': 'Maximum otp limits reached. Kindly support our customer care or try with different number'
+                    })
 
+                if send_otp(phone, otp):
+                    logger.debug('OTP enviado a %s', phone)
                 else:
                     return Response({
                         'status': 'False', 'detail': "OTP sending error. Please try after some time."
@@ -257,35 +298,40 @@ class ValidatePhoneSendOTP(APIView):
                 'status': 'False', 'detail': "I haven't received any phone number. Please do a POST request."
             })
 
+def otp_failed_response(result):
+    if result == OTP_EXPIRED:
+        detail = 'OTP expired, please request a new otp'
+    elif result == OTP_LOCKED:
+        detail = 'Too many incorrect attempts, please request a new otp'
+    else:
+        detail = 'OTP incorrect, please try again'
+    return Response({'status': False, 'detail': detail})
+
+
 @method_decorator(csrf_exempt, name='dispatch')
 class ValidateOTP(APIView):
     '''
     If you have received otp, post a request with phone and that otp and you will be redirected to set the password
 
     '''
+    throttle_classes = (PhoneRateThrottle, IPRateThrottle)
+    throttle_scope = 'otp_verify'
 
     def post(self, request, *args, **kwargs):
-        phone = request.data.get('phone', False)
+        phone = normalize_phone(request.data.get('phone', False))
         otp_sent = request.data.get('otp', False)
 
         if phone and otp_sent:
-            old = PhoneOTP.objects.filter(phone__iexact=phone)
-            if old.exists():
-                old = old.first()
-                otp = old.otp
-                if str(otp) == str(otp_sent):
-                    old.logged = True
-                    old.save()
-
+            otp_store = get_otp_store()
+            old, result = otp_store.verify(phone, str(otp_sent))
+            if old is not None:
+                if result == OTP_VALID:
                     return Response({
                         'status': True,
                         'detail': 'OTP matched, kindly proceed to save password'
                     })
                 else:
-                    return Response({
-                        'status': False,
-                        'detail': 'OTP incorrect, please try again'
-                    })
+                    return otp_failed_response(result)
             else:
                 return Response({
                     'status': False,
@@ -304,33 +350,29 @@ class Register(APIView):
     '''Takes phone and a password and creates a new user only if otp was verified and phone is new'''
 
     def post(self, request, *args, **kwargs):
-        phone = request.data.get('phone', False)
+        phone = normalize_phone(request.data.get('phone', False))
         password = request.data.get('password', False)
         name = request.data.get('name', False)
 
         if phone and password:
-            phone = str(phone)
-            user = User.objects.filter(phone__iexact=phone)
+            user = User.objects.filter(phone=phone)
             if user.exists():
                 return Response({'status': False,
                                  'detail': 'Phone Number already have account associated. Kindly try forgot password'})
             else:
-                old = PhoneOTP.objects.filter(phone__iexact=phone)
-                if old.exists():
-                    old = old.first()
+                otp_store = get_otp_store()
+                old = otp_store.get(phone)
+                if old is not None:
                     if old.logged:
                         Temp_data = {'phone': phone, 'password': password}
+                        if name and len(name) > 0:
+                            Temp_data['name'] = name
 
                         serializer = CreateUserSerializer(data=Temp_data)
                         serializer.is_valid(raise_exception=True)
-                        if name and len(name) > 0:
-                            user.name = name
-                        user = serializer.save()
-
-                        user.name = name
-                        user.save()
+                        serializer.save()
 
-                        old.delete()
+                        otp_store.delete(phone)
                         return Response({
                             'status': True,
                             'detail': 'Congrats, user has been created successfully.'
@@ -362,43 +404,29 @@ class Register(APIView):
 class ValidatePhoneForgot(APIView):
     '''
     Validate if account is there for a given phone number and then send otp for forgot password reset'''
+    throttle_classes = (PhoneRateThrottle, IPRateThrottle)
+    throttle_scope = 'otp'
 
     def post(self, request, *args, **kwargs):
-        phone_number = request.data.get('phone')
-        if phone_number:
-            phone = str(phone_number)
-            user = User.objects.filter(phone__iexact=phone)
-            if user.exists():
-                otp = send_otp_forgot(phone)
-                print(phone, otp)
-                if otp:
-                    otp = str(otp)
-                    count = 0
-                    old = PhoneOTP.objects.filter(phone__iexact=phone)
-                    if old.exists():
-                        old = old.first()
-                        k = old.count
-                        if k > 10:
-                            return Response({
-                                'status': False,
-                                'detail': 'Maximum otp limits reached. Kindly support our customer care or try with different number'
-                            })
-                        old.count = k + 1
-                        old.save()
+        phone = normalize_phone(request.data.get('phone'))
+        if phone:
+            user = User.objects.filter(phone=phone).values('name').first()
+            if user is not None:
+                otp = str(otp_generator())
+                state = get_otp_store().issue(phone, otp, forgot=True, max_count=11)
+                if state is None:
+                    return Response({
+                        'status': False,
+                        'detail': 'Maximum otp limits reached. Kindly support our customer care or try with different number'
+                    })
 
+                if send_otp_forgot(phone, otp, user['name']):
+                    logger.debug('OTP enviado a %s', phone)
+                    if state.count > 1:
                         return Response(
                             {'status': True, 'detail': 'OTP has been sent for password reset. Limits about to reach.'})
 
                     else:
-                        count = count + 1
-
-                        PhoneOTP.objects.create(
-                            phone=phone,
-                            otp=otp,
-                            count=count,
-                            forgot=True,
-
-                        )
                         return Response({'status': True, 'detail': 'OTP has been sent for password reset'})
 
                 else:
@@ -417,35 +445,31 @@ class ForgotValidateOTP(APIView):
     If you have received an otp, post a request with phone and that otp and you will be redirected to reset  the forgotted password
 
     '''
+    throttle_classes = (PhoneRateThrottle, IPRateThrottle)
+    throttle_scope = 'otp_verify'
 
     def post(self, request, *args, **kwargs):
-        phone = request.data.get('phone', False)
+        phone = normalize_phone(request.data.get('phone', False))
         otp_sent = request.data.get('otp', False)
 
         if phone and otp_sent:
-            old = PhoneOTP.objects.filter(phone__iexact=phone)
-            if old.exists():
-                old = old.first()
+            otp_store = get_otp_store()
+            old = otp_store.get(phone)
+            if old is not None:
                 if old.forgot == False:
                     return Response({
                         'status': False,
                         'detail': 'This phone havenot send valid otp for forgot password. Request a new otp or contact help centre.'
                     })
 
-                otp = old.otp
-                if str(otp) == str(otp_sent):
-                    old.forgot_logged = True
-                    old.save()
-
+                old, result = otp_store.verify(phone, str(otp_sent), mark='forgot_logged')
+                if result == OTP_VALID:
                     return Response({
                         'status': True,
                         'detail': 'OTP matched, kindly proceed to create new password'
                     })
                 else:
-                    return Response({
-                        'status': False,
-                        'detail': 'OTP incorrect, please try again'
-                    })
+                    return otp_failed_response(result)
             else:
                 return Response({
                     'status': False,
@@ -464,29 +488,35 @@ class ForgetPasswordChange(APIView):
     '''
     if forgot_logged is valid and account exists then only pass otp, phone and password to reset the password. All three should match.APIView
     '''
+    throttle_classes = (PhoneRateThrottle, IPRateThrottle)
+    throttle_scope = 'otp_verify'
 
     def post(self, request, *args, **kwargs):
-        phone = request.data.get('phone', False)
+        phone = normalize_phone(request.data.get('phone', False))
         otp = request.data.get("otp", False)
         password = request.data.get('password', False)
 
         if phone and otp and password:
-            old = PhoneOTP.objects.filter(Q(phone__iexact=phone) & Q(otp__iexact=otp))
-            if old.exists():
-                old = old.first()
+            otp_store = get_otp_store()
+            # Same expiry and attempt limits as forgot_validate_otp; the flag it set is
+            # checked on the state as it was.
+            old, result = otp_store.verify(phone, str(otp), mark=None)
+            if result in (OTP_EXPIRED, OTP_LOCKED):
+                return otp_failed_response(result)
+            if result == OTP_VALID:
                 if old.forgot_logged:
                     post_data = {
                         'phone': phone,
                         'password': password
                     }
-                    user_obj = get_object_or_404(User, phone__iexact=phone)
+                    user_obj = get_object_or_404(User, phone=phone)
                     serializer = ForgetPasswordSerializer(data=post_data)
                     serializer.is_valid(raise_exception=True)
                     if user_obj:
                         user_obj.set_password(serializer.data.get('password'))
                         user_obj.active = True
                         user_obj.save()
-                        old.delete()
+                        otp_store.delete(phone)
                         return Response({
                             'status': True,
                             'detail': 'Password changed successfully. Please Login'
@@ -516,23 +546,18 @@ class ForgetPasswordChange(APIView):
 @method_decorator(csrf_exempt, name='dispatch')
 class CreateChat(APIView):
     permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'chat'
 
     def post(self, request, format=None):
 
         serializer = CreateChatSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        telefono_hasta = serializer.validated_data['phone_hasta']
-        consulta_usuario = User.objects.filter(phone__exact=telefono_hasta)
-        peticion = request.headers['Authorization']
-        last = peticion.rsplit(' ', 1)[-1]
+        telefono_hasta = normalize_phone(serializer.validated_data['phone_hasta'])
+        user_hasta = User.objects.filter(phone=telefono_hasta).first()
+        user_desde = request.user
 
-        user_desde = get_user_from_token(last)
-        # print(user_desde)
-
-        if len(consulta_usuario) >= 1:
-            user_hasta = consulta_usuario[0]
-
-        else:
+        if user_hasta is None:
 
             return Response({
                 'status': False,
@@ -551,33 +576,314 @@ class CreateChat(APIView):
             'nombre_destinatario': str(new_chat.user_hasta.name)
         })
 
+def resolve_phones(telefonos):
+    '''
+    Resolves ``telefonos`` to their users with a single query. Yields one
+    ``(telefono, user, detail)`` per number, in order: user is None for repeated and
+    unknown numbers, and detail tells which.
+    '''
+    normalizados = [normalize_phone(telefono) for telefono in telefonos]
+    users = {user.phone: user for user in User.objects.filter(
+        phone__in={telefono for telefono in normalizados if phone_validator(telefono)}
+    ).only('id', 'phone', 'name')}
+    vistos = set()
+    for telefono, normalizado in zip(telefonos, normalizados):
+        if normalizado in vistos:
+            yield telefono, None, 'El numero de telefono está repetido en la solicitud.'
+        elif normalizado not in users:
+            yield telefono, None, '¡El numero de telefono del destinatario no existe!'
+        else:
+            vistos.add(normalizado)
+            yield telefono, users[normalizado], None
+
+
 @method_decorator(csrf_exempt, name='dispatch')
-class ValidateChat(APIView):
+class CreateChatBatch(APIView):
+    '''
+    Batch variant of CreateChat: takes ``phones_hasta``, a list of up to CHAT_BATCH_MAX_SIZE
+    phone numbers, and opens a chat with each one that belongs to a user. Recipients are
+    resolved with a single query and the chats inserted with one bulk INSERT in a transaction.
+    ``resultados`` has one entry per number sent, in the same order.
+    '''
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'chat'
+
+    def post(self, request, format=None):
+        serializer = CreateChatBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        telefonos = serializer.validated_data['phones_hasta']
+
+        resultados = []
+        nuevos = []
+        for telefono, user_hasta, detail in resolve_phones(telefonos):
+            if user_hasta is None:
+                resultados.append({'phone_hasta': telefono, 'status': False, 'detail': detail})
+            else:
+                nuevos.append(Chat(user_desde=request.user, user_hasta=user_hasta))
+                resultados.append({'phone_hasta': telefono, 'chat': nuevos[-1]})
+
+        with transaction.atomic():
+            Chat.objects.bulk_create(nuevos)
+
+        for resultado in resultados:
+            chat = resultado.pop('chat', None)
+            if chat is not None:
+                resultado.update({
+                    'status': True,
+                    'id_conversacion': str(chat.pk),
+                    'id_destinatario': str(chat.user_hasta.pk),
+                    'nombre_destinatario': str(chat.user_hasta.name)
+                })
+
+        return Response({
+            'status': True,
+            'detail': 'Se crearon %d de %d chats.' % (len(nuevos), len(telefonos)),
+            'resultados': resultados,
+        })
+
+def add_group_members(grupo, telefonos, excluidos):
+    '''
+    Invites the users of ``telefonos`` to ``grupo``, except ``excluidos`` (ids of the
+    current members), with one bulk INSERT. Returns ``(invitados, resultados)``, with one
+    result per number in the order sent.
+    '''
+    resultados = []
+    nuevos = []
+    for telefono, user, detail in resolve_phones(telefonos):
+        if user is not None and user.pk in excluidos:
+            user, detail = None, 'El usuario ya es miembro del grupo.'
+        if user is None:
+            resultados.append({'phone_miembro': telefono, 'status': False, 'detail': detail})
+            continue
+        nuevos.append(ChatMember(chat=grupo, user=user))
+        resultados.append({'phone_miembro': telefono, 'status': True, 'id_usuario': str(user.pk),
+                           'nombre': str(user.name)})
+
+    if len(excluidos) + len(nuevos) > settings.CHAT_GROUP_MAX_MEMBERS:
+        raise exceptions.ValidationError(
+            {'phones_miembros': ['Un grupo puede tener como máximo %d miembros.' % settings.CHAT_GROUP_MAX_MEMBERS]})
+    # A concurrent invitation of the same user is skipped by the unique (chat, user) index.
+    ChatMember.objects.bulk_create(nuevos, ignore_conflicts=True)
+    return len(nuevos), resultados
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class CreateGroup(APIView):
+    '''
+    Creates a group conversation named ``nombre`` with the caller as its admin, and invites
+    the users of ``phones_miembros`` (up to CHAT_GROUP_MAX_MEMBERS), who join once they
+    accept it on authorized_group/. Members are resolved with one query and inserted with
+    one bulk INSERT.
+    '''
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'chat'
+
+    def post(self, request, format=None):
+        serializer = CreateGroupSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        with transaction.atomic():
+            # A group has no receiver to accept it: it is active from the start.
+            grupo = Chat.objects.create(tipo=Chat.GRUPO, nombre=serializer.validated_data['nombre'], aceptado=True)
+            ChatMember.objects.create(chat=grupo, user=request.user, rol=ChatMember.ADMIN, aceptado=True)
+            invitados, resultados = add_group_members(
+                grupo, serializer.validated_data['phones_miembros'], {request.user.pk})
+
+        return Response({
+            'status': True,
+            'detail': 'El grupo ha sido creado con %d invitados.' % invitados,
+            'id_conversacion': str(grupo.pk),
+            'resultados': resultados,
+        })
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class GroupMembers(APIView):
+    '''
+    GET ?id_chat=<id> lists the members of a group, to any of its members, with the url of
+    their avatar (?avatar_size=<px> picks its variant). POST with ``id_chat`` and
+    ``phones_miembros`` invites more users; only admins may.
+    '''
     permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'chat'
 
     def get(self, request, format=None):
+        serializer = ValidateChatSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)  # valida la estructura
+        id_chat = serializer.validated_data['id_chat']
 
-        serializer = ValidateChatSerializer(data=request.data)
+        if not ChatMember.objects.filter(chat_id=id_chat, user=request.user).exists():
+            return Response({
+                'status': False,
+                'detail': 'La conversación consultada no le corresponde.'
+            })
+
+        miembros = ChatMember.objects.filter(chat_id=id_chat).select_related('user__profile').only(
+            'user__name', 'user__profile__image', 'user__profile__image_variants_of', 'user__profile__image_digest',
+            'rol', 'aceptado', 'fecha_hora_union').order_by('id')
+        return Response({
+            'status': True,
+            'miembros': ChatMemberSerializer(miembros, many=True, context={'request': request}).data,
+        })
+
+    def post(self, request, format=None):
+        serializer = GroupMembersSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)  # valida la estructura
         id_chat = serializer.validated_data['id_chat']
-        consulta_chat = Chat.objects.filter(id__exact=id_chat)
-        peticion = request.headers['Authorization']
-        last = peticion.rsplit(' ', 1)[-1]
 
-        user_hasta = get_user_from_token(last)
+        with transaction.atomic():
+            miembros = dict(ChatMember.objects.select_for_update().filter(chat_id=id_chat).values_list('user_id', 'rol'))
+            if miembros.get(request.user.pk) != ChatMember.ADMIN:
+                return Response({
+                    'status': False,
+                    'detail': 'Solo un administrador del grupo puede invitar miembros.'
+                })
+            invitados, resultados = add_group_members(
+                Chat(pk=id_chat), serializer.validated_data['phones_miembros'], set(miembros))
+
+        return Response({
+            'status': True,
+            'detail': 'Se invitaron %d de %d usuarios.' % (invitados, len(resultados)),
+            'resultados': resultados,
+        })
 
-        if len(consulta_chat) >= 1:
-            chat = consulta_chat[0]
 
+@method_decorator(csrf_exempt, name='dispatch')
+class AuthorizedGroup(APIView):
+    '''Accepts the caller's invitation to the group ``id_chat``.'''
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'chat'
 
-        else:
+    def post(self, request, format=None):
+        serializer = AuthorizedChatSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)  # valida la estructura
+
+        if not ChatMember.objects.filter(chat_id=serializer.validated_data['id_chat'],
+                                         user=request.user).update(aceptado=True):
+            return Response({
+                'status': False,
+                'detail': 'No ha sido invitado a este grupo.'
+            })
+        return Response({
+            'status': True,
+            'detail': 'Se ha unido al grupo.'
+        })
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class LeaveGroup(APIView):
+    '''
+    Removes the caller from the group ``id_chat`` (also declines a pending invitation) and
+    closes their connections to it. When the last admin leaves, the oldest member that
+    accepted the invitation becomes admin.
+    '''
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'chat'
+
+    def post(self, request, format=None):
+        serializer = AuthorizedChatSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)  # valida la estructura
+        id_chat = serializer.validated_data['id_chat']
+
+        with transaction.atomic():
+            admins = list(ChatMember.objects.select_for_update().filter(
+                chat_id=id_chat, rol=ChatMember.ADMIN).values_list('user_id', flat=True))
+            if not ChatMember.objects.filter(chat_id=id_chat, user=request.user).delete()[0]:
+                return Response({
+                    'status': False,
+                    'detail': 'La conversación consultada no le corresponde.'
+                })
+            if admins == [request.user.pk]:
+                sucesor = ChatMember.objects.filter(chat_id=id_chat, aceptado=True).order_by('id').first()
+                if sucesor is not None:
+                    ChatMember.objects.filter(pk=sucesor.pk).update(rol=ChatMember.ADMIN)
+
+        notify_member_removed(id_chat, request.user.pk)
+        return Response({
+            'status': True,
+            'detail': 'Ha salido del grupo.'
+        })
+
+
+class Groups(APIView):
+    '''
+    The caller's groups, newest first: GET with ?before=<id_chat>&limit=<n>. Pass back
+    ``next_before`` to get the following page; each page is a range scan on the
+    (user, chat) index of the memberships.
+    '''
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'chat'
+
+    def get(self, request, format=None):
+        serializer = GroupsSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)  # valida la estructura
+        before = serializer.validated_data.get('before')
+        limit = serializer.validated_data.get('limit', settings.CHAT_INBOX_PAGE_SIZE)
+
+        miembros = ChatMember.objects.filter(user=request.user)
+        if before is not None:
+            miembros = miembros.filter(chat_id__lt=before)
+        # One extra row tells whether there is another page without a COUNT query.
+        miembros = list(miembros.select_related('chat').order_by('-chat')[:limit + 1])
+        has_more = len(miembros) > limit
+        miembros = miembros[:limit]
+
+        return Response({
+            'status': True,
+            'grupos': GroupSerializer(miembros, many=True).data,
+            'next_before': miembros[-1].chat_id if miembros else None,
+            'has_more': has_more,
+        })
+
+
+def replica_chat(queryset, id_chat):
+    '''
+    The chat ``id_chat`` read from a replica, or None. A chat the replica does not have
+    yet (it lags a little behind) is looked up again in the primary.
+    '''
+    with read_from_replica():
+        chat = queryset.filter(id=id_chat).first()
+    if chat is None and settings.DATABASE_REPLICAS:
+        chat = queryset.filter(id=id_chat).first()
+    return chat
+
+
+async def areplica_chat(queryset, id_chat):
+    with read_from_replica():
+        chat = await queryset.filter(id=id_chat).afirst()
+    if chat is None and settings.DATABASE_REPLICAS:
+        chat = await queryset.filter(id=id_chat).afirst()
+    return chat
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ValidateChat(APIView):
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'chat'
+
+    def get(self, request, format=None):
+
+        serializer = ValidateChatSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)  # valida la estructura
+        id_chat = serializer.validated_data['id_chat']
+        chat = replica_chat(Chat.objects.all(), id_chat)
+        user_hasta = request.user
+
+        if chat is None:
 
             return Response({
                 'status': False,
                 'detail': '¡La conversación no existe!'
             })
 
-        if user_hasta == chat.user_hasta:
+        if user_hasta.pk == chat.user_hasta_id:
             return Response({
                 'status': True,
                 'detail': 'La conversación ha sido verificada con éxito.'
@@ -591,31 +897,28 @@ class ValidateChat(APIView):
 @method_decorator(csrf_exempt, name='dispatch')
 class AuthorizedChat(APIView):
     permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'chat'
 
     def post(self, request, format=None):
 
         serializer = AuthorizedChatSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)  # valida la estructura
         id_chat = serializer.validated_data['id_chat']
-        consulta_chat = Chat.objects.filter(id__exact=id_chat)
-        peticion = request.headers['Authorization']
-        last = peticion.rsplit(' ', 1)[-1]
-
-        user_hasta = get_user_from_token(last)
-
-        if len(consulta_chat) >= 1:
-            chat = consulta_chat[0]
+        chat = Chat.objects.filter(id__exact=id_chat).first()
+        user_hasta = request.user
 
-        else:
+        if chat is None:
 
             return Response({
                 'status': False,
                 'detail': '¡La conversación no existe!'
             })
 
-        if user_hasta == chat.user_hasta:
+        if user_hasta.pk == chat.user_hasta_id:
             chat.aceptado = True
-            chat.save()
+            chat.save(update_fields=['aceptado'])
+            notify_chat_accepted(chat)
             return Response({
                 'status': True,
 
@@ -631,29 +934,25 @@ class AuthorizedChat(APIView):
 @method_decorator(csrf_exempt, name='dispatch')
 class ValidateChatAproved(APIView):
     permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'chat'
 
     def get(self, request, format=None):
 
         serializer = ValidateChatSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)  # valida la estructura
         id_chat = serializer.validated_data['id_chat']
-        consulta_chat = Chat.objects.filter(id__exact=id_chat)
-        peticion = request.headers['Authorization']
-        last = peticion.rsplit(' ', 1)[-1]
-
-        user_desde = get_user_from_token(last)
+        chat = replica_chat(Chat.objects.all(), id_chat)
+        user_desde = request.user
 
-        if len(consulta_chat) >= 1:
-            chat = consulta_chat[0]
-
-        else:
+        if chat is None:
 
             return Response({
                 'status': False,
                 'detail': '¡La conversación no existe!'
             })
 
-        if user_desde == chat.user_desde:
+        if user_desde.pk == chat.user_desde_id:
 
             if chat.aceptado == True:
                 return Response({
@@ -672,3 +971,864 @@ class ValidateChatAproved(APIView):
                 'status': False,
                 'detail': 'La conversación consultada no le corresponde.'
             })
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncAPIView(View):
+    '''
+    Base of the ASGI-native views. DRF's APIView can not run coroutine handlers, so this
+    plain django View does the part of the DRF pipeline the sync views use: body parsing,
+    knox token authentication through the token cache (unless ``authentication_class`` is
+    None), throttling and the request serializer. Handlers get the user in
+    ``request.user`` and the data in ``self.validated_data``; the responses are the same
+    JSON as the sync views.
+    '''
+    authentication_class = CachedTokenAuthentication
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'chat'
+    serializer_class = None
+
+    async def dispatch(self, request, *args, **kwargs):
+        if not hasattr(self, request.method.lower()):
+            return await super().dispatch(request, *args, **kwargs)  # 405
+        try:
+            data = await sync_to_async(self.initial)(request)
+        except exceptions.APIException as exc:
+            response = JsonResponse({'detail': exc.detail}, status=exc.status_code)
+            if exc.status_code == status.HTTP_401_UNAUTHORIZED:
+                response['WWW-Authenticate'] = self.authentication_class().authenticate_header(request)
+            if getattr(exc, 'wait', None):
+                response['Retry-After'] = '%d' % exc.wait
+            return response
+
+        serializer = self.serializer_class(data=data)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        self.validated_data = serializer.validated_data
+        return await super().dispatch(request, *args, **kwargs)
+
+    def initial(self, request):
+        '''
+        Parses the body into ``request.data`` (throttles may read it), then authenticates
+        and throttles the request. Runs in the sync thread: the token cache and the
+        throttles may hit the database or redis.
+        '''
+        # validated_chat/ and validate_chat_aproved/ take a JSON body even on GET.
+        if request.content_type != 'application/json':
+            request.data = request.POST
+        else:
+            try:
+                request.data = json.loads(request.body or b'{}')
+            except ValueError as exc:
+                raise exceptions.ParseError('JSON parse error - %s' % exc)
+            if not isinstance(request.data, dict):
+                raise exceptions.ParseError('JSON parse error - se esperaba un objeto')
+
+        if self.authentication_class is not None:
+            result = self.authentication_class().authenticate(request)
+            if result is None:
+                raise exceptions.NotAuthenticated()
+            request.user, request.auth = result
+        for throttle_class in self.throttle_classes:
+            throttle = throttle_class()
+            if not throttle.allow_request(request, self):
+                raise exceptions.Throttled(throttle.wait())
+        return self.get_data(request)
+
+    def get_data(self, request):
+        '''The data validated with ``serializer_class``: the parsed body.'''
+        return request.data
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class LoginAsync(AsyncAPIView):
+    '''
+    ASGI-native LoginAPI. The sync view keeps a request thread busy for the whole login,
+    password hash included; here the request only awaits the hash, which runs in
+    ``api_chat.hashers.password_executor``, so at most PASSWORD_HASHER_THREADS hashes (one
+    per core) run at once instead of one per concurrent login competing for the cores.
+    '''
+    authentication_class = None
+    # Every attempt runs a full password hash, so it is throttled before authenticating.
+    throttle_classes = (PhoneRateThrottle, IPRateThrottle)
+    throttle_scope = 'login'
+    serializer_class = LoginCredentialsSerializer
+
+    async def post(self, request, format=None):
+        phone = normalize_phone(self.validated_data['phone'])
+        user = await aauthenticate(phone, self.validated_data['password'], request)
+        if user is None:
+            # Only failed logins pay for the query that tells both errors apart.
+            registered = await User.objects.filter(phone=phone).aexists()
+            return JsonResponse(as_serializer_error(login_failed_error(registered)),
+                                status=status.HTTP_400_BAD_REQUEST)
+
+        data = await sync_to_async(self.complete_login)(request, user)
+        if data is None:
+            return JsonResponse({"error": "Maximum amount of tokens allowed per user exceeded."},
+                                status=status.HTTP_403_FORBIDDEN)
+        return JsonResponse(data)
+
+    @staticmethod
+    def complete_login(request, user):
+        '''
+        The rest of LoginAPI, run in the sync thread. Returns the response data, or None
+        if the user has too many tokens.
+        '''
+        view = LoginAPI()
+        view.request, view.format_kwarg = request, None
+        view.log_in(request, user)
+        created = view.create_token(user)
+        if created is None:
+            return None
+        instance, token = created
+        return view.get_post_response_data(request, token, instance)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class CreateChatAsync(AsyncAPIView):
+    serializer_class = CreateChatSerializer
+
+    async def post(self, request, format=None):
+        telefono_hasta = normalize_phone(self.validated_data['phone_hasta'])
+        try:
+            user_hasta = await User.objects.only('id', 'name').aget(phone=telefono_hasta)
+        except User.DoesNotExist:
+            return JsonResponse({
+                'status': False,
+                'detail': '¡El numero de telefono del destinatario no existe!'
+            })
+
+        new_chat = await Chat.objects.acreate(user_desde=request.user, user_hasta=user_hasta)
+
+        return JsonResponse({
+            'status': True,
+            'detail': 'El Chat ha sido creado satisfactoriamente.',
+            'id_conversacion': str(new_chat.pk),
+            'id_destinatario': str(user_hasta.pk),
+            'nombre_destinatario': str(user_hasta.name)
+        })
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ValidateChatAsync(AsyncAPIView):
+    serializer_class = ValidateChatSerializer
+
+    async def get(self, request, format=None):
+        chat = await areplica_chat(Chat.objects.only('id', 'user_hasta'), self.validated_data['id_chat'])
+        if chat is None:
+            return JsonResponse({
+                'status': False,
+                'detail': '¡La conversación no existe!'
+            })
+
+        if request.user.pk == chat.user_hasta_id:
+            return JsonResponse({
+                'status': True,
+                'detail': 'La conversación ha sido verificada con éxito.'
+            })
+        else:
+            return JsonResponse({
+                'status': False,
+                'detail': 'La conversación no ha sido verificada correctamente.'
+            })
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AuthorizedChatAsync(AsyncAPIView):
+    serializer_class = AuthorizedChatSerializer
+
+    async def post(self, request, format=None):
+        try:
+            chat = await Chat.objects.only('id', 'user_hasta').aget(id=self.validated_data['id_chat'])
+        except Chat.DoesNotExist:
+            return JsonResponse({
+                'status': False,
+                'detail': '¡La conversación no existe!'
+            })
+
+        if request.user.pk == chat.user_hasta_id:
+            await Chat.objects.filter(pk=chat.pk).aupdate(aceptado=True)
+            await anotify_chat_accepted(chat)
+            return JsonResponse({
+                'status': True,
+                'detail': 'La conversación ha sido aceptada.'
+            })
+        else:
+            return JsonResponse({
+                'status': False,
+                'detail': 'La conversación no ha sido aceptada.'
+            })
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ValidateChatAprovedAsync(AsyncAPIView):
+    serializer_class = ValidateChatSerializer
+
+    async def get(self, request, format=None):
+        chat = await areplica_chat(Chat.objects.only('id', 'user_desde', 'aceptado'), self.validated_data['id_chat'])
+        if chat is None:
+            return JsonResponse({
+                'status': False,
+                'detail': '¡La conversación no existe!'
+            })
+
+        if request.user.pk == chat.user_desde_id:
+            if chat.aceptado == True:
+                return JsonResponse({
+                    'status': True,
+                    'detail': 'La conversación ha sido aceptada por el receptor.'
+                })
+            else:
+                return JsonResponse({
+                    'status': False,
+                    'detail': 'La conversación no ha sido aceptada por el receptor.'
+                })
+        else:
+            return JsonResponse({
+                'status': False,
+                'detail': 'La conversación consultada no le corresponde.'
+            })
+
+
+def b64(value):
+    return base64.b64encode(bytes(value)).decode('ascii')
+
+
+def store_prekeys(user, prekeys):
+    '''
+    Adds ``prekeys`` to the pool of ``user`` with one bulk INSERT; key_ids already in the
+    pool are skipped. Returns how many prekeys the pool has.
+    '''
+    OneTimePreKey.objects.bulk_create(
+        [OneTimePreKey(user=user, key_id=prekey['key_id'], public_key=prekey['public_key']) for prekey in prekeys],
+        ignore_conflicts=True)
+    return OneTimePreKey.objects.filter(user=user).count()
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class UploadKeys(APIView):
+    '''
+    Publishes the caller's identity key and signed prekey, with an optional first batch of
+    one-time prekeys. A new identity key discards the prekeys of the previous one.
+    '''
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'keys'
+
+    def post(self, request, format=None):
+        serializer = UploadKeysSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)  # valida la estructura
+        datos = serializer.validated_data
+
+        with transaction.atomic():
+            anterior = KeyBundle.objects.filter(user=request.user).values_list('identity_key', flat=True).first()
+            if anterior is not None and bytes(anterior) != datos['identity_key']:
+                OneTimePreKey.objects.filter(user=request.user).delete()
+            KeyBundle.objects.update_or_create(user=request.user, defaults={
+                'identity_key': datos['identity_key'],
+                'signed_prekey_id': datos['signed_prekey_id'],
+                'signed_prekey': datos['signed_prekey'],
+                'signed_prekey_signature': datos['signed_prekey_signature'],
+            })
+            disponibles = store_prekeys(request.user, datos['one_time_prekeys'])
+
+        return Response({
+            'status': True,
+            'detail': 'Las claves han sido publicadas.',
+            'prekeys_disponibles': disponibles,
+        })
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class UploadPreKeys(APIView):
+    '''
+    GET tells how many one-time prekeys the caller has left; POST tops the pool up with
+    ``one_time_prekeys`` (up to KEYS_MAX_PREKEYS per request).
+    '''
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'keys'
+
+    def get(self, request, format=None):
+        return Response({
+            'status': True,
+            'prekeys_disponibles': OneTimePreKey.objects.filter(user=request.user).count(),
+        })
+
+    def post(self, request, format=None):
+        serializer = UploadPreKeysSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)  # valida la estructura
+
+        if not KeyBundle.objects.filter(user=request.user).exists():
+            return Response({
+                'status': False,
+                'detail': 'Publique primero su clave de identidad.'
+            })
+        return Response({
+            'status': True,
+            'detail': 'Las prekeys han sido publicadas.',
+            'prekeys_disponibles': store_prekeys(request.user, serializer.validated_data['one_time_prekeys']),
+        })
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class KeyBundles(APIView):
+    '''
+    Key bundles of ``ids_usuarios``, to start sessions with all of them at once (e.g. the
+    members of a group): one query reads the published keys and one claims a one-time
+    prekey of each user, whatever the number of users. ``one_time_prekey`` is null once a
+    user's pool is empty; users that published no keys are listed in ``sin_claves``.
+    '''
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'keys'
+
+    def post(self, request, format=None):
+        serializer = KeyBundlesSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)  # valida la estructura
+        ids_usuarios = list(dict.fromkeys(serializer.validated_data['ids_usuarios']))
+
+        bundles = {bundle.user_id: bundle for bundle in KeyBundle.objects.filter(user_id__in=ids_usuarios)}
+        prekeys = OneTimePreKey.objects.claim(bundles)
+
+        resultado = []
+        for id_usuario in ids_usuarios:
+            bundle = bundles.get(id_usuario)
+            if bundle is None:
+                continue
+            prekey = prekeys.get(id_usuario)
+            resultado.append({
+                'id_usuario': id_usuario,
+                'identity_key': b64(bundle.identity_key),
+                'signed_prekey_id': bundle.signed_prekey_id,
+                'signed_prekey': b64(bundle.signed_prekey),
+                'signed_prekey_signature': b64(bundle.signed_prekey_signature),
+                'one_time_prekey': {'key_id': prekey[0], 'public_key': b64(prekey[1])} if prekey else None,
+            })
+
+        return Response({
+            'status': True,
+            'bundles': resultado,
+            'sin_claves': [id_usuario for id_usuario in ids_usuarios if id_usuario not in bundles],
+        })
+
+
+def es_participante(id_chat, user):
+    '''
+    Whether ``user`` takes part in the chat: either side of a direct chat, or a member of
+    a group who accepted the invitation (one more probe of the (chat, user) index).
+    '''
+    chat = Chat.objects.filter(id=id_chat).only('tipo', 'user_desde', 'user_hasta').first()
+    if chat is None:
+        return False
+    if chat.tipo == Chat.GRUPO:
+        return ChatMember.objects.filter(chat_id=id_chat, user=user, aceptado=True).exists()
+    return user.pk in (chat.user_desde_id, chat.user_hasta_id)
+
+
+class ChatHistory(APIView):
+    '''
+    Keyset-paginated message history: GET with ?id_chat=<id>&after=<seq>&limit=<n> returns the
+    messages with seq > after in order. Each page is a range scan on the (chat, seq) index, so
+    its cost does not depend on how long the conversation is. Pass back ``next_after`` to get
+    the following page.
+    '''
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'chat'
+
+    def get(self, request, format=None):
+        serializer = ChatHistorySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)  # valida la estructura
+        id_chat = serializer.validated_data['id_chat']
+        after = serializer.validated_data['after']
+        limit = serializer.validated_data.get('limit', settings.CHAT_HISTORY_PAGE_SIZE)
+
+        if not es_participante(id_chat, request.user):
+            return Response({
+                'status': False,
+                'detail': 'La conversación consultada no le corresponde.'
+            })
+
+        # One extra row tells whether there is another page without a COUNT query.
+        mensajes = list(Message.objects.filter(chat_id=id_chat, seq__gt=after).order_by('seq')[:limit + 1])
+        has_more = len(mensajes) > limit
+        mensajes = mensajes[:limit]
+
+        return Response({
+            'status': True,
+            'mensajes': MessageSerializer(mensajes, many=True).data,
+            'next_after': mensajes[-1].seq if mensajes else after,
+            'has_more': has_more,
+        })
+
+
+class ChatInbox(APIView):
+    '''
+    The caller's conversations, newest first: GET with ?estado=todos|pendientes|activos
+    &before=<cursor>&limit=<n>. Pass back ``next_cursor`` as ``before`` to get the following
+    page. Chats started by the caller and chats received are read with one keyset query each,
+    every one a range scan on its own (user, fecha_hora_creacion, id) index instead of an OR
+    over both user columns, and merged here.
+    '''
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'chat'
+
+    def get(self, request, format=None):
+        serializer = ChatInboxSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)  # valida la estructura
+        estado = serializer.validated_data['estado']
+        before = serializer.validated_data.get('before')
+        limit = serializer.validated_data.get('limit', settings.CHAT_INBOX_PAGE_SIZE)
+
+        chats = Chat.objects.all()
+        if estado == 'pendientes':
+            chats = chats.filter(aceptado=False)
+        elif estado == 'activos':
+            chats = chats.filter(aceptado=True)
+        if before is not None:
+            fecha, id_chat = before
+            # The redundant fecha <= bound lets the database use it as an index range.
+            chats = chats.filter(Q(fecha_hora_creacion__lt=fecha) | Q(id__lt=id_chat),
+                                 fecha_hora_creacion__lte=fecha)
+        chats = chats.order_by('-fecha_hora_creacion', '-id')
+
+        # One extra row tells whether there is another page without a COUNT query.
+        recibidos = chats.filter(user_hasta=request.user).select_related('user_desde')[:limit + 1]
+        enviados = chats.filter(user_desde=request.user).select_related('user_hasta')[:limit + 1]
+        pagina = []
+        for chat in heapq.merge(recibidos, enviados,
+                                key=lambda chat: (chat.fecha_hora_creacion, chat.id), reverse=True):
+            if pagina and pagina[-1].id == chat.id:
+                continue  # chat with oneself, read from both sides
+            pagina.append(chat)
+        has_more = len(pagina) > limit
+        pagina = pagina[:limit]
+
+        return Response({
+            'status': True,
+            'chats': InboxChatSerializer(pagina, many=True, context={'user': request.user}).data,
+            'next_cursor': encode_inbox_cursor(pagina[-1]) if pagina else None,
+            'has_more': has_more,
+        })
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class Devices(APIView):
+    '''
+    GET lists the caller's devices; POST registers the device ``identificador`` (registering
+    it again returns the same id). Every device gets its own mailbox, see mailbox/.
+    '''
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'chat'
+
+    def get(self, request, format=None):
+        return Response({
+            'status': True,
+            'dispositivos': [
+                {'id_dispositivo': id_dispositivo, 'identificador': identificador, 'nombre': nombre}
+                for id_dispositivo, identificador, nombre in
+                Device.objects.filter(user=request.user).values_list('id', 'identificador', 'nombre').order_by('id')
+            ],
+        })
+
+    def post(self, request, format=None):
+        serializer = DeviceSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)  # valida la estructura
+
+        dispositivo, _ = Device.objects.get_or_create(
+            user=request.user, identificador=serializer.validated_data['identificador'],
+            defaults={'nombre': serializer.validated_data['nombre']})
+        return Response({
+            'status': True,
+            'detail': 'El dispositivo ha sido registrado.',
+            'id_dispositivo': dispositivo.pk,
+        })
+
+
+def participantes(chat, ids_usuarios):
+    '''
+    The users among ``ids_usuarios`` that take part in ``chat``: either side of an accepted
+    direct chat, or the members of a group who accepted the invitation.
+    '''
+    if chat.tipo == Chat.GRUPO:
+        return set(ChatMember.objects.filter(chat=chat, user_id__in=ids_usuarios, aceptado=True)
+                   .values_list('user_id', flat=True))
+    if not chat.aceptado:
+        return set()
+    return {chat.user_desde_id, chat.user_hasta_id}.intersection(ids_usuarios)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class MailboxSend(APIView):
+    '''
+    Store-and-forward delivery: POST with ``id_chat`` and ``sobres``, one ciphertext per
+    recipient user (encrypted with the keys of key_bundles/). Each envelope is copied to the
+    mailbox of every device of its recipient with one bulk INSERT, and pushed to the devices
+    connected to ws/mailbox/<id>/. Recipients with no registered device are listed in
+    ``sin_dispositivos``.
+    '''
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'chat'
+
+    def post(self, request, format=None):
+        serializer = MailboxSendSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)  # valida la estructura
+        contenidos = {sobre['id_usuario']: sobre['contenido'] for sobre in serializer.validated_data['sobres']}
+
+        chat = Chat.objects.filter(id=serializer.validated_data['id_chat']).only(
+            'id', 'tipo', 'aceptado', 'user_desde', 'user_hasta').first()
+        validos = participantes(chat, [request.user.pk, *contenidos]) if chat else set()
+        if request.user.pk not in validos:
+            return Response({
+                'status': False,
+                'detail': 'La conversación consultada no le corresponde.'
+            })
+        if not validos.issuperset(contenidos):
+            return Response({
+                'status': False,
+                'detail': 'Los usuarios %s no participan en la conversación.' % sorted(set(contenidos) - validos)
+            })
+
+        dispositivos = list(Device.objects.filter(user_id__in=contenidos).values_list('id', 'user_id'))
+        sobres = Envelope.objects.bulk_create(
+            [Envelope(device_id=id_dispositivo, chat=chat, user_desde=request.user, contenido=contenidos[id_usuario])
+             for id_dispositivo, id_usuario in dispositivos], batch_size=1000)
+        # Without RETURNING (old sqlite) the ids are unknown; the devices get them on drain.
+        notify_envelopes([sobre for sobre in sobres if sobre.pk is not None])
+
+        con_dispositivo = {id_usuario for _, id_usuario in dispositivos}
+        return Response({
+            'status': True,
+            'detail': 'Los sobres han sido enviados.',
+            'sobres': len(sobres),
+            'sin_dispositivos': [id_usuario for id_usuario in contenidos if id_usuario not in con_dispositivo],
+        })
+
+
+def own_device(request, id_dispositivo):
+    return Device.objects.filter(id=id_dispositivo, user=request.user).exists()
+
+
+class Mailbox(APIView):
+    '''
+    Drains the mailbox of a device after being offline: GET with ?id_dispositivo=<id>
+    &after=<id>&limit=<n> returns the envelopes with id > after, oldest first, up to
+    MAILBOX_MAX_LIMIT per page; pass back ``next_after`` while ``has_more``. Each page is a
+    range scan on the (device, id) index and envelopes stay until acknowledged with
+    mailbox/ack/, so a drain interrupted halfway is simply repeated.
+    '''
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'chat'
+
+    def get(self, request, format=None):
+        serializer = MailboxSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)  # valida la estructura
+        id_dispositivo = serializer.validated_data['id_dispositivo']
+        after = serializer.validated_data['after']
+        limit = serializer.validated_data.get('limit', settings.MAILBOX_PAGE_SIZE)
+
+        if not own_device(request, id_dispositivo):
+            return Response({
+                'status': False,
+                'detail': 'El dispositivo consultado no le corresponde.'
+            })
+
+        # Plain tuples and one extra row for has_more: pages are thousands of envelopes long.
+        filas = list(Envelope.objects.filter(device_id=id_dispositivo, id__gt=after).order_by('id').values_list(
+            'id', 'chat_id', 'user_desde_id', 'contenido', 'fecha_hora_creacion')[:limit + 1])
+        has_more = len(filas) > limit
+        filas = filas[:limit]
+        fecha = DateTimeField()
+
+        return Response({
+            'status': True,
+            'sobres': [
+                {'id': id_sobre, 'id_chat': id_chat, 'user_desde': user_desde, 'contenido': b64(contenido),
+                 'fecha_hora_creacion': fecha.to_representation(fecha_hora_creacion)}
+                for id_sobre, id_chat, user_desde, contenido, fecha_hora_creacion in filas
+            ],
+            'next_after': filas[-1][0] if filas else after,
+            'has_more': has_more,
+        })
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class MailboxAck(APIView):
+    '''
+    Acknowledges the envelopes of a device with ``desde`` <= id <= ``hasta`` (``desde``
+    defaults to 0: everything up to ``hasta``), deleting them with one range DELETE.
+    '''
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'chat'
+
+    def post(self, request, format=None):
+        serializer = MailboxAckSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)  # valida la estructura
+        id_dispositivo = serializer.validated_data['id_dispositivo']
+
+        if not own_device(request, id_dispositivo):
+            return Response({
+                'status': False,
+                'detail': 'El dispositivo consultado no le corresponde.'
+            })
+
+        # Nothing references an envelope or listens for its deletion, so delete() runs one
+        # DELETE without collecting them first.
+        eliminados, _ = Envelope.objects.filter(
+            device_id=id_dispositivo,
+            id__range=(serializer.validated_data['desde'], serializer.validated_data['hasta']),
+        ).delete()
+        return Response({
+            'status': True,
+            'detail': 'Los sobres han sido confirmados.',
+            'eliminados': eliminados,
+        })
+
+def storage_unavailable():
+    logger.exception('Error del almacenamiento de adjuntos')
+    return Response({
+        'status': False,
+        'detail': 'El almacenamiento no está disponible, inténtelo más tarde.'
+    }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+def get_attachment(request, id_adjunto, estado):
+    '''
+    The attachment ``id_adjunto`` in ``estado``, if it belongs to a chat the caller takes
+    part in; only its uploader may see it while pending. None otherwise.
+    '''
+    adjunto = Attachment.objects.select_related('chat').filter(id=id_adjunto, estado=estado).first()
+    if adjunto is None or not participantes(adjunto.chat, [request.user.pk]):
+        return None
+    if estado == Attachment.PENDIENTE and adjunto.user_id != request.user.pk:
+        return None
+    return adjunto
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class Attachments(APIView):
+    '''
+    Starts the upload of an encrypted attachment of ``tamano`` bytes to ``id_chat``: returns
+    a presigned PUT url for every part of ``tamano_parte`` bytes (the last one may be
+    shorter). Parts may be uploaded in parallel and in any order, straight to the bucket;
+    then call attachment_complete/. An interrupted upload is resumed with attachment_parts/.
+    '''
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'attachments'
+
+    def post(self, request, format=None):
+        serializer = CreateAttachmentSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)  # valida la estructura
+        tamano = serializer.validated_data['tamano']
+
+        chat = Chat.objects.filter(id=serializer.validated_data['id_chat']).only(
+            'id', 'tipo', 'aceptado', 'user_desde', 'user_hasta').first()
+        if chat is None or not participantes(chat, [request.user.pk]):
+            return Response({
+                'status': False,
+                'detail': 'La conversación consultada no le corresponde.'
+            })
+
+        tamano_parte = max(settings.ATTACHMENT_PART_SIZE, attachments.MIN_PART_SIZE,
+                           -(-tamano // attachments.MAX_PARTS))
+        key = '%s/%d/%s' % (settings.ATTACHMENTS_LOCATION, chat.pk, unique_key_generator())
+        try:
+            upload_id = attachments.create_upload(key)
+        except attachments.STORAGE_ERRORS:
+            return storage_unavailable()
+        adjunto = Attachment.objects.create(chat=chat, user=request.user, key=key, upload_id=upload_id,
+                                            tamano=tamano, tamano_parte=tamano_parte)
+
+        return Response({
+            'status': True,
+            'id_adjunto': adjunto.pk,
+            'tamano_parte': tamano_parte,
+            'partes': attachments.presign_parts(
+                key, upload_id, range(1, attachments.part_count(tamano, tamano_parte) + 1)),
+            'expira_en': settings.ATTACHMENT_URL_EXPIRES,
+        })
+
+
+class AttachmentParts(APIView):
+    '''
+    Resumes a pending upload: GET with ?id_adjunto=<id> lists the parts already stored in
+    the bucket and returns fresh urls for the missing ones (or the ones of a wrong size).
+    '''
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'attachments'
+
+    def get(self, request, format=None):
+        serializer = AttachmentSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)  # valida la estructura
+
+        adjunto = get_attachment(request, serializer.validated_data['id_adjunto'], Attachment.PENDIENTE)
+        if adjunto is None:
+            return Response({
+                'status': False,
+                'detail': 'No tiene una subida pendiente con ese adjunto.'
+            })
+        try:
+            partes = attachments.list_uploaded_parts(adjunto.key, adjunto.upload_id)
+        except attachments.STORAGE_ERRORS:
+            return storage_unavailable()
+        faltantes = attachments.missing_parts(adjunto, partes)
+
+        return Response({
+            'status': True,
+            'tamano_parte': adjunto.tamano_parte,
+            'subidas': sorted(set(partes) - set(faltantes)),
+            'partes': attachments.presign_parts(adjunto.key, adjunto.upload_id, faltantes),
+            'expira_en': settings.ATTACHMENT_URL_EXPIRES,
+        })
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AttachmentComplete(APIView):
+    '''
+    Finishes an upload once all its parts are stored. The parts are read from the bucket,
+    so their sizes are checked against the declared ``tamano`` and the client does not need
+    to collect ETags.
+    '''
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'attachments'
+
+    def post(self, request, format=None):
+        serializer = AttachmentSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)  # valida la estructura
+
+        adjunto = get_attachment(request, serializer.validated_data['id_adjunto'], Attachment.PENDIENTE)
+        if adjunto is None:
+            return Response({
+                'status': False,
+                'detail': 'No tiene una subida pendiente con ese adjunto.'
+            })
+        try:
+            partes = attachments.list_uploaded_parts(adjunto.key, adjunto.upload_id)
+            faltantes = attachments.missing_parts(adjunto, partes)
+            if faltantes:
+                return Response({
+                    'status': False,
+                    'detail': 'Faltan partes por subir.',
+                    'faltantes': faltantes,
+                })
+            attachments.complete_upload(adjunto.key, adjunto.upload_id, partes)
+        except attachments.STORAGE_ERRORS:
+            return storage_unavailable()
+        Attachment.objects.filter(pk=adjunto.pk).update(estado=Attachment.COMPLETO, upload_id='')
+
+        return Response({
+            'status': True,
+            'detail': 'El adjunto ha sido subido.',
+            'id_adjunto': adjunto.pk,
+        })
+
+
+class AttachmentDownload(APIView):
+    '''
+    GET with ?id_adjunto=<id> returns a presigned url to download a completed attachment
+    from the bucket, for any participant of its chat.
+    '''
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (TokenRateThrottle,)
+    throttle_scope = 'attachments'
+
+    def get(self, request, format=None):
+        serializer = AttachmentSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)  # valida la estructura
+
+        adjunto = get_attachment(request, serializer.validated_data['id_adjunto'], Attachment.COMPLETO)
+        if adjunto is None:
+            return Response({
+                'status': False,
+                'detail': 'El adjunto consultado no le corresponde.'
+            })
+        return Response({
+            'status': True,
+            'url': attachments.presign_download(adjunto.key),
+            'tamano': adjunto.tamano,
+            'expira_en': settings.ATTACHMENT_URL_EXPIRES,
+        })
+
+class ValidateChatAprovedWait(AsyncAPIView):
+    '''
+    Long-poll variant of ValidateChatAproved: GET with ?id_chat=<id>&timeout=<seconds> blocks
+    until the receiver accepts the chat or the timeout expires, instead of the initiator
+    polling validate_chat_aproved/ in a loop. Served natively by the ASGI server, so a
+    waiting request does not hold a worker thread.
+    '''
+    serializer_class = ChatLongPollSerializer
+
+    def get_data(self, request):
+        return request.GET.dict()
+
+    async def get(self, request, *args, **kwargs):
+        id_chat = self.validated_data['id_chat']
+        timeout = self.validated_data.get('timeout', min(settings.CHAT_LONG_POLL_TIMEOUT,
+                                                         settings.CHAT_LONG_POLL_MAX_TIMEOUT))
+
+        # Subscribe before reading the chat so an acceptance landing in between is not lost.
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel()
+        await channel_layer.group_add(chat_group_name(id_chat), channel)
+        try:
+            chat = await Chat.objects.filter(id=id_chat).only('id', 'aceptado', 'user_desde').afirst()
+            if chat is None:
+                return JsonResponse({
+                    'status': False,
+                    'detail': '¡La conversación no existe!'
+                })
+
+            if chat.user_desde_id != request.user.pk:
+                return JsonResponse({
+                    'status': False,
+                    'detail': 'La conversación consultada no le corresponde.'
+                })
+
+            if not chat.aceptado:
+                try:
+                    await asyncio.wait_for(self.wait_accepted(channel_layer, channel), timeout)
+                except asyncio.TimeoutError:
+                    return JsonResponse({
+                        'status': False,
+                        'detail': 'La conversación no ha sido aceptada por el receptor.'
+                    })
+
+            return JsonResponse({
+                'status': True,
+                'detail': 'La conversación ha sido aceptada por el receptor.'
+            })
+        finally:
+            await channel_layer.group_discard(chat_group_name(id_chat), channel)
+
+    @staticmethod
+    async def wait_accepted(channel_layer, channel):
+        while True:
+            event = await channel_layer.receive(channel)
+            if event.get('type') == 'chat.accepted':
+                return event
+
+
+class MetricsView(View):
+    '''
+    Scrape endpoint for the ``api_chat.metrics`` registry of this process, in the Prometheus
+    text format. Not found unless METRICS_ENABLED; when METRICS_TOKEN is set the scraper
+    must send ``Authorization: Bearer <METRICS_TOKEN>``.
+    '''
+
+    def get(self, request, *args, **kwargs):
+        if not settings.METRICS_ENABLED:
+            raise Http404
+        if settings.METRICS_TOKEN and not compare_digest(
+                request.headers.get('Authorization', ''), 'Bearer %s' % settings.METRICS_TOKEN):
+            return HttpResponse(status=status.HTTP_401_UNAUTHORIZED)
+        return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')